@@ -1,5 +1,6 @@
 from django.contrib import admin
 from safe_geonode.models import Calculation, Server, Workspace
+from safe_geonode.models import LayerMetadata
 
 
 class CalculationAdmin(admin.ModelAdmin):
@@ -9,5 +10,12 @@ class CalculationAdmin(admin.ModelAdmin):
                     'run_duration', 'layer', 'exposure_layer',
                     'hazard_layer', 'impact_function')
 
+
+class LayerMetadataAdmin(admin.ModelAdmin):
+    list_filter = 'server_url', 'layertype'
+    list_display = ('name', 'server_url', 'title', 'layertype', 'synced')
+    search_fields = ('name', 'title')
+
 admin.site.register(Calculation, CalculationAdmin)
+admin.site.register(LayerMetadata, LayerMetadataAdmin)
 admin.site.register([Server, Workspace])
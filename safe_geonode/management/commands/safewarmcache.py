@@ -0,0 +1,98 @@
+#########################################################################
+#
+# Copyright (C) 2012 OpenPlans
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+#########################################################################
+
+from django.core.management.base import BaseCommand
+from optparse import make_option
+from safe_geonode.models import Server
+from safe_geonode.storage import INTERNAL_SERVER_URL
+from safe_geonode.storage import CAPABILITIES_CACHE_TIMEOUT
+from safe_geonode.storage import USE_LAYER_CATALOG
+from safe_geonode.storage import get_ows_metadata, sync_layer_catalog
+from safe_geonode.utilities import run_in_parallel
+import datetime
+import time
+import sys
+
+
+def refresh_server(server_url):
+    """Refresh cached capabilities and layer catalog of one server
+
+    Output
+        tuple of number of layers and seconds it took
+    """
+
+    start = datetime.datetime.now()
+    if USE_LAYER_CATALOG:
+        metadata = sync_layer_catalog(server_url, refresh=True)
+    else:
+        metadata = get_ows_metadata(server_url, refresh=True)
+
+    td = datetime.datetime.now() - start
+    duration = td.microseconds / 1000000.0 + td.seconds + td.days * 24 * 3600
+    return len(metadata), round(duration, 2)
+
+
+class Command(BaseCommand):
+    help = ("Keeps capabilities and layer metadata of the local GeoServer"
+            " and all registered servers fresh in the cache so that users"
+            " do not have to wait for them.")
+
+    option_list = BaseCommand.option_list + (
+            make_option('-i', '--interval', dest='interval', type='int',
+                default=CAPABILITIES_CACHE_TIMEOUT // 2,
+                help="Number of seconds between refreshes"),
+            make_option('-w', '--workers', dest='workers', type='int',
+                default=4,
+                help="Number of servers refreshed at the same time"),
+            make_option('-o', '--once',
+                action='store_true',
+                dest='once',
+                default=False,
+                help='Refresh once and exit instead of running forever.'),
+        )
+
+    def handle(self, *args, **options):
+        verbosity = int(options.get('verbosity'))
+        interval = options.get('interval')
+        workers = options.get('workers')
+        once = options.get('once')
+
+        while True:
+            start = time.time()
+
+            server_urls = [INTERNAL_SERVER_URL]
+            for server in Server.objects.all():
+                if server.url not in server_urls:
+                    server_urls.append(server.url)
+
+            results = run_in_parallel(refresh_server, server_urls,
+                                      workers=workers)
+
+            for server_url, (result, error) in zip(server_urls, results):
+                if error is not None:
+                    print >> sys.stderr, ('Could not refresh %s: %s'
+                                          % (server_url, error))
+                elif verbosity > 0:
+                    print ('Refreshed %d layers from %s in %s seconds'
+                           % (result[0], server_url, result[1]))
+
+            if once:
+                break
+
+            time.sleep(max(0, interval - (time.time() - start)))
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+import datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        # Adding model 'Calculation'
+        db.create_table('safe_geonode_calculation', (
+            ('id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('user', self.gf('django.db.models.fields.related.ForeignKey')(to=orm['auth.User'])),
+            ('success', self.gf('django.db.models.fields.BooleanField')(default=False)),
+            ('run_date', self.gf('django.db.models.fields.DateTimeField')()),
+            ('run_duration', self.gf('django.db.models.fields.FloatField')()),
+            ('impact_function', self.gf('django.db.models.fields.CharField')(max_length=255, null=True, blank=True)),
+            ('impact_function_source', self.gf('django.db.models.fields.TextField')()),
+            ('exposure_server', self.gf('django.db.models.fields.URLField')(max_length=200, null=True, blank=True)),
+            ('exposure_layer', self.gf('django.db.models.fields.CharField')(max_length=255, null=True, blank=True)),
+            ('hazard_server', self.gf('django.db.models.fields.URLField')(max_length=200, null=True, blank=True)),
+            ('hazard_layer', self.gf('django.db.models.fields.CharField')(max_length=255, null=True, blank=True)),
+            ('bbox', self.gf('django.db.models.fields.CharField')(max_length=255, null=True, blank=True)),
+            ('errors', self.gf('django.db.models.fields.TextField')()),
+            ('stacktrace', self.gf('django.db.models.fields.TextField')(null=True, blank=True)),
+            ('layer', self.gf('django.db.models.fields.CharField')(max_length=255, null=True, blank=True)),
+        ))
+        db.send_create_signal('safe_geonode', ['Calculation'])
+
+        # Adding model 'Server'
+        db.create_table('safe_geonode_server', (
+            ('id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('name', self.gf('django.db.models.fields.CharField')(max_length=255)),
+            ('url', self.gf('django.db.models.fields.URLField')(max_length=200)),
+        ))
+        db.send_create_signal('safe_geonode', ['Server'])
+
+        # Adding model 'Workspace'
+        db.create_table('safe_geonode_workspace', (
+            ('id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('user', self.gf('django.db.models.fields.related.ForeignKey')(to=orm['auth.User'])),
+        ))
+        db.send_create_signal('safe_geonode', ['Workspace'])
+
+        # Adding M2M table for field servers on 'Workspace'
+        db.create_table('safe_geonode_workspace_servers', (
+            ('id', models.AutoField(verbose_name='ID', primary_key=True, auto_created=True)),
+            ('workspace', models.ForeignKey(orm['safe_geonode.workspace'], null=False)),
+            ('server', models.ForeignKey(orm['safe_geonode.server'], null=False))
+        ))
+        db.create_unique('safe_geonode_workspace_servers', ['workspace_id', 'server_id'])
+
+    def backwards(self, orm):
+        # Deleting model 'Calculation'
+        db.delete_table('safe_geonode_calculation')
+
+        # Deleting model 'Server'
+        db.delete_table('safe_geonode_server')
+
+        # Deleting model 'Workspace'
+        db.delete_table('safe_geonode_workspace')
+
+        # Removing M2M table for field servers on 'Workspace'
+        db.delete_table('safe_geonode_workspace_servers')
+
+    models = {
+        'auth.group': {
+            'Meta': {'object_name': 'Group'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '80'}),
+            'permissions': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['auth.Permission']", 'symmetrical': 'False', 'blank': 'True'})
+        },
+        'auth.permission': {
+            'Meta': {'ordering': "('content_type__app_label', 'content_type__model', 'codename')", 'unique_together': "(('content_type', 'codename'),)", 'object_name': 'Permission'},
+            'codename': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['contenttypes.ContentType']"}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '50'})
+        },
+        'auth.user': {
+            'Meta': {'object_name': 'User'},
+            'date_joined': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'email': ('django.db.models.fields.EmailField', [], {'max_length': '75', 'blank': 'True'}),
+            'first_name': ('django.db.models.fields.CharField', [], {'max_length': '30', 'blank': 'True'}),
+            'groups': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['auth.Group']", 'symmetrical': 'False', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'is_active': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'is_staff': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'is_superuser': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'last_login': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'last_name': ('django.db.models.fields.CharField', [], {'max_length': '30', 'blank': 'True'}),
+            'password': ('django.db.models.fields.CharField', [], {'max_length': '128'}),
+            'user_permissions': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['auth.Permission']", 'symmetrical': 'False', 'blank': 'True'}),
+            'username': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '30'})
+        },
+        'contenttypes.contenttype': {
+            'Meta': {'ordering': "('name',)", 'unique_together': "(('app_label', 'model'),)", 'object_name': 'ContentType', 'db_table': "'django_content_type'"},
+            'app_label': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'model': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '100'})
+        },
+        'safe_geonode.calculation': {
+            'Meta': {'object_name': 'Calculation'},
+            'bbox': ('django.db.models.fields.CharField', [], {'max_length': '255', 'null': 'True', 'blank': 'True'}),
+            'errors': ('django.db.models.fields.TextField', [], {}),
+            'exposure_layer': ('django.db.models.fields.CharField', [], {'max_length': '255', 'null': 'True', 'blank': 'True'}),
+            'exposure_server': ('django.db.models.fields.URLField', [], {'max_length': '200', 'null': 'True', 'blank': 'True'}),
+            'hazard_layer': ('django.db.models.fields.CharField', [], {'max_length': '255', 'null': 'True', 'blank': 'True'}),
+            'hazard_server': ('django.db.models.fields.URLField', [], {'max_length': '200', 'null': 'True', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'impact_function': ('django.db.models.fields.CharField', [], {'max_length': '255', 'null': 'True', 'blank': 'True'}),
+            'impact_function_source': ('django.db.models.fields.TextField', [], {}),
+            'layer': ('django.db.models.fields.CharField', [], {'max_length': '255', 'null': 'True', 'blank': 'True'}),
+            'run_date': ('django.db.models.fields.DateTimeField', [], {}),
+            'run_duration': ('django.db.models.fields.FloatField', [], {}),
+            'stacktrace': ('django.db.models.fields.TextField', [], {'null': 'True', 'blank': 'True'}),
+            'success': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['auth.User']"})
+        },
+        'safe_geonode.server': {
+            'Meta': {'object_name': 'Server'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '255'}),
+            'url': ('django.db.models.fields.URLField', [], {'max_length': '200'})
+        },
+        'safe_geonode.workspace': {
+            'Meta': {'object_name': 'Workspace'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'servers': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['safe_geonode.Server']", 'symmetrical': 'False'}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['auth.User']"})
+        }
+    }
+
+    complete_apps = ['safe_geonode']
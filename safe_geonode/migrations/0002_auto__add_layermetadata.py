@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+import datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        # Adding model 'LayerMetadata'
+        db.create_table('safe_geonode_layermetadata', (
+            ('id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('server_url', self.gf('django.db.models.fields.URLField')(max_length=200, db_index=True)),
+            ('name', self.gf('django.db.models.fields.CharField')(max_length=255)),
+            ('title', self.gf('django.db.models.fields.CharField')(max_length=255, null=True, blank=True)),
+            ('layertype', self.gf('django.db.models.fields.CharField')(max_length=16)),
+            ('west', self.gf('django.db.models.fields.FloatField')(null=True, blank=True)),
+            ('south', self.gf('django.db.models.fields.FloatField')(null=True, blank=True)),
+            ('east', self.gf('django.db.models.fields.FloatField')(null=True, blank=True)),
+            ('north', self.gf('django.db.models.fields.FloatField')(null=True, blank=True)),
+            ('geotransform', self.gf('django.db.models.fields.CharField')(max_length=255, null=True, blank=True)),
+            ('keywords', self.gf('django.db.models.fields.TextField')()),
+            ('formats', self.gf('django.db.models.fields.TextField')(default='[]')),
+            ('tile_url', self.gf('django.db.models.fields.TextField')()),
+            ('synced', self.gf('django.db.models.fields.DateTimeField')()),
+        ))
+        db.send_create_signal('safe_geonode', ['LayerMetadata'])
+
+        # Adding unique constraint on 'LayerMetadata', fields ['server_url', 'name']
+        db.create_unique('safe_geonode_layermetadata', ['server_url', 'name'])
+
+    def backwards(self, orm):
+        # Removing unique constraint on 'LayerMetadata', fields ['server_url', 'name']
+        db.delete_unique('safe_geonode_layermetadata', ['server_url', 'name'])
+
+        # Deleting model 'LayerMetadata'
+        db.delete_table('safe_geonode_layermetadata')
+
+    models = {
+        'auth.group': {
+            'Meta': {'object_name': 'Group'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '80'}),
+            'permissions': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['auth.Permission']", 'symmetrical': 'False', 'blank': 'True'})
+        },
+        'auth.permission': {
+            'Meta': {'ordering': "('content_type__app_label', 'content_type__model', 'codename')", 'unique_together': "(('content_type', 'codename'),)", 'object_name': 'Permission'},
+            'codename': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['contenttypes.ContentType']"}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '50'})
+        },
+        'auth.user': {
+            'Meta': {'object_name': 'User'},
+            'date_joined': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'email': ('django.db.models.fields.EmailField', [], {'max_length': '75', 'blank': 'True'}),
+            'first_name': ('django.db.models.fields.CharField', [], {'max_length': '30', 'blank': 'True'}),
+            'groups': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['auth.Group']", 'symmetrical': 'False', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'is_active': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'is_staff': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'is_superuser': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'last_login': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'last_name': ('django.db.models.fields.CharField', [], {'max_length': '30', 'blank': 'True'}),
+            'password': ('django.db.models.fields.CharField', [], {'max_length': '128'}),
+            'user_permissions': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['auth.Permission']", 'symmetrical': 'False', 'blank': 'True'}),
+            'username': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '30'})
+        },
+        'contenttypes.contenttype': {
+            'Meta': {'ordering': "('name',)", 'unique_together': "(('app_label', 'model'),)", 'object_name': 'ContentType', 'db_table': "'django_content_type'"},
+            'app_label': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'model': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '100'})
+        },
+        'safe_geonode.calculation': {
+            'Meta': {'object_name': 'Calculation'},
+            'bbox': ('django.db.models.fields.CharField', [], {'max_length': '255', 'null': 'True', 'blank': 'True'}),
+            'errors': ('django.db.models.fields.TextField', [], {}),
+            'exposure_layer': ('django.db.models.fields.CharField', [], {'max_length': '255', 'null': 'True', 'blank': 'True'}),
+            'exposure_server': ('django.db.models.fields.URLField', [], {'max_length': '200', 'null': 'True', 'blank': 'True'}),
+            'hazard_layer': ('django.db.models.fields.CharField', [], {'max_length': '255', 'null': 'True', 'blank': 'True'}),
+            'hazard_server': ('django.db.models.fields.URLField', [], {'max_length': '200', 'null': 'True', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'impact_function': ('django.db.models.fields.CharField', [], {'max_length': '255', 'null': 'True', 'blank': 'True'}),
+            'impact_function_source': ('django.db.models.fields.TextField', [], {}),
+            'layer': ('django.db.models.fields.CharField', [], {'max_length': '255', 'null': 'True', 'blank': 'True'}),
+            'run_date': ('django.db.models.fields.DateTimeField', [], {}),
+            'run_duration': ('django.db.models.fields.FloatField', [], {}),
+            'stacktrace': ('django.db.models.fields.TextField', [], {'null': 'True', 'blank': 'True'}),
+            'success': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['auth.User']"})
+        },
+        'safe_geonode.layermetadata': {
+            'Meta': {'unique_together': "(('server_url', 'name'),)", 'object_name': 'LayerMetadata'},
+            'east': ('django.db.models.fields.FloatField', [], {'null': 'True', 'blank': 'True'}),
+            'formats': ('django.db.models.fields.TextField', [], {'default': "'[]'"}),
+            'geotransform': ('django.db.models.fields.CharField', [], {'max_length': '255', 'null': 'True', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'keywords': ('django.db.models.fields.TextField', [], {}),
+            'layertype': ('django.db.models.fields.CharField', [], {'max_length': '16'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '255'}),
+            'north': ('django.db.models.fields.FloatField', [], {'null': 'True', 'blank': 'True'}),
+            'server_url': ('django.db.models.fields.URLField', [], {'max_length': '200', 'db_index': 'True'}),
+            'south': ('django.db.models.fields.FloatField', [], {'null': 'True', 'blank': 'True'}),
+            'synced': ('django.db.models.fields.DateTimeField', [], {}),
+            'tile_url': ('django.db.models.fields.TextField', [], {}),
+            'title': ('django.db.models.fields.CharField', [], {'max_length': '255', 'null': 'True', 'blank': 'True'}),
+            'west': ('django.db.models.fields.FloatField', [], {'null': 'True', 'blank': 'True'})
+        },
+        'safe_geonode.server': {
+            'Meta': {'object_name': 'Server'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '255'}),
+            'url': ('django.db.models.fields.URLField', [], {'max_length': '200'})
+        },
+        'safe_geonode.workspace': {
+            'Meta': {'object_name': 'Workspace'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'servers': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['safe_geonode.Server']", 'symmetrical': 'False'}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['auth.User']"})
+        }
+    }
+
+    complete_apps = ['safe_geonode']
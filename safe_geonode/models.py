@@ -1,10 +1,19 @@
 from __future__ import division
 from django.db import models
+from django.core.signals import request_started, request_finished
 from django.contrib.auth.models import User
+from django.utils import simplejson as json
+from geonode.layers.models import Layer
 from pygments import highlight
 from pygments.lexers import PythonLexer
 from pygments.formatters import HtmlFormatter
+from safe_geonode.utilities import geotransform2resolution
+from safe_geonode.utilities import open_request_scratch_space
+from safe_geonode.utilities import close_request_scratch_space
 import datetime
+import logging
+
+logger = logging.getLogger(__name__)
 
 
 class Calculation(models.Model):
@@ -60,6 +69,82 @@ class Workspace(models.Model):
         return self.user.username
 
 
+class LayerMetadata(models.Model):
+    """Catalog entry with the metadata of one layer on an OWS server
+
+    Entries hold what get_metadata returns for the layer, so questions
+    and calculate can read it with one query instead of asking the server.
+    """
+
+    server_url = models.URLField(db_index=True)
+    name = models.CharField(max_length=255)
+    title = models.CharField(max_length=255, null=True, blank=True)
+    layertype = models.CharField(max_length=16)
+    west = models.FloatField(null=True, blank=True)
+    south = models.FloatField(null=True, blank=True)
+    east = models.FloatField(null=True, blank=True)
+    north = models.FloatField(null=True, blank=True)
+    geotransform = models.CharField(max_length=255, null=True, blank=True)
+    keywords = models.TextField()
+    formats = models.TextField(default='[]')
+    tile_url = models.TextField()
+    synced = models.DateTimeField()
+
+    class Meta:
+        unique_together = (('server_url', 'name'),)
+
+    def set_metadata(self, metadata):
+        """Copy fields from a metadata dictionary as returned by get_metadata
+        """
+
+        self.title = metadata['title']
+        self.layertype = metadata['layertype']
+        if metadata['bounding_box'] is None:
+            self.west = self.south = self.east = self.north = None
+        else:
+            self.west, self.south, self.east, self.north = \
+                metadata['bounding_box']
+        if metadata['geotransform'] is None:
+            self.geotransform = None
+        else:
+            self.geotransform = json.dumps(list(metadata['geotransform']))
+        self.keywords = json.dumps(metadata['keywords'])
+        self.formats = json.dumps(metadata.get('formats', []))
+        self.tile_url = metadata['tile_url']
+        self.synced = datetime.datetime.now()
+
+    def get_metadata(self):
+        """Get metadata dictionary of the same form as get_metadata
+        """
+
+        if self.west is None:
+            bounding_box = None
+        else:
+            bounding_box = (self.west, self.south, self.east, self.north)
+
+        if self.geotransform is None:
+            geotransform = None
+            resolution = None
+        else:
+            geotransform = tuple(json.loads(self.geotransform))
+            resolution = geotransform2resolution(geotransform,
+                                                 isotropic=False)
+
+        return {'id': self.name,
+                'title': self.title,
+                'layertype': self.layertype,
+                'bounding_box': bounding_box,
+                'geotransform': geotransform,
+                'resolution': resolution,
+                'keywords': json.loads(self.keywords),
+                'formats': json.loads(self.formats),
+                'server_url': self.server_url,
+                'tile_url': self.tile_url}
+
+    def __unicode__(self):
+        return '%s on %s' % (self.name, self.server_url)
+
+
 def duration(sender, **kwargs):
     instance = kwargs['instance']
     now = datetime.datetime.now()
@@ -68,3 +153,58 @@ def duration(sender, **kwargs):
     instance.run_duration = round(duration, 2)
 
 models.signals.pre_save.connect(duration, sender=Calculation)
+
+
+def layer_saved(sender, **kwargs):
+    """Expire catalog entry of a GeoNode layer when it is saved
+
+    Nothing is asked from GeoServer here, as layers are saved often and
+    GeoServer may not know about a new layer yet. The entry is fetched
+    again by get_metadata the next time it is needed.
+    """
+
+    from django.core.cache import cache
+    from safe_geonode.storage import INTERNAL_SERVER_URL
+    from safe_geonode.storage import invalidate_capabilities
+    from safe_geonode.storage import catalog_sync_key
+
+    instance = kwargs['instance']
+    invalidate_capabilities(INTERNAL_SERVER_URL)
+    LayerMetadata.objects.filter(server_url=INTERNAL_SERVER_URL,
+                                 name=instance.typename).delete()
+
+    # The catalog may not list the layer yet, so sync it again before
+    # listing all layers
+    cache.delete(catalog_sync_key(INTERNAL_SERVER_URL))
+
+
+def layer_deleted(sender, **kwargs):
+    """Remove catalog entry of a GeoNode layer when it is deleted
+    """
+
+    from safe_geonode.storage import INTERNAL_SERVER_URL
+    from safe_geonode.storage import invalidate_capabilities
+
+    instance = kwargs['instance']
+    invalidate_capabilities(INTERNAL_SERVER_URL)
+    LayerMetadata.objects.filter(server_url=INTERNAL_SERVER_URL,
+                                 name=instance.typename).delete()
+
+
+def server_deleted(sender, **kwargs):
+    """Remove catalog entries of a remote server when it is deleted
+    """
+
+    from safe_geonode.storage import bump_catalog_revision
+
+    instance = kwargs['instance']
+    LayerMetadata.objects.filter(server_url=instance.url).delete()
+    bump_catalog_revision()
+
+models.signals.post_save.connect(layer_saved, sender=Layer)
+models.signals.post_delete.connect(layer_deleted, sender=Layer)
+models.signals.post_delete.connect(server_deleted, sender=Server)
+
+# Temporary files made while serving a request are removed when it ends
+request_started.connect(open_request_scratch_space)
+request_finished.connect(close_request_scratch_space)
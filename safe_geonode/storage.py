@@ -7,17 +7,26 @@
 import os
 import sys
 import time
+import datetime
 import numpy
-import urllib2
+import hashlib
+import urllib
+import zlib
+import shutil
+import threading
 import tempfile
-import contextlib
 import logging
 
 from zipfile import ZipFile
+from osgeo import ogr
+from functools import partial
+from xml.etree.cElementTree import iterparse
 
 from safe_geonode.utilities import LAYER_TYPES
 from safe_geonode.utilities import WCS_TEMPLATE
 from safe_geonode.utilities import WFS_TEMPLATE
+from safe_geonode.utilities import CAPABILITIES_TEMPLATE
+from safe_geonode.utilities import DESCRIBE_COVERAGE_TEMPLATE
 from safe_geonode.utilities import extract_WGS84_geotransform
 from safe_geonode.utilities import is_sequence
 from safe_geonode.utilities import unique_filename
@@ -25,24 +34,163 @@ from safe_geonode.utilities import write_keywords
 from safe_geonode.utilities import geotransform2resolution
 from safe_geonode.utilities import get_bounding_box
 from safe_geonode.utilities import bboxlist2string
+from safe_geonode.utilities import bboxstring2list
+from safe_geonode.utilities import BoundingBoxIndex
+from safe_geonode.utilities import crop_raster, is_on_pixel_grid
+from safe_geonode.utilities import is_on_geotransform_grid
+from safe_geonode.utilities import layer_file_exists
+from safe_geonode.utilities import split_bounding_box, mosaic_rasters
 from safe_geonode.utilities import check_bbox_string
+from safe_geonode.utilities import run_in_parallel, CancelledError
+from safe_geonode.utilities import http_get, is_server_reachable
+from safe_geonode.utilities import make_scratch_dir
+from safe_geonode.utilities import warp_raster, clip_vector, write_features
+from safe_geonode.utilities import get_overview_levels, build_overviews
+from safe_geonode.utilities import is_optimized_geotiff
+from safe_geonode.utilities import write_optimized_geotiff
+from safe_geonode.utilities import memory_map_raster, write_band_array
+from safe_geonode.utilities import index_shapefile
+from safe_geonode.models import LayerMetadata
 
 # Do we really need to import these objects? should they be part of the API?
+from safe.storage.utilities import read_keywords
 from safe.storage.vector import Vector
 from safe.storage.raster import Raster
 from safe.api import read_layer
 
-from owslib.wcs import WebCoverageService
-from owslib.wfs import WebFeatureService
-
 from geonode.layers.utils import file_upload, GeoNodeException
 from geonode.layers.models import Layer
 from django.conf import settings
+from django.core.cache import cache
+from django.utils import simplejson as json
+from django.db import transaction, IntegrityError
+from django.core.exceptions import ObjectDoesNotExist
 
 logger = logging.getLogger(__name__)
 
 INTERNAL_SERVER_URL = os.path.join(settings.GEOSERVER_BASE_URL, 'ows')
 
+# Number of seconds parsed capabilities are used before they are
+# revalidated against the server. Parsing capabilities dominates the
+# latency of get_metadata on servers with many layers.
+CAPABILITIES_CACHE_TIMEOUT = getattr(settings,
+                                     'SAFE_CAPABILITIES_CACHE_TIMEOUT', 300)
+
+# Stale capabilities are kept around for this long so they can be
+# revalidated with a conditional request instead of downloaded again.
+CAPABILITIES_CACHE_LIFETIME = 24 * 3600
+
+# Socket timeout in seconds for capabilities requests
+OWS_TIMEOUT = getattr(settings, 'SAFE_OWS_TIMEOUT', 60)
+
+# Directory and maximal size in bytes of the cache of downloaded layers.
+# Set SAFE_LAYER_CACHE_SIZE to 0 to disable the cache.
+LAYER_CACHE_DIR = getattr(settings, 'SAFE_LAYER_CACHE_DIR',
+                          os.path.join(tempfile.gettempdir(),
+                                       'safe-layer-cache'))
+LAYER_CACHE_SIZE = getattr(settings, 'SAFE_LAYER_CACHE_SIZE', 2 * 1024 ** 3)
+
+# Seconds downloaded layers are reused. Remote servers do not tell us when
+# their data changes, so entries are only trusted for a limited time.
+LAYER_CACHE_MAX_AGE = getattr(settings, 'SAFE_LAYER_CACHE_MAX_AGE', 24 * 3600)
+
+# Extensions of layer files in the layer cache
+LAYER_CACHE_TYPES = ['.tif', '.shp', '.zip', '.gml']
+
+# Number of cached extents remembered per raster layer and resolution
+MAX_CACHED_RASTER_EXTENTS = 100
+
+# Seconds hit and miss counters of the layer cache are kept
+LAYER_CACHE_STATS_LIFETIME = 30 * 24 * 3600
+
+# Maximal number of pixels in each direction requested from WCS at a time.
+# Larger rasters are downloaded as tiles by up to SAFE_WCS_TILE_WORKERS
+# concurrent requests.
+WCS_TILE_SIZE = getattr(settings, 'SAFE_WCS_TILE_SIZE', 2048)
+WCS_TILE_WORKERS = getattr(settings, 'SAFE_WCS_TILE_WORKERS', 4)
+
+# WFS output formats for vector downloads in order of preference. Formats
+# not offered by a server are skipped and the last one is always used as
+# fallback. WFS_FORMAT_FILES maps formats to file suffix and whether the
+# content is gzip compressed. GML is smaller on the wire but OGR reads
+# its attributes as untyped strings, so it must be asked for explicitly,
+# e.g. SAFE_WFS_FORMATS = ['GML2-GZIP', 'SHAPE-ZIP'].
+WFS_FORMATS = getattr(settings, 'SAFE_WFS_FORMATS', ['SHAPE-ZIP'])
+WFS_FORMAT_FILES = {'GML2-GZIP': ('.gml', True),
+                    'GML2': ('.gml', False),
+                    'SHAPE-ZIP': ('.zip', False)}
+
+# Download vector layers in pages of SAFE_WFS_PAGE_SIZE features which
+# are written to a local shapefile one at a time. Needs WFS servers that
+# understand startIndex and sortBy, such as GeoServer. Pages are only
+# stable if features are sorted, so layers are paged by the attribute
+# SAFE_WFS_PAGE_SORT_BY (e.g. a primary key) and requested in one go if
+# it is None.
+WFS_PAGING = getattr(settings, 'SAFE_WFS_PAGING', False)
+WFS_PAGE_SIZE = getattr(settings, 'SAFE_WFS_PAGE_SIZE', 10000)
+WFS_PAGE_SORT_BY = getattr(settings, 'SAFE_WFS_PAGE_SORT_BY', None)
+WFS_PAGE_TEMPLATE = '&maxFeatures=%i&startIndex=%i&sortBy=%s'
+
+# Clip layers of the internal GeoServer from their uploaded files instead
+# of downloading them through WCS and WFS
+USE_LOCAL_FILES = getattr(settings, 'SAFE_USE_LOCAL_FILES', True)
+
+# Extensions of uploaded files layers are clipped from
+LOCAL_FILE_TYPES = {'raster': ['.tif', '.tiff'],
+                    'vector': ['.shp']}
+
+# Decimation factors of the overviews built for uploaded rasters, the
+# GDAL resampling method used to build them and the minimal number of
+# pixels along the shorter side of an overview
+OVERVIEW_LEVELS = getattr(settings, 'SAFE_OVERVIEW_LEVELS',
+                          [2, 4, 8, 16, 32, 64])
+OVERVIEW_RESAMPLING = getattr(settings, 'SAFE_OVERVIEW_RESAMPLING', 'NEAREST')
+OVERVIEW_MIN_SIZE = getattr(settings, 'SAFE_OVERVIEW_MIN_SIZE', 256)
+
+# Rewrite uploaded rasters as cloud optimized GeoTIFFs with the given
+# GTiff creation options
+NORMALIZE_RASTERS = getattr(settings, 'SAFE_NORMALIZE_RASTERS', True)
+RASTER_CREATION_OPTIONS = getattr(settings, 'SAFE_RASTER_CREATION_OPTIONS',
+                                  ['TILED=YES',
+                                   'BLOCKXSIZE=256',
+                                   'BLOCKYSIZE=256',
+                                   'COMPRESS=DEFLATE'])
+
+# Give uploaded shapefiles a spatial index and indexes of the attributes
+# named in SAFE_VECTOR_INDEX_FIELDS if they have them
+INDEX_VECTORS = getattr(settings, 'SAFE_INDEX_VECTORS', True)
+VECTOR_INDEX_FIELDS = getattr(settings, 'SAFE_VECTOR_INDEX_FIELDS',
+                              ['type', 'name', 'osm_id'])
+
+# Keep the band of cached rasters uncompressed in a .npy file and read
+# downloaded rasters from it through a memory map, see memory_map_raster
+MEMORY_MAP_RASTERS = getattr(settings, 'SAFE_MEMORY_MAP_RASTERS', True)
+
+# Number of bytes held in memory at a time when downloading layers
+DOWNLOAD_BUFFER_SIZE = getattr(settings, 'SAFE_DOWNLOAD_BUFFER_SIZE',
+                               1024 * 1024)
+
+# Content types used by OGC services to report errors
+SERVICE_EXCEPTION_TYPES = ['application/vnd.ogc.se_xml',
+                           'application/vnd.ogc.se+xml']
+
+# Read layer metadata from the LayerMetadata catalog where possible
+USE_LAYER_CATALOG = getattr(settings, 'SAFE_USE_LAYER_CATALOG', True)
+
+# Number of seconds before catalog entries are synced with their server
+CATALOG_SYNC_INTERVAL = getattr(settings, 'SAFE_CATALOG_SYNC_INTERVAL', 3600)
+
+# Cache key of the counter bumped whenever the layer catalog changes
+CATALOG_REVISION_KEY = 'safe-catalog-revision'
+
+# Number of coverages described by each DescribeCoverage request
+DESCRIBE_COVERAGE_BATCH_SIZE = 50
+
+# XML namespaces used in OWS 1.0.0 documents
+WCS_NS = '{http://www.opengis.net/wcs}'
+WFS_NS = '{http://www.opengis.net/wfs}'
+GML_NS = '{http://www.opengis.net/gml}'
+
 def write_raster_data(data, projection, geotransform, filename, keywords=None):
     """Write array to raster file with specified metadata and one data layer
 
@@ -136,6 +284,7 @@ def get_metadata_from_layer(layer):
 
     # Metadata common to both raster and vector data
     metadata['bounding_box'] = layer.boundingBoxWGS84
+    metadata['formats'] = list(getattr(layer, 'formats', None) or [])
     metadata['title'] = layer.title  # This maybe overwritten by keyword
     metadata['id'] = layer.id
 
@@ -174,91 +323,718 @@ def get_metadata_from_layer(layer):
     return metadata
 
 
-def get_metadata(server_url, layer_name=None):
-    """Uses OWSLib to get the metadata for a given layer
+def get_metadata(server_url, layer_name=None, revisions=None):
+    """Get the metadata for a given layer
 
     Input
         server_url: e.g. http://localhost:8001/geoserver-geonode-dev/ows
         layer_name: Name of layer - must follow the convention workspace:name
                     If None metadata for all layers will be returned as a
                     dictionary with one entry per layer
+        revisions: Optional list. Catalog revisions produced by storing
+                   fetched metadata in the catalog are appended to it.
 
     Output
         metadata: Dictionary of metadata fields for specified layer or,
                   if layer_name is None, a dictionary of metadata dictionaries
+
+    If SAFE_USE_LAYER_CATALOG is True (default), metadata is read from the
+    LayerMetadata catalog. Entries missing from the catalog or older than
+    SAFE_CATALOG_SYNC_INTERVAL seconds are fetched from the server and
+    stored in the catalog.
     """
 
-    # Get all metadata from server
-    wcs = WebCoverageService(server_url, version='1.0.0')
-    wfs = WebFeatureService(server_url, version='1.0.0')
+    if not USE_LAYER_CATALOG:
+        return get_ows_metadata(server_url, layer_name)
+
+    metadata = get_catalog_metadata(server_url, layer_name)
+    if metadata is not None:
+        return metadata
 
-    # Take care of input options
     if layer_name is None:
-        layer_names = wcs.contents.keys() + wfs.contents.keys()
+        return sync_layer_catalog(server_url, revisions=revisions)
     else:
-        layer_names = [layer_name]
+        metadata = get_ows_metadata(server_url, layer_name)
+        revision = save_catalog_metadata(server_url, {layer_name: metadata})
+        if revision is not None and revisions is not None:
+            revisions.append(revision)
+        return metadata
+
+
+def get_ows_metadata(server_url, layer_name=None, refresh=False):
+    """Get the metadata for a given layer from OWS capabilities
+
+    Input
+        server_url: e.g. http://localhost:8001/geoserver-geonode-dev/ows
+        layer_name: Name of layer - must follow the convention workspace:name
+                    If None metadata for all layers will be returned as a
+                    dictionary with one entry per layer
+        refresh: If True, capabilities of all layers are revalidated with
+                 the server even if the cached ones are still fresh
+
+    Output
+        metadata: Dictionary of metadata fields for specified layer or,
+                  if layer_name is None, a dictionary of metadata dictionaries
+    """
+
+    # Return metadata for all layers, fetching WCS and WFS concurrently
+    if layer_name is None:
+        metadata = {}
+        results = run_in_parallel(partial(get_capabilities_metadata,
+                                          server_url, refresh=refresh),
+                                  ['wcs', 'wfs'])
+        for service_metadata, error in results:
+            if error is not None:
+                raise error.exc_info[0], error.exc_info[1], error.exc_info[2]
+            metadata.update(service_metadata)
+        return metadata
+
+    # Use capabilities if they are already cached
+    for service in ['wcs', 'wfs']:
+        metadata = get_cached_capabilities_metadata(server_url, service)
+        if metadata is not None and layer_name in metadata:
+            return metadata[layer_name]
+
+    # Otherwise ask the server about this layer only
+    try:
+        return get_layer_metadata(server_url, layer_name)
+    except Exception, e:
+        logger.debug('Could not get metadata for layer %s directly from %s, '
+                     'falling back to full capabilities. Error message was: '
+                     '%s' % (layer_name, server_url, e))
+
+    # Scan full capabilities. The layer may have been added after
+    # capabilities were cached, so refresh them if it is not found.
+    for refresh in [False, True]:
+        wcs_metadata = get_capabilities_metadata(server_url, 'wcs',
+                                                 refresh=refresh)
+        wfs_metadata = get_capabilities_metadata(server_url, 'wfs',
+                                                 refresh=refresh)
+
+        if layer_name in wcs_metadata:
+            return wcs_metadata[layer_name]
+        elif layer_name in wfs_metadata:
+            return wfs_metadata[layer_name]
+
+    msg = ('Layer %s was not found in WxS contents on server %s.\n'
+           'WCS contents: %s\n'
+           'WFS contents: %s\n' % (layer_name, server_url,
+                                   wcs_metadata.keys(),
+                                   wfs_metadata.keys()))
+    raise Exception(msg)
+
+
+def catalog_sync_key(server_url):
+    """Get cache key recording when the catalog of a server was synced
+    """
+
+    return 'safe-catalog-synced-%s' % hashlib.md5(server_url).hexdigest()
+
+
+def get_catalog_metadata(server_url, layer_name=None):
+    """Get the metadata for a given layer from the LayerMetadata catalog
+
+    Input
+        server_url: e.g. http://localhost:8001/geoserver-geonode-dev/ows
+        layer_name: Name of layer or None for all layers of the server
+
+    Output
+        metadata: Same as get_metadata or None if the catalog does not
+                  have up to date metadata for the layer(s).
+    """
+
+    if layer_name is None:
+        # Only a synced catalog is known to list all layers of a server
+        if cache.get(catalog_sync_key(server_url)) is None:
+            return None
+
+        entries = LayerMetadata.objects.filter(server_url=server_url)
+        return dict([(entry.name, entry.get_metadata())
+                     for entry in entries])
+
+    oldest = (datetime.datetime.now() -
+              datetime.timedelta(seconds=CATALOG_SYNC_INTERVAL))
+    try:
+        entry = LayerMetadata.objects.get(server_url=server_url,
+                                          name=layer_name,
+                                          synced__gte=oldest)
+    except LayerMetadata.DoesNotExist:
+        return None
+
+    return entry.get_metadata()
+
+
+def save_catalog_metadata(server_url, metadata, replace=False):
+    """Store layer metadata in the LayerMetadata catalog
+
+    Input
+        server_url: e.g. http://localhost:8001/geoserver-geonode-dev/ows
+        metadata: Dictionary of metadata dictionaries, one entry per layer
+        replace: If True, all other catalog entries of the server are
+                 removed. Otherwise only the given layers are updated.
+
+    Output
+        revision: Catalog revision produced by the change or None if
+                  no metadata changed
+
+    The catalog revision is only bumped if entries were replaced or the
+    metadata of a layer changed. Entries whose metadata is the same are
+    just marked as synced, so cached answers remain valid.
+    """
+
+    changed = replace
+    try:
+        with transaction.commit_on_success():
+            entries = LayerMetadata.objects.filter(server_url=server_url)
+            if replace:
+                entries.delete()
+                new_entries = []
+                for name, layer_metadata in metadata.items():
+                    entry = LayerMetadata(server_url=server_url, name=name)
+                    entry.set_metadata(layer_metadata)
+                    new_entries.append(entry)
+                LayerMetadata.objects.bulk_create(new_entries)
+            else:
+                for name, layer_metadata in metadata.items():
+                    try:
+                        entry = entries.get(name=name)
+                    except LayerMetadata.DoesNotExist:
+                        entry = LayerMetadata(server_url=server_url,
+                                              name=name)
+                        changed = True
+                    else:
+                        if entry.get_metadata() != layer_metadata:
+                            changed = True
+                    entry.set_metadata(layer_metadata)
+                    entry.save()
+    except IntegrityError, e:
+        # Another process stored the same layers at the same time
+        logger.debug('Could not store catalog entries for %s: %s'
+                     % (server_url, e))
+
+    if changed:
+        return bump_catalog_revision()
+    return None
+
+
+def sync_layer_catalog(server_url, refresh=False, revisions=None):
+    """Replace the catalog entries of a server with its current layers
+
+    Input
+        server_url: e.g. http://localhost:8001/geoserver-geonode-dev/ows
+        refresh: If True, capabilities are revalidated with the server
+                 even if the cached ones are still fresh
+        revisions: Optional list. The catalog revision produced by the
+                   sync, if any, is appended to it.
+
+    Output
+        metadata: Dictionary of metadata dictionaries, one entry per layer
+    """
+
+    metadata = get_ows_metadata(server_url, refresh=refresh)
+
+    entries = LayerMetadata.objects.filter(server_url=server_url)
+    current = dict([(entry.name, entry.get_metadata()) for entry in entries])
+    if current == metadata:
+        # Keep the catalog revision so cached answers remain valid
+        entries.update(synced=datetime.datetime.now())
+    else:
+        revision = save_catalog_metadata(server_url, metadata, replace=True)
+        if revision is not None and revisions is not None:
+            revisions.append(revision)
+    cache.set(catalog_sync_key(server_url), time.time(),
+              CATALOG_SYNC_INTERVAL)
+
+    return metadata
+
+
+def get_catalog_revision():
+    """Get counter that changes whenever layers are added, changed or removed
+    """
+
+    revision = cache.get(CATALOG_REVISION_KEY)
+    if revision is None:
+        # Start from the clock so an evicted counter never goes back
+        # to a value that has been handed out before
+        cache.add(CATALOG_REVISION_KEY, int(time.time() * 1000),
+                  CAPABILITIES_CACHE_LIFETIME)
+        revision = cache.get(CATALOG_REVISION_KEY)
+
+    return revision
+
+
+def bump_catalog_revision():
+    """Record that layers have been added, changed or removed
+    """
+
+    get_catalog_revision()
+    try:
+        return cache.incr(CATALOG_REVISION_KEY)
+    except ValueError:
+        # Counter was evicted in the meantime
+        return get_catalog_revision()
+
+
+def get_layer_service_url(server_url, layer_name):
+    """Get url of the GeoServer virtual service for a single layer
+
+    Input
+        server_url: e.g. http://localhost:8001/geoserver-geonode-dev/ows
+        layer_name: Name of layer of the form workspace:name
+
+    Output
+        url: e.g. http://localhost:8001/geoserver-geonode-dev/geonode/name/ows
+
+    Capabilities requested from this url only describe the given layer.
+    """
+
+    workspace, name = layer_name.split(':')
 
     #FIXME(Ariel): This is a weak way of finding the geoserver_url
     geoserver_url = server_url[:-4]
 
-    # Get metadata for requested layer(s)
-    metadata = {}
-    for name in layer_names:
-        if name in wcs.contents:
-            layer = wcs.contents[name]
-            layer.datatype = 'raster'  # Monkey patch layer type
-        elif name in wfs.contents:
-            layer = wfs.contents[name]
-            layer.datatype = 'vector'  # Monkey patch layer type
-        else:
-            msg = ('Layer %s was not found in WxS contents on server %s.\n'
-                   'WCS contents: %s\n'
-                   'WFS contents: %s\n' % (name, server_url,
-                                           wcs.contents, wfs.contents))
-            raise Exception(msg)
+    return '%s/%s/%s/ows' % (geoserver_url, workspace, name)
 
-        layer_metadata = get_metadata_from_layer(layer)
 
-        tile_url =  "%s/gwc/service/gmaps?layers=%s&zoom={z}&x={x}&y={y}&format=image/png" % (geoserver_url, name)
-        layer_metadata['server_url'] = server_url
-        layer_metadata['tile_url'] = tile_url
+def get_layer_metadata(server_url, layer_name):
+    """Get metadata for one layer without requesting full capabilities
 
-        metadata[name] = layer_metadata
+    Input
+        server_url: e.g. http://localhost:8001/geoserver-geonode-dev/ows
+        layer_name: Name of layer - must follow the convention workspace:name
 
-    # Return metadata for one or all layers
-    if layer_name is not None:
-        return metadata[layer_name]
-    else:
+    Output
+        metadata: Dictionary of metadata fields as returned by
+                  get_metadata_from_layer
+
+    Capabilities are requested from the GeoServer virtual service of the
+    layer, which lists nothing but that layer. The result is cached
+    until the capabilities of the server are invalidated.
+    """
+
+    key = layer_metadata_cache_key(server_url, layer_name)
+    metadata = cache.get(key)
+    if metadata is not None:
         return metadata
 
+    layer_url = get_layer_service_url(server_url, layer_name)
+    _, name = layer_name.split(':')
+
+    errors = []
+    for service in ['wcs', 'wfs']:
+        url = CAPABILITIES_TEMPLATE % (layer_url, service)
+        record = None
+        try:
+            with http_get(url, timeout=OWS_TIMEOUT) as response:
+                response.raise_for_status()
+                for candidate in iter_capabilities(layer_url, service,
+                                                   response.raw):
+                    # Virtual services may list the layer without its
+                    # workspace
+                    if candidate.id in [layer_name, name]:
+                        record = candidate
+                        break
+        except Exception, e:
+            # One service failing, e.g. WCS for a vector layer, must not
+            # keep the other one from being asked
+            logger.debug('Could not get %s capabilities of layer %s from '
+                         '%s: %s' % (service, layer_name, layer_url, e))
+            errors.append('%s: %s' % (service.upper(), e))
+            continue
+
+        if record is None:
+            continue
+
+        metadata = get_metadata_from_layer(record)
+        metadata['id'] = layer_name
+        metadata['server_url'] = server_url
+        metadata['tile_url'] = get_tile_url(server_url, layer_name)
+
+        cache.set(key, metadata, CAPABILITIES_CACHE_TIMEOUT)
+        return metadata
+
+    msg = ('Layer %s was not found in WxS contents of %s'
+           % (layer_name, layer_url))
+    if errors:
+        msg += '. Errors were: %s' % '; '.join(errors)
+    raise Exception(msg)
+
+
+def get_tile_url(server_url, layer_name):
+    """Get url template for GeoWebCache tiles of a given layer
+    """
+
+    #FIXME(Ariel): This is a weak way of finding the geoserver_url
+    geoserver_url = server_url[:-4]
+
+    return ('%s/gwc/service/gmaps?layers=%s&zoom={z}&x={x}&y={y}'
+            '&format=image/png' % (geoserver_url, layer_name))
 
-def get_file(download_url, suffix):
+
+def capabilities_cache_key(server_url, service):
+    """Get cache key for the capabilities of one OWS service on a server
+    """
+
+    return 'safe-capabilities-%s-%s' % (service,
+                                        hashlib.md5(server_url).hexdigest())
+
+
+def generation_key(server_url):
+    """Get cache key of the generation of a server's capabilities
+
+    The generation changes whenever invalidate_capabilities is called.
+    """
+
+    return 'safe-generation-%s' % hashlib.md5(server_url).hexdigest()
+
+
+def layer_metadata_cache_key(server_url, layer_name):
+    """Get cache key for the metadata of a single layer
+
+    The key includes the generation of the server's capabilities so that
+    invalidate_capabilities also invalidates all single layer entries.
+    """
+
+    generation = cache.get(generation_key(server_url), 0)
+
+    return 'safe-layer-%s-%s' % (generation,
+                                 hashlib.md5(server_url + layer_name).hexdigest())
+
+
+class LayerRecord(object):
+    """Compact metadata record for one layer of an OWS service
+
+    Records have the attributes of OWSLib layer objects that are used by
+    get_metadata_from_layer, but hold nothing else.
+    """
+
+    __slots__ = ['id', 'title', 'keywords', 'boundingBoxWGS84', 'grid',
+                 'datatype', 'formats']
+
+    def __init__(self, **kwargs):
+        for name in self.__slots__:
+            setattr(self, name, kwargs.get(name))
+
+
+class GridRecord(object):
+    """Grid limits of a raster layer as found in DescribeCoverage
+    """
+
+    __slots__ = ['lowlimits', 'highlimits']
+
+    def __init__(self, lowlimits, highlimits):
+        self.lowlimits = lowlimits
+        self.highlimits = highlimits
+
+
+def iterparse_elements(source, tag):
+    """Yield all elements with a given tag from an XML document
+
+    Input
+        source: Filename or file like object, e.g. an HTTP response
+        tag: Fully qualified tag, e.g. '{http://www.opengis.net/wfs}Name'
+             or a list of such tags
+
+    Elements are yielded as soon as they have been parsed and are removed
+    from the document afterwards, so memory use does not grow with the size
+    of the document. Use the element before asking for the next one.
+    """
+
+    if isinstance(tag, basestring):
+        tags = [tag]
+    else:
+        tags = tag
+
+    parents = []
+    for event, elem in iterparse(source, events=('start', 'end')):
+        if event == 'start':
+            parents.append(elem)
+            continue
+
+        parents.pop()
+        if elem.tag in tags:
+            yield elem
+
+            # Free the element and everything below it
+            elem.clear()
+            if len(parents) > 0:
+                parents[-1].remove(elem)
+
+
+def coverage_record(elem):
+    """Get layer record from a WCS 1.0.0 CoverageOffering element
+    """
+
+    lower, upper = [pos.text.split() for pos in
+                    elem.findall(WCS_NS + 'lonLatEnvelope/' + GML_NS + 'pos')]
+    bbox = (float(lower[0]), float(lower[1]),
+            float(upper[0]), float(upper[1]))
+
+    grid = None
+    for grid_tag in ['RectifiedGrid', 'Grid']:
+        limits = elem.find(WCS_NS + 'domainSet/' +
+                           WCS_NS + 'spatialDomain/' +
+                           GML_NS + grid_tag + '/' +
+                           GML_NS + 'limits/' +
+                           GML_NS + 'GridEnvelope')
+        if limits is not None:
+            grid = GridRecord(limits.findtext(GML_NS + 'low').split(),
+                              limits.findtext(GML_NS + 'high').split())
+            break
+
+    keywords = [keyword.text for keyword in
+                elem.findall(WCS_NS + 'keywords/' + WCS_NS + 'keyword')]
+
+    return LayerRecord(id=elem.findtext(WCS_NS + 'name'),
+                       title=elem.findtext(WCS_NS + 'label'),
+                       keywords=keywords,
+                       boundingBoxWGS84=bbox,
+                       grid=grid,
+                       datatype='raster')
+
+
+def feature_type_record(elem):
+    """Get layer record from a WFS 1.0.0 FeatureType element
+    """
+
+    bbox = None
+    b = elem.find(WFS_NS + 'LatLongBoundingBox')
+    if b is not None:
+        bbox = (float(b.attrib['minx']), float(b.attrib['miny']),
+                float(b.attrib['maxx']), float(b.attrib['maxy']))
+
+    keywords = [keyword.text for keyword in elem.findall(WFS_NS + 'Keywords')]
+
+    return LayerRecord(id=elem.findtext(WFS_NS + 'Name'),
+                       title=elem.findtext(WFS_NS + 'Title'),
+                       keywords=keywords,
+                       boundingBoxWGS84=bbox,
+                       datatype='vector')
+
+
+def iter_capabilities(server_url, service, source):
+    """Yield layer records from a capabilities document as it is parsed
+
+    Input
+        server_url: e.g. http://localhost:8001/geoserver-geonode-dev/ows
+        service: Either 'wcs' or 'wfs'
+        source: File like object with the capabilities document
+
+    Output
+        Generator of LayerRecord objects, one per layer
+
+    WCS capabilities do not describe the grid of coverages, so coverages
+    are described in batches of DESCRIBE_COVERAGE_BATCH_SIZE using
+    DescribeCoverage once their names have been read.
+    """
+
+    if service == 'wfs':
+        # Output formats of GetFeature are listed before the feature types
+        formats = None
+        for elem in iterparse_elements(source, [WFS_NS + 'ResultFormat',
+                                                WFS_NS + 'FeatureType']):
+            if elem.tag == WFS_NS + 'FeatureType':
+                record = feature_type_record(elem)
+                record.formats = formats
+                yield record
+            elif formats is None:
+                formats = [child.tag.split('}')[-1] for child in elem]
+        return
+
+    names = [elem.findtext(WCS_NS + 'name') for elem in
+             iterparse_elements(source, WCS_NS + 'CoverageOfferingBrief')]
+
+    for i in range(0, len(names), DESCRIBE_COVERAGE_BATCH_SIZE):
+        coverages = ','.join(names[i:i + DESCRIBE_COVERAGE_BATCH_SIZE])
+        url = DESCRIBE_COVERAGE_TEMPLATE % (server_url,
+                                            urllib.quote(coverages, safe=',:'))
+        with http_get(url, timeout=OWS_TIMEOUT) as response:
+            response.raise_for_status()
+            for elem in iterparse_elements(response.raw,
+                                           WCS_NS + 'CoverageOffering'):
+                yield coverage_record(elem)
+
+
+def parse_capabilities(server_url, service, source):
+    """Get metadata for all layers in a capabilities document
+
+    Input
+        server_url: e.g. http://localhost:8001/geoserver-geonode-dev/ows
+        service: Either 'wcs' or 'wfs'
+        source: File like object with the capabilities document
+
+    Output
+        metadata: Dictionary of metadata dictionaries, one entry per layer
+    """
+
+    metadata = {}
+    for record in iter_capabilities(server_url, service, source):
+        layer_metadata = get_metadata_from_layer(record)
+        layer_metadata['server_url'] = server_url
+        layer_metadata['tile_url'] = get_tile_url(server_url, record.id)
+
+        metadata[record.id] = layer_metadata
+
+    return metadata
+
+
+def get_capabilities_metadata(server_url, service, refresh=False):
+    """Get metadata for all layers of one OWS service with caching
+
+    Input
+        server_url: e.g. http://localhost:8001/geoserver-geonode-dev/ows
+        service: Either 'wcs' or 'wfs'
+        refresh: If True, cached capabilities are revalidated against the
+                 server irrespective of their age.
+
+    Output
+        metadata: Dictionary of metadata dictionaries, one entry per layer
+
+    Parsed capabilities are kept in the Django cache, so they are shared
+    between worker processes if a shared cache backend is configured.
+    Once they are older than SAFE_CAPABILITIES_CACHE_TIMEOUT seconds they
+    are revalidated with a conditional request using the ETag and
+    Last-Modified headers of the original response.
+    """
+
+    key = capabilities_cache_key(server_url, service)
+    entry = cache.get(key)
+    now = time.time()
+
+    if (entry is not None and not refresh and
+        now - entry['checked'] < CAPABILITIES_CACHE_TIMEOUT):
+        return entry['metadata']
+
+    headers = {}
+    if entry is not None:
+        if entry['etag'] is not None:
+            headers['If-None-Match'] = entry['etag']
+        if entry['last_modified'] is not None:
+            headers['If-Modified-Since'] = entry['last_modified']
+
+    url = CAPABILITIES_TEMPLATE % (server_url, service)
+    with http_get(url, headers=headers, timeout=OWS_TIMEOUT) as response:
+        if response.status_code == 304 and entry is not None:
+            # Capabilities have not changed, keep using the parsed ones
+            entry['checked'] = now
+            cache.set(key, entry, CAPABILITIES_CACHE_LIFETIME)
+            return entry['metadata']
+        response.raise_for_status()
+
+        # Parse capabilities while they are being downloaded
+        metadata = parse_capabilities(server_url, service, response.raw)
+        entry = {'etag': response.headers.get('ETag'),
+                 'last_modified': response.headers.get('Last-Modified'),
+                 'checked': now,
+                 'metadata': metadata}
+    cache.set(key, entry, CAPABILITIES_CACHE_LIFETIME)
+
+    return entry['metadata']
+
+
+def get_cached_capabilities_metadata(server_url, service):
+    """Get metadata for all layers of one OWS service if cached and fresh
+
+    Output
+        metadata: Dictionary of metadata dictionaries or None if the
+                  capabilities are not cached or need revalidation.
+    """
+
+    entry = cache.get(capabilities_cache_key(server_url, service))
+    if (entry is None or
+        time.time() - entry['checked'] >= CAPABILITIES_CACHE_TIMEOUT):
+        return None
+
+    return entry['metadata']
+
+
+def invalidate_capabilities(server_url):
+    """Remove cached capabilities for a server
+
+    This must be called when layers are added, changed or removed
+    so that get_metadata does not return outdated information.
+    """
+
+    cache.delete_many([capabilities_cache_key(server_url, service)
+                       for service in ['wcs', 'wfs']])
+
+    # Orphan the metadata cached for single layers and downloaded layers
+    cache.set(generation_key(server_url), time.time(),
+              CAPABILITIES_CACHE_LIFETIME)
+    bump_catalog_revision()
+
+
+def get_file(download_url, suffix, cancel=None, gunzip=False):
     """Download a file from an HTTP server.
+
+    The file is streamed to disk SAFE_DOWNLOAD_BUFFER_SIZE bytes at a time
+    so memory use does not depend on the size of the file. If the optional
+    threading.Event cancel is set, the download stops with a CancelledError.
+    If gunzip is True, gzip compressed content is decompressed on the fly.
     """
 
-    tempdir = '/tmp/%s' % str(time.time())
-    os.mkdir(tempdir)
+    tempdir = make_scratch_dir()
     t = tempfile.NamedTemporaryFile(delete=False,
                                     suffix=suffix,
                                     dir=tempdir)
+    filename = os.path.abspath(t.name)
 
-    with contextlib.closing(urllib2.urlopen(download_url)) as f:
-        data = f.read()
+    try:
+        with http_get(download_url, timeout=OWS_TIMEOUT) as response:
+            response.raise_for_status()
+            content_type = response.headers.get('Content-Type', '')
+            content_type = content_type.split(';')[0].strip().lower()
+
+            # Content-Length counts compressed bytes if the body is encoded
+            content_length = None
+            if 'Content-Encoding' not in response.headers:
+                content_length = response.headers.get('Content-Length')
+
+            data = response.raw.read(DOWNLOAD_BUFFER_SIZE)
+
+            # OGC service exceptions are announced by their content type
+            # or are small XML documents where data was expected
+            if (content_type in SERVICE_EXCEPTION_TYPES or
+                (data.lstrip().startswith('<') and
+                 'ServiceException' in data)):
+                msg = ('File download failed.\n'
+                       'URL: %s\n'
+                       'Error message: %s' % (download_url, data))
+                raise Exception(msg)
 
-    if '<ServiceException>' in data:
-        msg = ('File download failed.\n'
-               'URL: %s\n'
-               'Error message: %s' % (download_url, data))
-        raise Exception(msg)
+            if gunzip:
+                decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+            size = 0
+            with t:
+                while data:
+                    if cancel is not None and cancel.is_set():
+                        msg = 'Download of %s was cancelled' % download_url
+                        raise CancelledError(msg)
+                    size += len(data)
+                    if gunzip:
+                        data = decompressor.decompress(data)
+                    t.write(data)
+                    data = response.raw.read(DOWNLOAD_BUFFER_SIZE)
+
+                if gunzip:
+                    t.write(decompressor.flush())
+
+        if content_length is not None and size != int(content_length):
+            msg = ('File download was incomplete.\n'
+                   'URL: %s\n'
+                   'Got %i bytes but expected %s'
+                   % (download_url, size, content_length))
+            raise Exception(msg)
+    except:
+        t.close()
+        shutil.rmtree(tempdir, ignore_errors=True)
+        raise
 
-    # Write and return filename
-    t.write(data)
-    filename = os.path.abspath(t.name)
     return filename
 
 
-
-def download(server_url, layer_name, bbox, resolution=None):
+def download(server_url, layer_name, bbox, resolution=None, cancel=None):
     """Download the source data of a given layer.
 
     Input
@@ -277,17 +1053,16 @@ def download(server_url, layer_name, bbox, resolution=None):
                     and resy.
                     If resolution is None, the 'native' resolution of
                     the dataset is used.
+        cancel: Optional threading.Event to stop the download early
 
     Layer geometry type must be either 'vector' or 'raster'
     """
 
     # Input checks
     assert isinstance(server_url, basestring)
-    try:
-        urllib2.urlopen(server_url)
-    except Exception, e:
+    if not is_server_reachable(server_url):
         msg = ('Argument server_url doesn\'t appear to be a valid URL'
-               'I got %s. Error message was: %s' % (server_url, str(e)))
+               'I got %s.' % server_url)
         raise Exception(msg)
 
     msg = ('Expected layer_name to be a basestring. '
@@ -346,17 +1121,6 @@ def download(server_url, layer_name, bbox, resolution=None):
                    'This can only be done for raster layers.' % layer_name)
             raise RisikoException(msg)
 
-        template = WFS_TEMPLATE
-        suffix = '.zip'
-        download_url = template % (server_url, layer_name, bbox_string)
-        thefilename = get_file(download_url, suffix)
-        dirname = os.path.dirname(thefilename)
-        t = open(thefilename, 'r')
-        zf = ZipFile(t)
-        namelist = zf.namelist()
-        zf.extractall(path=dirname)
-        (shpname,) = [name for name in namelist if '.shp' in name]
-        filename = os.path.join(dirname, shpname)
     elif data_type == 'raster':
 
         if resolution is None:
@@ -364,25 +1128,686 @@ def download(server_url, layer_name, bbox, resolution=None):
             resolution = layer_metadata['resolution']
             #resolution = (resolution, resolution)  #FIXME (Ole): Make nicer
 
+    # Reuse earlier download of the same data if possible
+    key = layer_cache_key(server_url, layer_name, bbox_string, resolution,
+                          layer_metadata)
+    filename = get_cached_layer(key)
+
+    # Otherwise clip layers of the internal GeoServer straight from their
+    # files. The clips are cached like downloads so that calculations
+    # over the same layer share them.
+    local_filename = None
+    if filename is None:
+        local_filename = get_local_file(server_url, layer_name, data_type)
+    if local_filename is not None:
+        if cancel is not None and cancel.is_set():
+            msg = 'Download of %s was cancelled' % layer_name
+            raise CancelledError(msg)
+        filename = clip_local_file(local_filename, layer_name, data_type,
+                                   bbox_string, resolution)
+
+    # Otherwise crop rasters from a cached download covering the bbox
+    extents_key = layer_cache_key(server_url, layer_name, None, resolution,
+                                  layer_metadata)
+    if filename is None and data_type == 'raster':
+        filename = crop_cached_raster(key, extents_key, bbox_string,
+                                      [float(res) for res in resolution],
+                                      layer_metadata['geotransform'])
+
+    if filename is None and data_type == 'vector' and WFS_PAGING:
+        template = WFS_TEMPLATE
+        filename = os.path.join(make_scratch_dir(),
+                                '%s.shp' % layer_name.split(':')[-1])
+        download_features(server_url, layer_name, bbox_string, filename,
+                          formats=layer_metadata.get('formats', []),
+                          cancel=cancel)
+    elif filename is None and data_type == 'vector':
+        template = WFS_TEMPLATE
+        output_format = choose_format(WFS_FORMATS,
+                                      layer_metadata.get('formats', []))
+        suffix, gunzip = WFS_FORMAT_FILES[output_format]
+        download_url = template % (server_url, layer_name, output_format,
+                                   bbox_string)
+        filename = get_file(download_url, suffix, cancel=cancel,
+                            gunzip=gunzip)
+    elif filename is None and data_type == 'raster':
         # Download raster using specified bounding box and resolution
         template = WCS_TEMPLATE
         suffix = '.tif'
-        download_url = template % (server_url, layer_name, bbox_string,
-                                   resolution[0], resolution[1])
-        filename = get_file(download_url, suffix)
+        tiles = split_bounding_box(bboxstring2list(bbox_string),
+                                   [float(res) for res in resolution],
+                                   WCS_TILE_SIZE)
+        if len(tiles) > 1:
+            filename = get_tiled_raster(server_url, layer_name, bbox_string,
+                                        resolution, tiles, cancel=cancel)
+        else:
+            download_url = template % (server_url, layer_name, bbox_string,
+                                       resolution[0], resolution[1])
+            filename = get_file(download_url, suffix, cancel=cancel)
 
-    # Write keywords file
-    keywords = layer_metadata['keywords']
-    write_keywords(keywords, os.path.splitext(filename)[0] + '.keywords')
+    if template is not None or local_filename is not None:
+        # Write keywords file. For SHAPE-ZIP archives it is written next
+        # to the archive, as read_layer can not find it inside.
+        keywords = layer_metadata['keywords']
+        write_keywords(keywords, os.path.splitext(filename)[0] + '.keywords')
+
+        filename = cache_layer(key, filename)
+        if data_type == 'raster':
+            add_cached_raster_extent(extents_key, key, bbox_string)
 
     # Instantiate layer from file
-    lyr = read_layer(filename)
+    if os.path.splitext(filename)[1] == '.zip':
+        # Read shapefile straight from the SHAPE-ZIP archive and its
+        # keywords from the file next to it
+        lyr = read_layer(get_shapefile_in_zip(filename))
+        lyr.keywords = read_keywords(os.path.splitext(filename)[0] +
+                                     '.keywords')
+    else:
+        lyr = read_layer(filename)
+
+    # Read cached rasters from the .npy file cache_layer wrote into their
+    # entry, see memory_map_raster. Layers outside the cache are used once
+    # so they have none.
+    basename = os.path.splitext(os.path.basename(filename))[0]
+    npy_filename = os.path.join(LAYER_CACHE_DIR, key, basename + '.npy')
+    if (data_type == 'raster' and MEMORY_MAP_RASTERS and
+        LAYER_CACHE_SIZE > 0 and os.path.isfile(npy_filename)):
+        try:
+            memory_map_raster(lyr, npy_filename)
+        except (OSError, IOError), e:
+            # Evicted in the meantime, the layer reads its own copy
+            logger.info('Could not memory map %s: %s' % (filename, e))
 
     # FIXME (Ariel) Don't monkeypatch the layer object
     lyr.metadata = layer_metadata
     return lyr
 
 
+def get_local_file(server_url, layer_name, data_type):
+    """Get uploaded file of a layer of the internal GeoServer
+
+    Input
+        server_url, layer_name: As in download
+        data_type: 'raster' or 'vector'
+
+    Output
+        filename: Name of the uploaded GeoTIFF or shapefile of the layer,
+                  or None if the layer is not local or its file can not
+                  be found, in which case it must be downloaded.
+    """
+
+    if not USE_LOCAL_FILES:
+        return None
+
+    if server_url.rstrip('/') != INTERNAL_SERVER_URL.rstrip('/'):
+        return None
+
+    try:
+        layer = Layer.objects.get(typename=layer_name)
+        upload_session = getattr(layer, 'upload_session', None)
+    except ObjectDoesNotExist:
+        return None
+
+    if upload_session is None:
+        return None
+
+    for layer_file in upload_session.layerfile_set.all():
+        try:
+            filename = layer_file.file.path
+        except (ValueError, NotImplementedError):
+            # No file or not stored on the local file system
+            continue
+
+        extension = os.path.splitext(filename)[1].lower()
+        if (extension in LOCAL_FILE_TYPES.get(data_type, []) and
+            os.path.isfile(filename)):
+            return filename
+
+    return None
+
+
+def clip_local_file(source, layer_name, data_type, bbox_string, resolution):
+    """Clip uploaded file of a layer like WCS or WFS would
+
+    Input
+        source: Name of the uploaded file, see get_local_file
+        layer_name, bbox_string, resolution: As in download
+        data_type: 'raster' or 'vector'
+
+    Output
+        filename: Name of the clipped GeoTIFF or shapefile in a new
+                  scratch directory
+    """
+
+    bbox = bboxstring2list(bbox_string)
+    basename = os.path.join(make_scratch_dir(), layer_name.split(':')[-1])
+
+    if data_type == 'raster':
+        filename = basename + '.tif'
+        warp_raster(source, bbox, [float(res) for res in resolution],
+                    filename)
+    else:
+        filename = basename + '.shp'
+        count = clip_vector(source, bbox, filename)
+        if count == 0:
+            msg = ('No features of layer %s were found in bounding box %s'
+                   % (layer_name, bbox_string))
+            raise RisikoException(msg)
+
+    return filename
+
+
+def choose_format(preferences, formats):
+    """Choose output format for a download
+
+    Input
+        preferences: Formats in order of preference. The last one is
+                     assumed to be supported by every server.
+        formats: Formats offered by the server. Empty if not known.
+
+    Output
+        First preferred format offered by the server, compared without
+        regard to case, or the last preference.
+    """
+
+    offered = [x.lower() for x in formats]
+    for preference in preferences[:-1]:
+        if preference.lower() in offered:
+            return preference
+
+    return preferences[-1]
+
+
+def iter_feature_pages(server_url, layer_name, bbox_string, formats=None,
+                       page_size=None, sort_by=None, cancel=None):
+    """Yield features of a vector layer from WFS one page at a time
+
+    Input
+        server_url, layer_name, bbox_string, cancel: As in download
+        formats: WFS output formats offered by the server, if known
+        page_size: Number of features per page.
+                   If None, SAFE_WFS_PAGE_SIZE is used.
+        sort_by: Attribute to sort features by so that pages neither
+                 overlap nor miss features. If None, SAFE_WFS_PAGE_SORT_BY
+                 is used and if that is None too, all features are
+                 requested as one page.
+
+    Output
+        Generator of OGR layers with up to page_size features each.
+        Only one page is kept at a time, so use each page before asking
+        for the next one.
+
+    Pages are requested with maxFeatures, startIndex and sortBy until a
+    page with fewer than page_size features arrives.
+    """
+
+    if page_size is None:
+        page_size = WFS_PAGE_SIZE
+
+    if sort_by is None:
+        sort_by = WFS_PAGE_SORT_BY
+
+    output_format = choose_format(WFS_FORMATS, formats or [])
+    suffix, gunzip = WFS_FORMAT_FILES[output_format]
+
+    start = 0
+    while True:
+        download_url = WFS_TEMPLATE % (server_url, layer_name,
+                                       output_format, bbox_string)
+        if sort_by is not None:
+            download_url += WFS_PAGE_TEMPLATE % (page_size, start,
+                                                 urllib.quote(sort_by))
+        filename = get_file(download_url, suffix, cancel=cancel,
+                            gunzip=gunzip)
+        try:
+            if suffix == '.zip':
+                datasource = ogr.Open(get_shapefile_in_zip(filename))
+            else:
+                datasource = ogr.Open(filename)
+
+            # Empty pages may not even have a layer
+            count = 0
+            if datasource is not None and datasource.GetLayerCount() > 0:
+                page = datasource.GetLayer(0)
+                count = page.GetFeatureCount()
+                if count > 0:
+                    yield page
+                page = None
+            datasource = None
+        finally:
+            shutil.rmtree(os.path.dirname(filename), ignore_errors=True)
+
+        if sort_by is None or count < page_size:
+            break
+        start += count
+
+
+def download_features(server_url, layer_name, bbox_string, filename,
+                      formats=None, cancel=None):
+    """Write a vector layer from WFS to a shapefile one page at a time
+
+    Input
+        server_url, layer_name, bbox_string, cancel: As in download
+        filename: Name of shapefile to create
+        formats: WFS output formats offered by the server, if known
+
+    Output
+        Number of features written
+
+    Memory use is bounded by SAFE_WFS_PAGE_SIZE features rather than the
+    size of the layer.
+    """
+
+    pages = iter_feature_pages(server_url, layer_name, bbox_string,
+                               formats=formats, cancel=cancel)
+    count = write_features(pages, filename)
+
+    if count == 0:
+        msg = ('No features of layer %s were found in bounding box %s'
+               % (layer_name, bbox_string))
+        raise RisikoException(msg)
+
+    return count
+
+
+def get_shapefile_in_zip(filename):
+    """Get name through which GDAL reads the shapefile in a zip archive
+
+    Input
+        filename: Name of zip archive with exactly one shapefile
+
+    Output
+        GDAL virtual file name of the form /vsizip/<archive>/<member>.shp
+    """
+
+    with ZipFile(filename) as zf:
+        shpnames = [name for name in zf.namelist() if name.endswith('.shp')]
+
+    msg = ('Expected exactly one shapefile in %s. I got %s'
+           % (filename, shpnames))
+    assert len(shpnames) == 1, msg
+
+    return '/vsizip/%s/%s' % (os.path.abspath(filename), shpnames[0])
+
+
+def get_tiled_raster(server_url, layer_name, bbox_string, resolution, tiles,
+                     cancel=None):
+    """Download a raster as tiles and combine them into one GeoTIFF
+
+    Input
+        server_url, layer_name, bbox_string, resolution, cancel: As download
+        tiles: Tile bounding boxes from split_bounding_box
+
+    Output
+        filename: Name of the GeoTIFF file in a new temporary directory
+
+    Up to SAFE_WCS_TILE_WORKERS tiles are requested at the same time.
+    If one tile fails, the remaining ones are cancelled.
+    """
+
+    if cancel is None:
+        cancel = threading.Event()
+
+    def get_tile(tile_bbox):
+        download_url = WCS_TEMPLATE % (server_url, layer_name,
+                                       bboxlist2string(tile_bbox, decimals=9),
+                                       resolution[0], resolution[1])
+        return get_file(download_url, '.tif', cancel=cancel)
+
+    results = run_in_parallel(get_tile, tiles, workers=WCS_TILE_WORKERS,
+                              cancel=cancel)
+    tile_filenames = [tile_filename for tile_filename, _ in results
+                      if tile_filename is not None]
+
+    try:
+        errors = [error for _, error in results if error is not None]
+        errors.sort(key=lambda error: isinstance(error, CancelledError))
+        if errors:
+            exc_info = errors[0].exc_info
+            raise exc_info[0], exc_info[1], exc_info[2]
+
+        filename = os.path.join(make_scratch_dir(),
+                                '%s.tif' % layer_name.split(':')[-1])
+        mosaic_rasters(tile_filenames, bboxstring2list(bbox_string),
+                       [float(res) for res in resolution], filename)
+    finally:
+        for tile_filename in tile_filenames:
+            shutil.rmtree(os.path.dirname(tile_filename), ignore_errors=True)
+
+    return filename
+
+
+def layer_cache_key(server_url, layer_name, bbox_string, resolution,
+                    layer_metadata):
+    """Get key of downloaded layer data in the layer cache
+
+    Input
+        server_url, layer_name, bbox_string, resolution: As in download
+        layer_metadata: Metadata of the layer from get_metadata
+
+    Output
+        key: sha1 hex digest which changes whenever the request or the
+             layer may have changed, i.e. when its metadata changes or
+             the capabilities of its server are invalidated.
+
+    If bbox_string is None, the key stands for all downloads of the
+    layer at the given resolution.
+    """
+
+    bbox = None
+    if bbox_string is not None:
+        bbox = bboxlist2string(bboxstring2list(bbox_string))
+    if resolution is not None:
+        resolution = [float(res) for res in resolution]
+    generation = cache.get(generation_key(server_url), 0)
+
+    request = json.dumps([server_url, layer_name, bbox, resolution,
+                          generation, layer_metadata], sort_keys=True)
+
+    return hashlib.sha1(request).hexdigest()
+
+
+def count_layer_cache(outcome):
+    """Increment counter of layer cache hits or misses
+    """
+
+    key = 'safe-layer-cache-%s' % outcome
+    cache.add(key, 0, LAYER_CACHE_STATS_LIFETIME)
+    try:
+        cache.incr(key)
+    except ValueError:
+        # Counter was evicted in the meantime
+        pass
+
+
+def link_layer_files(source_dir, target_dir, exclude=None):
+    """Hard link the files of a layer into another directory
+
+    Input
+        source_dir: Directory with the layer file and its auxiliary files
+        target_dir: Existing directory to link them into
+        exclude: Optional list of extensions of files to leave out
+
+    Files are copied where they can not be linked, e.g. across file
+    systems. Links share the data of the files but not their names, so
+    they remain valid when the cache entry is evicted or replaced.
+    """
+
+    for name in os.listdir(source_dir):
+        if os.path.splitext(name)[1] in (exclude or []):
+            continue
+        source = os.path.join(source_dir, name)
+        target = os.path.join(target_dir, name)
+        try:
+            os.link(source, target)
+        except OSError:
+            shutil.copy(source, target)
+
+
+def get_cached_layer(key, count=True):
+    """Get filename of layer data in the layer cache
+
+    Input
+        key: Key from layer_cache_key
+        count: If True, the lookup is counted as a cache hit or miss
+
+    Output
+        filename: Name of a link to the layer file in a new scratch
+                  directory or None if the layer is not cached or older
+                  than SAFE_LAYER_CACHE_MAX_AGE. Callers never get the
+                  name of the file in the cache, which other processes
+                  may evict at any time.
+    """
+
+    if LAYER_CACHE_SIZE <= 0:
+        return None
+
+    path = os.path.join(LAYER_CACHE_DIR, key)
+    try:
+        (name,) = [name for name in os.listdir(path)
+                   if os.path.splitext(name)[1] in LAYER_CACHE_TYPES]
+        filename = os.path.join(path, name)
+        age = time.time() - os.path.getmtime(filename)
+
+        # Record use of the entry for the LRU eviction
+        os.utime(path, None)
+    except (OSError, ValueError):
+        age = None
+
+    if age is not None and age <= LAYER_CACHE_MAX_AGE:
+        dirname = make_scratch_dir()
+        try:
+            # Memory mapped .npy files stay in the layer cache
+            link_layer_files(path, dirname, exclude=['.npy'])
+        except (OSError, IOError):
+            # Evicted in the meantime
+            shutil.rmtree(dirname, ignore_errors=True)
+            age = None
+        else:
+            filename = os.path.join(dirname, os.path.basename(filename))
+
+    if age is None or age > LAYER_CACHE_MAX_AGE:
+        if count:
+            count_layer_cache('misses')
+        return None
+
+    if count:
+        count_layer_cache('hits')
+    return filename
+
+
+def add_cached_raster_extent(extents_key, key, bbox_string):
+    """Record bounding box of a raster in the layer cache
+
+    Input
+        extents_key: Key from layer_cache_key without bbox
+        key: Key of the cached raster
+        bbox_string: Bounding box of the cached raster
+    """
+
+    extents = cache.get(extents_key, [])
+    extents = [(k, bbox) for k, bbox in extents if k != key]
+    extents.append((key, bboxstring2list(bbox_string)))
+
+    cache.set(extents_key, extents[-MAX_CACHED_RASTER_EXTENTS:],
+              LAYER_CACHE_MAX_AGE)
+
+
+def crop_cached_raster(key, extents_key, bbox_string, resolution,
+                       geotransform=None):
+    """Crop raster data from a cached raster covering a bounding box
+
+    Input
+        key: Key from layer_cache_key for the requested raster
+        extents_key: Key from layer_cache_key without bbox
+        bbox_string: Requested bounding box
+        resolution: Requested pixel size (resx, resy)
+        geotransform: Native geotransform of the layer from its metadata
+
+    Output
+        filename: Name of cropped raster file stored in the layer cache
+                  under key or None if no cached raster covers bbox_string
+
+    The result is on the grid a WCS request for bbox_string and
+    resolution returns. Pixels are cut out of the cached raster if the
+    bbox fits its grid. Otherwise they are resampled onto the requested
+    grid, but only from cached rasters on the native grid of the layer.
+    Resampling anything else would resample the data twice and pick
+    other values than GeoServer does.
+    """
+
+    if LAYER_CACHE_SIZE <= 0:
+        return None
+
+    bbox = bboxstring2list(bbox_string)
+    extents = cache.get(extents_key, [])
+    index = BoundingBoxIndex(extents)
+    for candidate in index.query(bbox):
+        candidate_bbox = dict(extents)[candidate]
+        if not (candidate_bbox[0] <= bbox[0] and
+                candidate_bbox[1] <= bbox[1] and
+                candidate_bbox[2] >= bbox[2] and
+                candidate_bbox[3] >= bbox[3]):
+            continue
+
+        source = get_cached_layer(candidate, count=False)
+        if source is None:
+            # Evicted in the meantime
+            continue
+
+        basename = os.path.splitext(os.path.basename(source))[0]
+        dirname = make_scratch_dir()
+        filename = os.path.join(dirname, basename + '.tif')
+        if is_on_pixel_grid(source, bbox, resolution):
+            crop_raster(source, bbox, filename)
+        elif (geotransform is not None and
+              is_on_geotransform_grid(source, geotransform)):
+            warp_raster(source, bbox, resolution, filename)
+        else:
+            shutil.rmtree(dirname, ignore_errors=True)
+            continue
+        shutil.copy(os.path.splitext(source)[0] + '.keywords', dirname)
+
+        count_layer_cache('crops')
+        return cache_layer(key, filename)
+
+    return None
+
+
+def cache_layer(key, filename):
+    """Add downloaded layer data to the layer cache
+
+    Input
+        key: Key from layer_cache_key
+        filename: Name of the downloaded layer file. All files in its
+                  directory are linked into the cache.
+
+    Output
+        filename: The given filename, which remains the caller's own
+                  copy of the data whatever happens to the cache entry
+
+    Entries are staged in a hidden directory and renamed into place, so
+    other processes either see a complete entry or none at all. Entries
+    of rasters get the .npy file mapped by download if
+    SAFE_MEMORY_MAP_RASTERS is True. It counts towards
+    SAFE_LAYER_CACHE_SIZE like the other files of the entry.
+    """
+
+    if LAYER_CACHE_SIZE <= 0:
+        return filename
+
+    if not os.path.isdir(LAYER_CACHE_DIR):
+        try:
+            os.makedirs(LAYER_CACHE_DIR)
+        except OSError:
+            # Created by another process in the meantime
+            pass
+
+    staging = tempfile.mkdtemp(prefix='.staging-', dir=LAYER_CACHE_DIR)
+    try:
+        link_layer_files(os.path.dirname(filename), staging)
+    except:
+        shutil.rmtree(staging, ignore_errors=True)
+        raise
+
+    basename, extension = os.path.splitext(os.path.basename(filename))
+    if (MEMORY_MAP_RASTERS and
+        extension in ['.tif', '.tiff', '.geotif', '.geotiff']):
+        try:
+            write_band_array(os.path.join(staging, basename + extension),
+                             os.path.join(staging, basename + '.npy'))
+        except Exception, e:
+            # The layer is read from the raster file instead
+            logger.warning('Could not write band array of %s: %s'
+                           % (filename, e))
+
+    # Replace outdated entry if any
+    path = os.path.join(LAYER_CACHE_DIR, key)
+    shutil.rmtree(path, ignore_errors=True)
+    try:
+        os.rename(staging, path)
+    except OSError:
+        # Another process cached the same layer in the meantime
+        shutil.rmtree(staging, ignore_errors=True)
+
+    # The new entry is kept even if it is larger than the cache
+    evict_layer_cache(keep=path)
+
+    return filename
+
+
+def get_layer_cache_entries():
+    """Get entries of the layer cache
+
+    Output
+        List of (last use time, size in bytes, path), oldest first
+    """
+
+    entries = []
+    if not os.path.isdir(LAYER_CACHE_DIR):
+        return entries
+
+    for name in os.listdir(LAYER_CACHE_DIR):
+        path = os.path.join(LAYER_CACHE_DIR, name)
+        try:
+            mtime = os.path.getmtime(path)
+            if name.startswith('.staging-'):
+                # Left behind by a process that died while caching
+                if time.time() - mtime > LAYER_CACHE_MAX_AGE:
+                    shutil.rmtree(path, ignore_errors=True)
+                continue
+
+            size = sum([os.path.getsize(os.path.join(path, x))
+                        for x in os.listdir(path)])
+        except OSError:
+            # Removed by another process in the meantime
+            continue
+
+        entries.append((mtime, size, path))
+
+    entries.sort()
+    return entries
+
+
+def evict_layer_cache(keep=None):
+    """Remove least recently used layers until SAFE_LAYER_CACHE_SIZE is met
+
+    Input
+        keep: Path of an entry that is never removed, e.g. the one just
+              added to the cache
+
+    Readers hold links to the files, so removing an entry never pulls
+    the data from under them.
+    """
+
+    entries = get_layer_cache_entries()
+    total = sum([size for _, size, _ in entries])
+    for _, size, path in entries:
+        if total <= LAYER_CACHE_SIZE:
+            break
+        if path == keep:
+            continue
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
+
+
+def get_layer_cache_stats():
+    """Get statistics of the layer cache
+
+    Output
+        Dictionary with number of hits, misses and misses served by
+        cropping a cached raster (since counters were last evicted from
+        the Django cache), entries and size in bytes
+    """
+
+    entries = get_layer_cache_entries()
+    return {'hits': cache.get('safe-layer-cache-hits', 0),
+            'misses': cache.get('safe-layer-cache-misses', 0),
+            'crops': cache.get('safe-layer-cache-crops', 0),
+            'entries': len(entries),
+            'size': sum([size for _, size, _ in entries])}
+
+
 def dummy_save(filename, title, user, metadata=''):
     """Take a file-like object and uploads it to a GeoNode
     """
@@ -513,7 +1938,7 @@ def check_layer(layer, full=False):
     if full:
         # Check that layer can be downloaded again
         downloaded_layer = download(INTERNAL_SERVER_URL, layer_name, bbox)
-        assert os.path.exists(downloaded_layer.filename)
+        assert layer_file_exists(downloaded_layer.filename)
 
         # Check integrity between Django layer and file
         assert_bounding_box_matches(layer, downloaded_layer.filename)
@@ -527,6 +1952,93 @@ def check_layer(layer, full=False):
         #print metadata['keywords']
 
 
+def copy_layer_files(filename, dirname):
+    """Copy a layer file and its auxiliary files to another directory
+
+    Input
+        filename: Name of layer file
+        dirname: Directory to copy to
+
+    Output
+        Name of the copied layer file
+
+    All files named like filename with any extension are copied, e.g.
+    .keywords, .sld and .prj files.
+    """
+
+    basename = os.path.splitext(os.path.basename(filename))[0]
+    source_dir = os.path.dirname(os.path.abspath(filename))
+    for name in os.listdir(source_dir):
+        if os.path.splitext(name)[0] == basename:
+            shutil.copy(os.path.join(source_dir, name), dirname)
+
+    return os.path.join(dirname, os.path.basename(filename))
+
+
+def normalize_raster(upload_filename, filename):
+    """Prepare a GeoTIFF for upload
+
+    Input
+        upload_filename: Name of GeoTIFF to upload
+        filename: Name of the file given to save_file_to_geonode. It is
+                  never modified.
+
+    Output
+        Name of GeoTIFF to upload instead. Unless it is upload_filename it
+        is in a scratch directory of its own together with the .keywords
+        and .sld files of upload_filename, whose directory is removed
+        unless it is that of filename.
+
+    Overviews are added for SAFE_OVERVIEW_LEVELS. If
+    SAFE_NORMALIZE_RASTERS is True, rasters that are not tiled and
+    compressed already are rewritten as cloud optimized GeoTIFFs with
+    SAFE_RASTER_CREATION_OPTIONS.
+    """
+
+    levels = get_overview_levels(upload_filename, OVERVIEW_LEVELS,
+                                 OVERVIEW_MIN_SIZE)
+    optimized = is_optimized_geotiff(upload_filename)
+
+    # Overviews must be rewritten to end up in front of the data
+    normalize = NORMALIZE_RASTERS and (len(levels) > 0 or not optimized)
+    if len(levels) == 0 and not normalize:
+        return upload_filename
+
+    if len(levels) > 0:
+        if upload_filename == filename:
+            # Build them on a copy to leave the given file alone
+            upload_filename = copy_layer_files(filename, make_scratch_dir())
+        try:
+            build_overviews(upload_filename, levels, OVERVIEW_RESAMPLING)
+        except:
+            if upload_filename != filename:
+                shutil.rmtree(os.path.dirname(upload_filename),
+                              ignore_errors=True)
+            raise
+
+    if normalize:
+        basename = os.path.splitext(upload_filename)[0]
+        dirname = make_scratch_dir()
+        optimized_filename = os.path.join(dirname,
+                                          os.path.basename(upload_filename))
+        try:
+            write_optimized_geotiff(upload_filename, optimized_filename,
+                                    RASTER_CREATION_OPTIONS)
+            for ext in ['.keywords', '.sld']:
+                if os.path.exists(basename + ext):
+                    shutil.copy(basename + ext, dirname)
+        except:
+            shutil.rmtree(dirname, ignore_errors=True)
+            raise
+        finally:
+            if upload_filename != filename:
+                shutil.rmtree(os.path.dirname(upload_filename),
+                              ignore_errors=True)
+        upload_filename = optimized_filename
+
+    return upload_filename
+
+
 def save_file_to_geonode(filename, user=None, title=None,
                          overwrite=True, check_metadata=True,
                          ignore=None):
@@ -601,17 +2113,6 @@ def save_file_to_geonode(filename, user=None, title=None,
         # We assume this is an AAIGrid ASCII file such as those generated by
         # ESRI and convert it to Geotiff before uploading.
 
-        # Create temporary tif file for upload and check that the road is clear
-        prefix = os.path.split(basename)[-1]
-        upload_filename = unique_filename(prefix=prefix, suffix='.tif')
-        upload_basename, extension = os.path.splitext(upload_filename)
-
-        # Copy any metadata files to unique filename
-        for ext in ['.sld', '.keywords']:
-            if os.path.exists(basename + ext):
-                cmd = 'cp %s%s %s%s' % (basename, ext, upload_basename, ext)
-                run(cmd)
-
         # Check that projection file exists
         prjname = basename + '.prj'
         if not os.path.isfile(prjname):
@@ -619,13 +2120,42 @@ def save_file_to_geonode(filename, user=None, title=None,
                    '%s' % (filename, prjname))
             raise RisikoException(msg)
 
-        # Convert ASCII file to GeoTIFF
-        R = read_layer(filename)
-        R.write_to_file(upload_filename)
+        # Create temporary tif file for upload in a scratch directory of
+        # its own, so the tif and anything GDAL writes next to it
+        # (e.g. .aux.xml) are removed together
+        prefix = os.path.split(basename)[-1]
+        upload_filename = unique_filename(prefix=prefix, suffix='.tif',
+                                          dir=make_scratch_dir())
+        upload_basename = os.path.splitext(upload_filename)[0]
+
+        try:
+            # Copy any metadata files to unique filename
+            for ext in ['.sld', '.keywords']:
+                if os.path.exists(basename + ext):
+                    shutil.copy(basename + ext, upload_basename + ext)
+
+            # Convert ASCII file to GeoTIFF
+            R = read_layer(filename)
+            R.write_to_file(upload_filename)
+        except:
+            shutil.rmtree(os.path.dirname(upload_filename),
+                          ignore_errors=True)
+            raise
     else:
         # The specified file is the one to upload
         upload_filename = filename
 
+    # Give rasters overviews and a layout suited to windowed reads
+    if os.path.splitext(upload_filename)[1] in ['.tif', '.tiff',
+                                                 '.geotif', '.geotiff']:
+        try:
+            upload_filename = normalize_raster(upload_filename, filename)
+        except:
+            if upload_filename != filename:
+                shutil.rmtree(os.path.dirname(upload_filename),
+                              ignore_errors=True)
+            raise
+
     # Use file name or keywords to derive title if not specified
     if kw_title is None:
         title = os.path.split(basename)[-1]
@@ -649,7 +2179,24 @@ def save_file_to_geonode(filename, user=None, title=None,
         if kw_title is not None:
             layer.title = kw_title
 
+        # Saving also invalidates cached capabilities and refreshes the
+        # catalog entry of the layer (see safe_geonode.models.layer_saved)
         layer.save()
+
+        # Index the stored shapefile so filtered reads by download and
+        # GeoServer only touch matching features. Uploads carry only the
+        # .shp, .shx, .dbf and .prj files, so indexes are built here and
+        # rebuilt when the layer is overwritten. The layer is usable
+        # without them, so failures are only logged.
+        if extension == '.shp' and INDEX_VECTORS:
+            local_filename = get_local_file(INTERNAL_SERVER_URL,
+                                            layer.typename, 'vector')
+            if local_filename is not None:
+                try:
+                    index_shapefile(local_filename, VECTOR_INDEX_FIELDS)
+                except Exception, e:
+                    logger.warning('Could not index %s: %s'
+                                   % (local_filename, e))
     except GeoNodeException, e:
         raise
     else:
@@ -684,10 +2231,10 @@ def save_file_to_geonode(filename, user=None, title=None,
                        'correctly: %s' % (layer, errmsg))
                 raise Exception(msg)
     finally:
-        # Clean up generated tif files in either case
-        if extension == '.asc':
-            os.remove(upload_filename)
-            os.remove(upload_filename + '.aux.xml')
+        # Clean up generated and copied files in either case
+        if upload_filename != filename:
+            shutil.rmtree(os.path.dirname(upload_filename),
+                          ignore_errors=True)
 
 
 def save_to_geonode(incoming, user=None, title=None,
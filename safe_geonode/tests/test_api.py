@@ -4,9 +4,19 @@ import sys
 import unittest
 import warnings
 import time
+import threading
+import multiprocessing
+import traceback
 
 from safe_geonode.views import calculate
+from safe_geonode.views import get_plugin_registry_hash
+from safe_geonode.views import get_requirement_names
+from safe_geonode.views import keyword_signature
+from safe_geonode.views import get_admissible_plugin_names
+from safe_geonode.views import get_questions
+from safe_geonode import views
 from safe_geonode.storage import save_file_to_geonode as save_to_geonode
+from safe_geonode.storage import bump_catalog_revision
 from safe_geonode.storage import check_layer
 from safe_geonode.storage import assert_bounding_box_matches
 from safe_geonode.storage import download
@@ -15,6 +25,9 @@ from safe_geonode.storage import get_metadata
 from safe_geonode.storage import get_bounding_box
 from safe_geonode.utilities import get_bounding_box_string
 from safe_geonode.utilities import nanallclose
+from safe_geonode.utilities import bbox_overlaps, BoundingBoxIndex
+from safe_geonode.utilities import run_in_parallel, CancelledError
+from safe_geonode.utilities import layer_file_exists
 from safe_geonode.tests.utilities import TESTDATA, INTERNAL_SERVER_URL
 
 from geonode.layers.utils import get_valid_user, check_geonode_is_up
@@ -142,7 +155,7 @@ class TestApi(LiveServerTestCase):
         result_layer = download(INTERNAL_SERVER_URL,
                                 layer_id,
                                 get_bounding_box_string(hazard_filename))
-        assert os.path.exists(result_layer.filename)
+        assert layer_file_exists(result_layer.filename)
 
 
     def test_jakarta_flood_study(self):
@@ -373,7 +386,7 @@ class TestApi(LiveServerTestCase):
         result_layer = download(INTERNAL_SERVER_URL,
                                 layer_name,
                                 get_bounding_box_string(hazard_filename))
-        assert os.path.exists(result_layer.filename)
+        assert layer_file_exists(result_layer.filename)
 
         # Check calculated values
         keywords = result_layer.get_keywords()
@@ -437,6 +450,238 @@ class TestApi(LiveServerTestCase):
                'not even the built-in ones')
         assert len(functions) > 0, msg
 
+    def test_questions_with_unreachable_server(self):
+        """Unreachable servers are reported as degraded by questions
+        """
+
+        bad_server = 'http://localhost:1/geoserver/ows'
+        c = Client()
+        functions_url = reverse('safe-questions')
+        rv = c.get(functions_url,
+                   {'geoservers': '%s,%s' % (INTERNAL_SERVER_URL, bad_server)})
+        self.assertEqual(rv.status_code, 200)
+        data = json.loads(rv.content)
+
+        assert 'layers' in data
+        assert 'degraded_servers' in data
+
+        degraded = [server['url'] for server in data['degraded_servers']]
+        msg = 'Expected %s to be reported as degraded. I got %s' % (bad_server,
+                                                                   degraded)
+        assert degraded == [bad_server], msg
+
+    def test_questions_etag(self):
+        """Questions are answered with 304 until layers change
+        """
+
+        c = Client()
+        functions_url = reverse('safe-questions')
+        rv = c.get(functions_url)
+        self.assertEqual(rv.status_code, 200)
+        etag = rv['ETag']
+
+        rv = c.get(functions_url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(rv.status_code, 304)
+
+        # Uploading a layer changes the answer
+        thefile = os.path.join(UNITDATA, 'hazard', 'jakarta_flood_design.tif')
+        save_to_geonode(thefile, user=self.user, overwrite=True)
+        rv = c.get(functions_url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(rv.status_code, 200)
+        assert rv['ETag'] != etag
+
+        # Syncing the catalog while answering does not make the new
+        # answer outdated right away
+        rv = c.get(functions_url, HTTP_IF_NONE_MATCH=rv['ETag'])
+        self.assertEqual(rv.status_code, 304)
+
+        # Answers made while layers changed elsewhere are not cached
+        def changing_questions(*args, **kwargs):
+            output = get_questions(*args, **kwargs)
+            bump_catalog_revision()
+            return output
+
+        views.get_questions = changing_questions
+        try:
+            rv = c.get(functions_url, {'limit': 1})
+        finally:
+            views.get_questions = get_questions
+        self.assertEqual(rv.status_code, 200)
+        assert not rv.has_header('ETag')
+
+    def test_questions_filters_and_pages(self):
+        """Questions can be filtered and paginated
+        """
+
+        for filename in [os.path.join('hazard', 'jakarta_flood_design.tif'),
+                         os.path.join('exposure', 'buildings_osm_4326.shp')]:
+            thefile = os.path.join(UNITDATA, filename)
+            save_to_geonode(thefile, user=self.user, overwrite=True)
+
+        c = Client()
+        functions_url = reverse('safe-questions')
+        data = json.loads(c.get(functions_url).content)
+        all_questions = data['questions']
+        assert len(all_questions) > 1
+
+        # Page through the questions one at a time
+        questions = []
+        params = {'limit': 1}
+        while True:
+            data = json.loads(c.get(functions_url, params).content)
+            self.assertEqual(len(data['questions']), 1)
+            questions.extend(data['questions'])
+            if 'next' not in data:
+                break
+            params['cursor'] = data['next']
+        self.assertEqual(questions, all_questions)
+
+        # Slim answers have no docstrings
+        data = json.loads(c.get(functions_url, {'slim': 1}).content)
+        for function in data['functions'].values():
+            assert 'doc' not in function
+
+        # Function filter
+        function = all_questions[0]['function']
+        data = json.loads(c.get(functions_url,
+                                {'function': function}).content)
+        assert data['functions'].keys() == [function]
+        for question in data['questions']:
+            self.assertEqual(question['function'], function)
+
+        # Category filter
+        data = json.loads(c.get(functions_url,
+                                {'category': 'hazard'}).content)
+        for params in data['layers'].values():
+            self.assertEqual(params['keywords']['category'], 'hazard')
+
+        # Nothing in the middle of the Atlantic
+        data = json.loads(c.get(functions_url,
+                                {'bbox': '-30,-10,-20,0'}).content)
+        self.assertEqual(data['questions'], [])
+
+        rv = c.get(functions_url, {'bbox': 'not a bbox'})
+        self.assertEqual(rv.status_code, 400)
+
+    def test_questions_without_filters(self):
+        """All admissible functions and questions are found without filters
+        """
+
+        for filename in [os.path.join('hazard', 'jakarta_flood_design.tif'),
+                         os.path.join('exposure', 'buildings_osm_4326.shp')]:
+            thefile = os.path.join(UNITDATA, filename)
+            save_to_geonode(thefile, user=self.user, overwrite=True)
+
+        output = get_questions([{'url': INTERNAL_SERVER_URL}])
+        assert len(output['functions']) > 0
+        assert len(output['questions']) > 0
+        for question in output['questions']:
+            assert question['function'] in output['functions']
+
+        # Filtering by one of them keeps its questions only
+        function = output['questions'][0]['function']
+        filtered = get_questions([{'url': INTERNAL_SERVER_URL}],
+                                 function_names=[function])
+        self.assertEqual(filtered['functions'].keys(), [function])
+        self.assertEqual(filtered['questions'],
+                         [question for question in output['questions']
+                          if question['function'] == function])
+
+    def test_questions_only_pair_overlapping_layers(self):
+        """Questions only pair hazards and exposures that overlap
+        """
+
+        index = BoundingBoxIndex([('a', [0, 0, 10, 10]),
+                                  ('b', [20, 0, 30, 10]),
+                                  ('c', [5, 5, 25, 6]),
+                                  ('point', [1, 1, 1, 1])])
+        self.assertEqual(index.query([8, 4, 22, 8]), ['a', 'c', 'b'])
+        self.assertEqual(index.query([10, 0, 20, 4]), [])
+        self.assertEqual(index.query([-5, -5, 0.5, 0.5]), ['a'])
+
+        # Layers without a bounding box overlap nothing
+        index = BoundingBoxIndex([('a', [0, 0, 10, 10]), ('none', None)])
+        self.assertEqual(len(index), 1)
+        self.assertEqual(index.query([-5, -5, 5, 5]), ['a'])
+        self.assertEqual(index.query(None), [])
+        assert not bbox_overlaps([0, 0, 10, 10], None)
+        assert not bbox_overlaps(None, None)
+
+        for filename in [os.path.join('hazard', 'jakarta_flood_design.tif'),
+                         os.path.join('exposure', 'buildings_osm_4326.shp')]:
+            thefile = os.path.join(UNITDATA, filename)
+            save_to_geonode(thefile, user=self.user, overwrite=True)
+
+        c = Client()
+        data = json.loads(c.get(reverse('safe-questions')).content)
+        layers = data['layers']
+        assert len(data['questions']) > 0
+        for question in data['questions']:
+            hazard_bbox = layers[question['hazard']]['bounding_box']
+            exposure_bbox = layers[question['exposure']]['bounding_box']
+            msg = ('Question %s pairs layers with bounding boxes %s and %s '
+                   'which do not overlap' % (question, hazard_bbox,
+                                             exposure_bbox))
+            assert bbox_overlaps(hazard_bbox, exposure_bbox), msg
+
+    def test_cancelled_downloads(self):
+        """Remaining calls are cancelled once one of them fails
+        """
+
+        def fail_on_first(x):
+            if x == 0:
+                raise ValueError('Bad layer')
+            return x
+
+        cancel = threading.Event()
+        results = run_in_parallel(fail_on_first, [0, 1, 2], workers=1,
+                                  cancel=cancel)
+        assert cancel.is_set()
+        assert isinstance(results[0][1], ValueError)
+
+        # Errors keep the traceback of the worker thread
+        exc_info = results[0][1].exc_info
+        self.assertEqual(exc_info[1], results[0][1])
+        frames = traceback.extract_tb(exc_info[2])
+        self.assertEqual(frames[-1][2], 'fail_on_first')
+
+        for result, error in results[1:]:
+            assert result is None
+            assert isinstance(error, CancelledError)
+
+        # Downloads watching the event stop as well
+        thefile = os.path.join(UNITDATA, 'hazard', 'jakarta_flood_design.tif')
+        layer = save_to_geonode(thefile, user=self.user, overwrite=True)
+        bbox = get_bounding_box_string(thefile)
+        try:
+            download(INTERNAL_SERVER_URL, layer.typename, bbox, cancel=cancel)
+        except CancelledError:
+            pass
+        else:
+            msg = 'Download should have been cancelled'
+            raise Exception(msg)
+
+    def test_parallel_timeout(self):
+        """Calls without a worker limit all get the full timeout
+        """
+
+        def wait(seconds):
+            time.sleep(seconds)
+            return seconds
+
+        # One slow server does not hold up the others, however many
+        # there are
+        delays = [5] + [0.5] * 20
+        t0 = time.time()
+        results = run_in_parallel(wait, delays, timeout=2)
+        assert time.time() - t0 < 4
+
+        result, error = results[0]
+        assert result is None
+        assert isinstance(error, multiprocessing.TimeoutError)
+        for result, error in results[1:]:
+            self.assertEqual(result, 0.5)
+            assert error is None
 
     def test_plugin_selection(self):
         """Verify the plugins can recognize compatible layers.
@@ -474,6 +719,64 @@ class TestApi(LiveServerTestCase):
         hazard_compatible = requirements_met(requirements, hazard_params)
         assert hazard_compatible
 
+    def test_memoized_plugin_selection(self):
+        """Memoized plugin selection agrees with get_admissible_plugins
+        """
+
+        exposure = {'layertype': 'vector',
+                    'category': 'exposure',
+                    'subcategory': 'structure',
+                    'title': 'buildings_osm_4326',
+                    'datatype': 'osm',
+                    'purpose': 'dki'}
+        hazard = {'layertype': 'raster',
+                  'category': 'hazard',
+                  'subcategory': 'flood',
+                  'title': 'Jakarta flood like 2007',
+                  'resolution': '0.00045228819716',
+                  'unit': 'm'}
+
+        registry = get_plugin_registry_hash()
+        names = get_requirement_names()
+        assert 'category' in names
+        assert 'hazard' not in names
+
+        # Titles are not inspected by any requirement
+        other_hazard = hazard.copy()
+        other_hazard['title'] = 'Another flood'
+        msg = 'Expected layers differing by title to have the same signature'
+        assert (keyword_signature(hazard, names) ==
+                keyword_signature(other_hazard, names)), msg
+
+        hazard_plugins = get_admissible_plugin_names(
+            keyword_signature(hazard, names), hazard, registry)
+        exposure_plugins = get_admissible_plugin_names(
+            keyword_signature(exposure, names), exposure, registry)
+
+        ref_plugins = get_admissible_plugins(keywords=[hazard, exposure])
+        msg = ('Memoized plugins %s were not the same as %s'
+               % (hazard_plugins & exposure_plugins, ref_plugins.keys()))
+        assert hazard_plugins & exposure_plugins == set(ref_plugins), msg
+        assert 'Flood Building Impact Function' in ref_plugins
+
+        # Keywords that safe can not check admit what safe says they do,
+        # even when the keywords named in requirements are the same
+        for key, value in [('title', 'A "quoted" flood'),
+                           (' class', 'flood'),
+                           ('flood depth', 'm')]:
+            bad_hazard = hazard.copy()
+            bad_hazard[key] = value
+            signature = keyword_signature(bad_hazard, names)
+            msg = 'Expected keywords %s to have their own signature' % key
+            assert signature != keyword_signature(hazard, names), msg
+
+            bad_plugins = get_admissible_plugin_names(signature, bad_hazard,
+                                                      registry)
+            ref_plugins = get_admissible_plugins(keywords=bad_hazard)
+            msg = ('Memoized plugins %s were not the same as %s'
+                   % (bad_plugins, ref_plugins.keys()))
+            assert bad_plugins == set(ref_plugins), msg
+
 
     def test_plugin_selection_http(self):
         """Verify the plugins can recognize compatible layers (HTTP).
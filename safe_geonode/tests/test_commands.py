@@ -5,6 +5,8 @@ from django.test import LiveServerTestCase
 from safe.common.testing import UNITDATA
 from gisdata import BAD_DATA
 from safe_geonode import get_version
+from safe_geonode.models import LayerMetadata
+from safe_geonode.storage import INTERNAL_SERVER_URL, get_catalog_metadata
 
 class CommandsTestCase(LiveServerTestCase):
 
@@ -25,6 +27,17 @@ class CommandsTestCase(LiveServerTestCase):
         opts = {'verbosity': 0, 'ignore_errors': True}
         call_command('safeimportlayers', *args, **opts)
 
+    def test_safewarmcache(self):
+        "Test safewarmcache fills the layer catalog."
+        layer = os.path.join(UNITDATA, 'hazard', 'jakarta_flood_design.tif')
+        call_command('safeimportlayers', layer, verbosity=0)
+
+        call_command('safewarmcache', once=True, verbosity=0)
+
+        entries = LayerMetadata.objects.filter(server_url=INTERNAL_SERVER_URL)
+        assert entries.count() > 0
+        assert get_catalog_metadata(INTERNAL_SERVER_URL) is not None
+
     def test_version(self):
         "Test version can be obtained programatically."
         version = get_version()
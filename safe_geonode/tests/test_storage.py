@@ -1,22 +1,51 @@
 import os
 import time
+import shutil
 import unittest
 import numpy
 import urllib2
+import hashlib
 import tempfile
 import datetime
 import gisdata
 
+from safe_geonode import storage
+from safe_geonode import utilities
 from safe_geonode.storage import save_file_to_geonode as save_to_geonode
 from safe_geonode.storage import RisikoException
 from safe_geonode.storage import check_layer, assert_bounding_box_matches
 from safe_geonode.storage import get_bounding_box
 from safe_geonode.storage import download, get_metadata
 from safe_geonode.storage import read_layer
+from safe_geonode.storage import capabilities_cache_key
+from safe_geonode.storage import get_capabilities_metadata
+from safe_geonode.storage import get_layer_metadata
+from safe_geonode.storage import invalidate_capabilities
+from safe_geonode.storage import iter_capabilities
+from safe_geonode.storage import get_ows_metadata
+from safe_geonode.storage import get_file
+from safe_geonode.storage import get_layer_cache_stats
+from safe_geonode.storage import choose_format
+from safe_geonode.storage import iter_feature_pages
+from safe_geonode.storage import get_local_file
+from safe_geonode.models import LayerMetadata
 from safe_geonode.utilities import get_bounding_box_string
-from safe_geonode.utilities import bboxstring2list
+from safe_geonode.utilities import bboxstring2list, bboxlist2string
 from safe_geonode.utilities import unique_filename, LAYER_TYPES
 from safe_geonode.utilities import nanallclose
+from safe_geonode.utilities import CAPABILITIES_TEMPLATE
+from safe_geonode.utilities import WCS_TEMPLATE
+from safe_geonode.utilities import get_http_session, http_get
+from safe_geonode.utilities import is_server_reachable
+from safe_geonode.utilities import layer_file_exists
+from safe_geonode.utilities import scratch_space, get_scratch_dir
+from safe_geonode.utilities import make_scratch_dir, sweep_scratch_space
+from safe_geonode.utilities import run_in_parallel
+from safe_geonode.utilities import is_optimized_geotiff
+from safe_geonode.utilities import get_overview_levels
+from safe_geonode.utilities import is_on_pixel_grid
+from safe_geonode.utilities import is_on_geotransform_grid
+from safe_geonode.utilities import index_shapefile, clip_vector
 from safe_geonode.tests.utilities import TESTDATA, INTERNAL_SERVER_URL
 from safe_geonode.tests.utilities import get_web_page
 
@@ -34,9 +63,11 @@ from geonode.layers.utils import get_valid_layer_name
 from django.db import connection, transaction
 from django.test import LiveServerTestCase
 from django.conf import settings
+from django.core.cache import cache
 
 #---Jeff
 from owslib.wcs import WebCoverageService
+from osgeo import gdal
 
 
 # FIXME: Can go when OWSLib patch comes on line
@@ -751,6 +782,741 @@ class TestStorage(LiveServerTestCase):
 
         assert layer_appears_immediately, msg
 
+    def test_capabilities_cache(self):
+        """Capabilities are cached and invalidated after upload
+        """
+
+        thefile = os.path.join(UNITDATA, 'hazard', 'jakarta_flood_design.tif')
+        layer = save_to_geonode(thefile, user=self.user, overwrite=True)
+
+        # Metadata for all layers populates the cache
+        metadata = get_metadata(INTERNAL_SERVER_URL)
+        assert layer.typename in metadata
+
+        key = capabilities_cache_key(INTERNAL_SERVER_URL, 'wcs')
+        entry = cache.get(key)
+        msg = 'Expected capabilities for %s to be cached' % INTERNAL_SERVER_URL
+        assert entry is not None, msg
+        assert layer.typename in entry['metadata']
+
+        # Cached metadata is the same as freshly parsed metadata
+        cached = get_metadata(INTERNAL_SERVER_URL, layer.typename)
+        fresh = get_capabilities_metadata(INTERNAL_SERVER_URL, 'wcs',
+                                          refresh=True)[layer.typename]
+        assert cached == fresh
+
+        # Explicit invalidation removes the cached capabilities
+        invalidate_capabilities(INTERNAL_SERVER_URL)
+        assert cache.get(key) is None
+
+    def test_layer_metadata(self):
+        """Metadata for a single layer matches full capabilities
+        """
+
+        for filename in [os.path.join('hazard', 'jakarta_flood_design.tif'),
+                         os.path.join('exposure', 'buildings_osm_4326.shp')]:
+            thefile = os.path.join(UNITDATA, filename)
+            layer = save_to_geonode(thefile, user=self.user, overwrite=True)
+
+            metadata = get_layer_metadata(INTERNAL_SERVER_URL, layer.typename)
+            ref_metadata = get_capabilities_metadata(INTERNAL_SERVER_URL,
+                                                     'wcs', refresh=True)
+            ref_metadata.update(get_capabilities_metadata(INTERNAL_SERVER_URL,
+                                                          'wfs', refresh=True))
+            ref_metadata = ref_metadata[layer.typename]
+
+            for key in ['id', 'layertype', 'title', 'keywords',
+                        'server_url', 'tile_url']:
+                msg = ('Single layer metadata for %s was not as expected. '
+                       'I got %s == %s but expected %s'
+                       % (layer.typename, key, metadata[key],
+                          ref_metadata[key]))
+                assert metadata[key] == ref_metadata[key], msg
+
+            assert numpy.allclose(metadata['bounding_box'],
+                                  ref_metadata['bounding_box'])
+            if metadata['layertype'] == 'raster':
+                assert numpy.allclose(metadata['geotransform'],
+                                      ref_metadata['geotransform'])
+
+    def test_streaming_capabilities(self):
+        """Streamed capabilities agree with OWSLib
+        """
+
+        thefile = os.path.join(UNITDATA, 'hazard', 'jakarta_flood_design.tif')
+        layer = save_to_geonode(thefile, user=self.user, overwrite=True)
+
+        url = CAPABILITIES_TEMPLATE % (INTERNAL_SERVER_URL, 'wcs')
+        f = urllib2.urlopen(url)
+        records = dict([(record.id, record) for record in
+                        iter_capabilities(INTERNAL_SERVER_URL, 'wcs', f)])
+        f.close()
+
+        wcs = WebCoverageService(INTERNAL_SERVER_URL, version='1.0.0')
+        msg = ('Expected coverages %s but got %s' % (wcs.contents.keys(),
+                                                     records.keys()))
+        assert sorted(records.keys()) == sorted(wcs.contents.keys()), msg
+
+        coverage = wcs.contents[layer.typename]
+        record = records[layer.typename]
+        assert record.title == coverage.title
+        assert record.keywords == coverage.keywords
+        assert numpy.allclose(record.boundingBoxWGS84,
+                              coverage.boundingBoxWGS84)
+        assert record.grid.highlimits == coverage.grid.highlimits
+
+
+    def test_layer_catalog(self):
+        """Layer catalog follows GeoNode layers and agrees with OWS
+        """
+
+        thefile = os.path.join(UNITDATA, 'hazard', 'jakarta_flood_design.tif')
+        layer = save_to_geonode(thefile, user=self.user, overwrite=True)
+
+        # Verifying the upload stored the layer in the catalog
+        entries = LayerMetadata.objects.filter(server_url=INTERNAL_SERVER_URL,
+                                               name=layer.typename)
+        assert entries.count() == 1
+
+        # Saving the layer expires its entry without asking GeoServer
+        # and the next lookup stores it again
+        layer.save()
+        assert entries.count() == 0
+
+        metadata = get_metadata(INTERNAL_SERVER_URL, layer.typename)
+        assert entries.count() == 1
+        ref_metadata = get_ows_metadata(INTERNAL_SERVER_URL, layer.typename)
+        assert sorted(metadata.keys()) == sorted(ref_metadata.keys())
+        for key in ['id', 'layertype', 'title', 'keywords']:
+            msg = ('Catalog metadata for %s was not as expected. '
+                   'I got %s == %s but expected %s'
+                   % (layer.typename, key, metadata[key], ref_metadata[key]))
+            assert metadata[key] == ref_metadata[key], msg
+        assert numpy.allclose(metadata['bounding_box'],
+                              ref_metadata['bounding_box'])
+        assert numpy.allclose(metadata['geotransform'],
+                              ref_metadata['geotransform'])
+
+        # Storing unchanged metadata again keeps cached answers valid
+        revision = storage.get_catalog_revision()
+        storage.save_catalog_metadata(INTERNAL_SERVER_URL,
+                                      {layer.typename: metadata})
+        self.assertEqual(storage.get_catalog_revision(), revision)
+
+        changed = dict(metadata)
+        changed['title'] = 'Changed title'
+        storage.save_catalog_metadata(INTERNAL_SERVER_URL,
+                                      {layer.typename: changed})
+        assert storage.get_catalog_revision() != revision
+
+        # All layers are listed once the catalog has been synced
+        metadata = get_metadata(INTERNAL_SERVER_URL)
+        assert layer.typename in metadata
+
+        # Deleting the layer removes it from the catalog
+        layer.delete()
+        assert entries.count() == 0
+        metadata = get_metadata(INTERNAL_SERVER_URL)
+        assert layer.typename not in metadata
+
+    def test_get_file(self):
+        """Files are streamed to disk and service exceptions are caught
+        """
+
+        thefile = os.path.join(UNITDATA, 'hazard', 'jakarta_flood_design.tif')
+        layer = save_to_geonode(thefile, user=self.user, overwrite=True)
+        bbox = get_bounding_box_string(thefile)
+
+        url = WCS_TEMPLATE % (INTERNAL_SERVER_URL, layer.typename, bbox,
+                              0.01, 0.01)
+        filename = get_file(url, '.tif')
+        downloaded = read_layer(filename)
+        assert downloaded.get_data().shape[0] > 0
+
+        url = WCS_TEMPLATE % (INTERNAL_SERVER_URL, 'geonode:not_a_layer',
+                              bbox, 0.01, 0.01)
+        try:
+            get_file(url, '.tif')
+        except Exception, e:
+            msg = 'Unexpected error message: %s' % e
+            assert 'File download failed' in str(e), msg
+        else:
+            msg = 'Download of non existing layer should have failed'
+            raise Exception(msg)
+
+    def test_shared_http_session(self):
+        """HTTP requests share one session and health checks are cached
+        """
+
+        assert get_http_session() is get_http_session()
+
+        with http_get(INTERNAL_SERVER_URL) as response:
+            self.assertEqual(response.status_code, 200)
+
+        assert is_server_reachable(INTERNAL_SERVER_URL)
+        assert not is_server_reachable('http://localhost:1/geoserver/ows')
+
+        # The answer is remembered
+        key = 'safe-reachable-%s' % hashlib.md5(INTERNAL_SERVER_URL).hexdigest()
+        assert cache.get(key) is True
+
+    def test_layer_cache(self):
+        """Repeated downloads are served from the layer cache
+        """
+
+        thefile = os.path.join(UNITDATA, 'hazard', 'jakarta_flood_design.tif')
+        layer = save_to_geonode(thefile, user=self.user, overwrite=True)
+        bbox = get_bounding_box_string(thefile)
+
+        # Local layers are clipped from their files without the layer cache
+        use_local_files = storage.USE_LOCAL_FILES
+        storage.USE_LOCAL_FILES = False
+        try:
+            L1 = download(INTERNAL_SERVER_URL, layer.typename, bbox)
+            hits = get_layer_cache_stats()['hits']
+            L2 = download(INTERNAL_SERVER_URL, layer.typename, bbox)
+
+            self.assertEqual(get_layer_cache_stats()['hits'], hits + 1)
+            assert nanallclose(L1.get_data(), L2.get_data())
+            self.assertEqual(L1.get_keywords(), L2.get_keywords())
+
+            # Callers get their own links to the cached files
+            assert L1.filename != L2.filename
+            assert not L2.filename.startswith(storage.LAYER_CACHE_DIR)
+
+            # Uploading the layer again makes the cached copy obsolete
+            layer = save_to_geonode(thefile, user=self.user, overwrite=True)
+            L3 = download(INTERNAL_SERVER_URL, layer.typename, bbox)
+            self.assertEqual(get_layer_cache_stats()['hits'], hits + 1)
+
+            # Replacing the entry leaves earlier files readable
+            assert nanallclose(read_layer(L2.filename).get_data(),
+                               L3.get_data())
+
+            # Entries larger than the cache are kept until the next one
+            cache_size = storage.LAYER_CACHE_SIZE
+            storage.LAYER_CACHE_SIZE = 1
+            try:
+                layer = save_to_geonode(thefile, user=self.user,
+                                        overwrite=True)
+                L4 = download(INTERNAL_SERVER_URL, layer.typename, bbox)
+                hits = get_layer_cache_stats()['hits']
+                L5 = download(INTERNAL_SERVER_URL, layer.typename, bbox)
+            finally:
+                storage.LAYER_CACHE_SIZE = cache_size
+            self.assertEqual(get_layer_cache_stats()['hits'], hits + 1)
+            assert nanallclose(L4.get_data(), L5.get_data())
+        finally:
+            storage.USE_LOCAL_FILES = use_local_files
+
+    def test_crop_cached_raster(self):
+        """Rasters within a cached extent are cropped locally
+        """
+
+        thefile = os.path.join(UNITDATA, 'hazard', 'jakarta_flood_design.tif')
+        layer = save_to_geonode(thefile, user=self.user, overwrite=True)
+        bbox = bboxstring2list(get_bounding_box_string(thefile))
+
+        # Local layers are clipped from their files without the layer cache
+        use_local_files = storage.USE_LOCAL_FILES
+        storage.USE_LOCAL_FILES = False
+        try:
+            L = download(INTERNAL_SERVER_URL, layer.typename, bbox)
+            crops = get_layer_cache_stats()['crops']
+
+            # Request the central part of the raster
+            dx = (bbox[2] - bbox[0]) / 4
+            dy = (bbox[3] - bbox[1]) / 4
+            sub_bbox = [bbox[0] + dx, bbox[1] + dy,
+                        bbox[2] - dx, bbox[3] - dy]
+            C = download(INTERNAL_SERVER_URL, layer.typename, sub_bbox)
+            self.assertEqual(get_layer_cache_stats()['crops'], crops + 1)
+        finally:
+            storage.USE_LOCAL_FILES = use_local_files
+
+        # Bounding boxes on the cached grid are cut out without resampling
+        resolution = L.get_resolution()
+        origin_x, dx, _, origin_y, _, dy = L.get_geotransform()
+        aligned_bbox = [origin_x + 5 * dx, origin_y + 30 * dy,
+                        origin_x + 25 * dx, origin_y + 10 * dy]
+        assert is_on_pixel_grid(L.filename, aligned_bbox, [dx, -dy])
+        assert not is_on_pixel_grid(L.filename, sub_bbox, resolution)
+        self.assertEqual(C.get_keywords(), L.get_keywords())
+
+        storage.USE_LOCAL_FILES = False
+        try:
+            A = download(INTERNAL_SERVER_URL, layer.typename, aligned_bbox)
+            self.assertEqual(get_layer_cache_stats()['crops'], crops + 2)
+        finally:
+            storage.USE_LOCAL_FILES = use_local_files
+
+        # Both crops have the grid and the values GeoServer returns
+        for crop, crop_bbox in [(C, sub_bbox), (A, aligned_bbox)]:
+            url = WCS_TEMPLATE % (INTERNAL_SERVER_URL, layer.typename,
+                                  bboxlist2string(crop_bbox),
+                                  resolution[0], resolution[1])
+            R = read_layer(get_file(url, '.tif'))
+
+            self.assertEqual(crop.get_data().shape, R.get_data().shape)
+            assert numpy.allclose(crop.get_geotransform(),
+                                  R.get_geotransform(),
+                                  atol=1.0e-3 * min(resolution))
+            assert nanallclose(crop.get_data(), R.get_data())
+
+        # Cached rasters off the native grid are not resampled again
+        geotransform = list(L.get_geotransform())
+        assert is_on_geotransform_grid(L.filename, geotransform)
+        geotransform[0] += dx / 2
+        assert not is_on_geotransform_grid(L.filename, geotransform)
+
+    def test_tiled_raster_download(self):
+        """Large rasters downloaded as tiles match a single download
+        """
+
+        thefile = os.path.join(UNITDATA, 'hazard', 'jakarta_flood_design.tif')
+        layer = save_to_geonode(thefile, user=self.user, overwrite=True)
+        bbox = get_bounding_box_string(thefile)
+
+        # Download through GeoServer rather than clipping the local file
+        tile_size = storage.WCS_TILE_SIZE
+        cache_size = storage.LAYER_CACHE_SIZE
+        use_local_files = storage.USE_LOCAL_FILES
+        storage.LAYER_CACHE_SIZE = 0
+        storage.USE_LOCAL_FILES = False
+        try:
+            R = download(INTERNAL_SERVER_URL, layer.typename, bbox)
+            storage.WCS_TILE_SIZE = 50
+            T = download(INTERNAL_SERVER_URL, layer.typename, bbox)
+        finally:
+            storage.WCS_TILE_SIZE = tile_size
+            storage.LAYER_CACHE_SIZE = cache_size
+            storage.USE_LOCAL_FILES = use_local_files
+
+        msg = 'Expected more than one tile for raster of shape %s' % (
+            str(R.get_data().shape))
+        assert max(R.get_data().shape) > 50, msg
+
+        self.assertEqual(T.get_data().shape, R.get_data().shape)
+        assert numpy.allclose(T.get_geotransform(), R.get_geotransform())
+        assert nanallclose(T.get_data(), R.get_data())
+
+    def test_vector_download_without_extraction(self):
+        """Vector layers are read from the downloaded zip archive
+        """
+
+        thefile = os.path.join(UNITDATA, 'exposure', 'buildings_osm_4326.shp')
+        layer = save_to_geonode(thefile, user=self.user, overwrite=True)
+        bbox = get_bounding_box_string(thefile)
+        metadata = get_metadata(INTERNAL_SERVER_URL, layer.typename)
+
+        # Download through GeoServer rather than clipping the local file
+        formats = storage.WFS_FORMATS
+        use_local_files = storage.USE_LOCAL_FILES
+        storage.WFS_FORMATS = ['SHAPE-ZIP']
+        storage.USE_LOCAL_FILES = False
+        try:
+            V = download(INTERNAL_SERVER_URL, layer.typename, bbox)
+        finally:
+            storage.WFS_FORMATS = formats
+            storage.USE_LOCAL_FILES = use_local_files
+        assert V.filename.startswith('/vsizip/')
+        assert layer_file_exists(V.filename)
+
+        # Nothing was extracted next to the archive, only the keywords
+        # were written next to it
+        dirname = os.path.dirname(V.filename[len('/vsizip/'):])
+        self.assertEqual(sorted([os.path.splitext(x)[1]
+                                 for x in os.listdir(dirname)]),
+                         ['.keywords', '.zip'])
+
+        self.assertEqual(V.get_keywords(), metadata['keywords'])
+
+        # Layers served from the layer cache have them as well
+        storage.WFS_FORMATS = ['SHAPE-ZIP']
+        storage.USE_LOCAL_FILES = False
+        try:
+            hits = get_layer_cache_stats()['hits']
+            C = download(INTERNAL_SERVER_URL, layer.typename, bbox)
+        finally:
+            storage.WFS_FORMATS = formats
+            storage.USE_LOCAL_FILES = use_local_files
+        self.assertEqual(get_layer_cache_stats()['hits'], hits + 1)
+        assert C.filename.startswith('/vsizip/')
+        self.assertEqual(C.get_keywords(), metadata['keywords'])
+        R = read_layer(thefile)
+        self.assertEqual(len(V), len(R))
+
+    def test_vector_format_negotiation(self):
+        """Vector layers are downloaded in the preferred offered format
+        """
+
+        thefile = os.path.join(UNITDATA, 'exposure', 'buildings_osm_4326.shp')
+        layer = save_to_geonode(thefile, user=self.user, overwrite=True)
+        bbox = get_bounding_box_string(thefile)
+        metadata = get_metadata(INTERNAL_SERVER_URL, layer.typename)
+
+        assert 'SHAPE-ZIP' in metadata['formats']
+        self.assertEqual(choose_format(['NONSENSE', 'SHAPE-ZIP'],
+                                       metadata['formats']), 'SHAPE-ZIP')
+        self.assertEqual(choose_format(['GML2-GZIP', 'SHAPE-ZIP'], []),
+                         'SHAPE-ZIP')
+
+        # Shapefiles are downloaded unless GML is asked for
+        self.assertEqual(choose_format(storage.WFS_FORMATS,
+                                       metadata['formats']), 'SHAPE-ZIP')
+
+        if 'GML2-GZIP' in metadata['formats']:
+            # Download through GeoServer rather than clipping the local file
+            formats = storage.WFS_FORMATS
+            use_local_files = storage.USE_LOCAL_FILES
+            storage.WFS_FORMATS = ['GML2-GZIP', 'SHAPE-ZIP']
+            storage.USE_LOCAL_FILES = False
+            try:
+                V = download(INTERNAL_SERVER_URL, layer.typename, bbox)
+            finally:
+                storage.WFS_FORMATS = formats
+                storage.USE_LOCAL_FILES = use_local_files
+            self.assertEqual(os.path.splitext(V.filename)[1], '.gml')
+            self.assertEqual(V.get_keywords(), metadata['keywords'])
+
+            R = read_layer(thefile)
+            self.assertEqual(len(V), len(R))
+
+    def test_paged_vector_download(self):
+        """Vector layers can be downloaded one page of features at a time
+        """
+
+        thefile = os.path.join(UNITDATA, 'exposure', 'buildings_osm_4326.shp')
+        layer = save_to_geonode(thefile, user=self.user, overwrite=True)
+        bbox = get_bounding_box_string(thefile)
+        metadata = get_metadata(INTERNAL_SERVER_URL, layer.typename)
+        R = read_layer(thefile)
+
+        ids = []
+        for page in iter_feature_pages(INTERNAL_SERVER_URL, layer.typename,
+                                       bbox, formats=metadata['formats'],
+                                       page_size=100, sort_by='osm_id'):
+            assert page.GetFeatureCount() <= 100
+            feature = page.GetNextFeature()
+            while feature is not None:
+                ids.append(feature.GetField('osm_id'))
+                feature = page.GetNextFeature()
+        assert len(ids) > 100
+
+        # Sorted pages neither overlap nor miss features
+        self.assertEqual(len(set(ids)), len(ids))
+        self.assertEqual(len(ids), len(R))
+
+        # Without an attribute to sort by all features come in one page
+        counts = [page.GetFeatureCount() for page in
+                  iter_feature_pages(INTERNAL_SERVER_URL, layer.typename,
+                                     bbox, formats=metadata['formats'],
+                                     page_size=100)]
+        self.assertEqual(counts, [len(R)])
+
+        paging = storage.WFS_PAGING
+        page_size = storage.WFS_PAGE_SIZE
+        cache_size = storage.LAYER_CACHE_SIZE
+        sort_by = storage.WFS_PAGE_SORT_BY
+        use_local_files = storage.USE_LOCAL_FILES
+        storage.WFS_PAGING = True
+        storage.WFS_PAGE_SIZE = 100
+        storage.WFS_PAGE_SORT_BY = 'osm_id'
+        storage.LAYER_CACHE_SIZE = 0
+        storage.USE_LOCAL_FILES = False
+        try:
+            V = download(INTERNAL_SERVER_URL, layer.typename, bbox)
+        finally:
+            storage.WFS_PAGING = paging
+            storage.WFS_PAGE_SIZE = page_size
+            storage.WFS_PAGE_SORT_BY = sort_by
+            storage.LAYER_CACHE_SIZE = cache_size
+            storage.USE_LOCAL_FILES = use_local_files
+
+        self.assertEqual(len(V), len(R))
+        self.assertEqual(V.get_keywords(), metadata['keywords'])
+
+    def test_local_files(self):
+        """Local layers are clipped from their files like GeoServer would
+        """
+
+        use_local_files = storage.USE_LOCAL_FILES
+        cache_size = storage.LAYER_CACHE_SIZE
+        storage.USE_LOCAL_FILES = True
+        storage.LAYER_CACHE_SIZE = 0
+        try:
+            for name in ['hazard/jakarta_flood_design.tif',
+                         'exposure/buildings_osm_4326.shp']:
+                thefile = os.path.join(UNITDATA, name)
+                layer = save_to_geonode(thefile, user=self.user,
+                                        overwrite=True)
+                bbox = bboxstring2list(get_bounding_box_string(thefile))
+
+                # Request the central part of the layer
+                dx = (bbox[2] - bbox[0]) / 4
+                dy = (bbox[3] - bbox[1]) / 4
+                bbox = [bbox[0] + dx, bbox[1] + dy,
+                        bbox[2] - dx, bbox[3] - dy]
+
+                data_type = get_metadata(INTERNAL_SERVER_URL,
+                                         layer.typename)['layertype']
+                assert get_local_file(INTERNAL_SERVER_URL, layer.typename,
+                                      data_type) is not None
+                L = download(INTERNAL_SERVER_URL, layer.typename, bbox)
+
+                storage.USE_LOCAL_FILES = False
+                R = download(INTERNAL_SERVER_URL, layer.typename, bbox)
+                storage.USE_LOCAL_FILES = True
+
+                self.assertEqual(L.get_keywords(), R.get_keywords())
+                if data_type == 'raster':
+                    self.assertEqual(L.get_data().shape, R.get_data().shape)
+                    assert numpy.allclose(L.get_geotransform(),
+                                          R.get_geotransform())
+                    assert nanallclose(L.get_data(), R.get_data())
+                else:
+                    self.assertEqual(len(L), len(R))
+        finally:
+            storage.USE_LOCAL_FILES = use_local_files
+            storage.LAYER_CACHE_SIZE = cache_size
+
+        # Remote servers are never local
+        assert get_local_file('http://example.com/geoserver/ows',
+                              layer.typename, 'vector') is None
+
+    def test_raster_overviews(self):
+        """Uploaded rasters get overviews while the given file is unchanged
+        """
+
+        min_size = storage.OVERVIEW_MIN_SIZE
+        use_local_files = storage.USE_LOCAL_FILES
+        storage.OVERVIEW_MIN_SIZE = 16
+        storage.USE_LOCAL_FILES = True
+        try:
+            for name in ['jakarta_flood_design.tif']:
+                thefile = os.path.join(UNITDATA, 'hazard', name)
+                before = hashlib.md5(open(thefile, 'rb').read()).hexdigest()
+                layer = save_to_geonode(thefile, user=self.user,
+                                        overwrite=True)
+                after = hashlib.md5(open(thefile, 'rb').read()).hexdigest()
+                self.assertEqual(before, after)
+
+                uploaded = get_local_file(INTERNAL_SERVER_URL,
+                                          layer.typename, 'raster')
+                band = gdal.Open(uploaded).GetRasterBand(1)
+                assert band.GetOverviewCount() > 0
+
+                # Existing overviews are not built again
+                self.assertEqual(get_overview_levels(uploaded,
+                                                     storage.OVERVIEW_LEVELS,
+                                                     16), [])
+
+                # Coarse downloads match the layer at a coarse resolution
+                bbox = get_bounding_box_string(thefile)
+                R = read_layer(thefile)
+                resolution = [4 * x for x in R.get_resolution()]
+                L = download(INTERNAL_SERVER_URL, layer.typename, bbox,
+                             resolution=resolution)
+                assert numpy.allclose(L.get_resolution(), resolution,
+                                      rtol=1.0e-6)
+        finally:
+            storage.OVERVIEW_MIN_SIZE = min_size
+            storage.USE_LOCAL_FILES = use_local_files
+
+    def test_normalized_rasters(self):
+        """Uploaded rasters are stored as tiled and compressed GeoTIFFs
+        """
+
+        thefile = os.path.join(UNITDATA, 'hazard', 'jakarta_flood_design.tif')
+        layer = save_to_geonode(thefile, user=self.user, overwrite=True)
+
+        use_local_files = storage.USE_LOCAL_FILES
+        storage.USE_LOCAL_FILES = True
+        try:
+            uploaded = get_local_file(INTERNAL_SERVER_URL, layer.typename,
+                                      'raster')
+        finally:
+            storage.USE_LOCAL_FILES = use_local_files
+        assert is_optimized_geotiff(uploaded)
+        assert not is_optimized_geotiff(thefile)
+
+        # Data, nodata and keywords are kept
+        R = read_layer(thefile)
+        U = read_layer(uploaded)
+        assert nanallclose(R.get_data(), U.get_data())
+        assert numpy.allclose(R.get_geotransform(), U.get_geotransform())
+        self.assertEqual(gdal.Open(thefile).GetRasterBand(1).GetNoDataValue(),
+                         gdal.Open(uploaded).GetRasterBand(1).GetNoDataValue())
+
+        keywords = get_metadata(INTERNAL_SERVER_URL,
+                                layer.typename)['keywords']
+        for kw in R.get_keywords():
+            self.assertEqual(keywords[kw], R.get_keywords()[kw])
+
+    def test_memory_mapped_rasters(self):
+        """Downloaded rasters share their data through memory mapped files
+        """
+
+        thefile = os.path.join(UNITDATA, 'hazard', 'jakarta_flood_design.tif')
+        layer = save_to_geonode(thefile, user=self.user, overwrite=True)
+        bbox = get_bounding_box_string(thefile)
+
+        L1 = download(INTERNAL_SERVER_URL, layer.typename, bbox)
+        L2 = download(INTERNAL_SERVER_URL, layer.typename, bbox)
+        A1 = L1.band.ReadAsArray()
+        A2 = L2.band.ReadAsArray()
+        assert isinstance(A1, numpy.memmap)
+        self.assertEqual(A1.filename, A2.filename)
+
+        # The .npy file keeps the data type of the raster and is part of
+        # the cache entry counted against SAFE_LAYER_CACHE_SIZE
+        R = read_layer(L1.filename)
+        self.assertEqual(A1.dtype, R.band.ReadAsArray().dtype)
+        entries = [os.path.abspath(path) for _, _, path
+                   in storage.get_layer_cache_entries()]
+        assert os.path.dirname(A1.filename) in entries
+
+        # Data is the same as read from the raster file
+        for nan in [True, False, 0.0]:
+            D1 = L1.get_data(nan=nan)
+            D = R.get_data(nan=nan)
+            self.assertEqual(D1.dtype, D.dtype)
+            assert nanallclose(D1, D)
+
+        # One-off files outside the layer cache are not mapped
+        cache_size = storage.LAYER_CACHE_SIZE
+        storage.LAYER_CACHE_SIZE = 0
+        try:
+            L3 = download(INTERNAL_SERVER_URL, layer.typename, bbox)
+        finally:
+            storage.LAYER_CACHE_SIZE = cache_size
+        assert not isinstance(L3.band.ReadAsArray(), numpy.memmap)
+        assert nanallclose(L3.get_data(), R.get_data())
+
+    def test_vector_indexes(self):
+        """Uploaded shapefiles get spatial and attribute indexes
+        """
+
+        thefile = os.path.join(UNITDATA, 'exposure', 'buildings_osm_4326.shp')
+        dirname = os.path.dirname(thefile)
+        before = sorted(os.listdir(dirname))
+
+        use_local_files = storage.USE_LOCAL_FILES
+        storage.USE_LOCAL_FILES = True
+        try:
+            stats = []
+            for i in range(2):
+                # Indexes are built again when the layer is overwritten
+                layer = save_to_geonode(thefile, user=self.user,
+                                        overwrite=True)
+                uploaded = get_local_file(INTERNAL_SERVER_URL,
+                                          layer.typename, 'vector')
+                basename = os.path.splitext(uploaded)[0]
+                assert os.path.isfile(basename + '.qix')
+                assert os.path.isfile(basename + '.ind')
+                stat = os.stat(basename + '.qix')
+                stats.append((stat.st_ino, stat.st_mtime))
+            assert stats[0] != stats[1]
+
+            # The rebuilt index finds the features of the second upload
+            bbox = bboxstring2list(get_bounding_box_string(thefile))
+            clipped = os.path.join(make_scratch_dir(), 'clipped.shp')
+            self.assertEqual(clip_vector(uploaded, bbox, clipped),
+                             len(read_layer(thefile)))
+        finally:
+            storage.USE_LOCAL_FILES = use_local_files
+
+        # The given files are left alone
+        self.assertEqual(sorted(os.listdir(dirname)), before)
+
+        # Attributes are indexed if the shapefile has them
+        tmpdir = tempfile.mkdtemp()
+        try:
+            copy = storage.copy_layer_files(thefile, tmpdir)
+            fields = index_shapefile(copy, ['TYPE', 'no_such_field'])
+            self.assertEqual([x.lower() for x in fields], ['type'])
+            assert os.path.isfile(os.path.splitext(copy)[0] + '.qix')
+
+            # Indexes are replaced without leaving temporary files behind
+            # and those of attributes no longer indexed are removed
+            files = sorted(os.listdir(tmpdir))
+            self.assertEqual(index_shapefile(copy), [])
+            self.assertEqual(sorted(os.listdir(tmpdir)),
+                             [x for x in files
+                              if os.path.splitext(x)[1] not in
+                              ['.ind', '.idm']])
+
+            # Filtered reads find the same features with the index
+            bbox = bboxstring2list(get_bounding_box_string(thefile))
+            clipped = os.path.join(tmpdir, 'clipped.shp')
+            self.assertEqual(clip_vector(copy, bbox, clipped),
+                             len(read_layer(thefile)))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_scratch_space(self):
+        """Temporary files are kept per request or job and cleaned up
+        """
+
+        # Files of a job and its worker threads share one directory
+        # which is removed when the job ends
+        with scratch_space():
+            root = get_scratch_dir()
+            dirname = make_scratch_dir()
+            filename = unique_filename(suffix='.tif')
+            workers = run_in_parallel(lambda x: get_scratch_dir(), [1, 2])
+            assert os.path.dirname(dirname) == root
+            assert os.path.dirname(filename) == root
+            assert [(root, None), (root, None)] == workers
+
+            # Converted ASCII grids do not leave anything behind
+            f = os.path.join(TESTDATA, 'test_grid.asc')
+            save_to_geonode(f, user=self.user)
+            self.assertEqual(os.listdir(root), [os.path.basename(dirname)])
+        assert not os.path.exists(root)
+
+        # Work outside of any scope shares a default directory whose
+        # abandoned entries are swept
+        dirname = make_scratch_dir()
+        other_dirname = make_scratch_dir()
+        root = os.path.dirname(dirname)
+        self.assertEqual(os.path.dirname(other_dirname), root)
+        old = time.time() - utilities.SCRATCH_MAX_AGE - 1
+        os.utime(dirname, (old, old))
+        sweep_scratch_space()
+        assert not os.path.exists(dirname)
+        assert os.path.exists(other_dirname)
+        shutil.rmtree(other_dirname)
+
+        # Abandoned scope directories are swept
+        with scratch_space():
+            root = get_scratch_dir()
+            os.utime(root, (old, old))
+            sweep_scratch_space()
+            assert not os.path.exists(root)
+
+        # Scratch space is swept at most once per interval
+        dirname = make_scratch_dir()
+        os.utime(dirname, (old, old))
+        utilities.get_scratch_usage(force=True)
+        assert not os.path.exists(dirname)
+        dirname = make_scratch_dir()
+        os.utime(dirname, (old, old))
+        utilities.get_scratch_usage()
+        assert os.path.exists(dirname)
+        shutil.rmtree(dirname)
+
+        # Scratch space is not handed out beyond the quota
+        quota = utilities.SCRATCH_QUOTA
+        dirname = make_scratch_dir()
+        open(os.path.join(dirname, 'data'), 'w').write('x' * 100)
+        utilities.SCRATCH_QUOTA = 50
+        try:
+            with scratch_space():
+                self.assertRaises(Exception, make_scratch_dir)
+        finally:
+            utilities.SCRATCH_QUOTA = quota
+            shutil.rmtree(dirname)
 
     def test_geotransform_from_geonode(self):
         """Geotransforms of GeoNode layers can be correctly determined
@@ -2,15 +2,33 @@
 """
 
 import os
+import sys
 import copy
+import time
 import numpy
 import math
+import errno
+import shutil
+import socket
+import bisect
+import hashlib
 import logging
-
-from osgeo import ogr
-from tempfile import mkstemp
-from urllib2 import urlopen
+import urlparse
+import requests
+import threading
+import contextlib
+
+from osgeo import ogr, osr, gdal, gdal_array
+from zipfile import ZipFile
+from tempfile import mkstemp, mkdtemp, gettempdir
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
 from safe.api import read_layer
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
 
 
 logger = logging.getLogger(__name__)
@@ -34,6 +52,10 @@ TYPE_MAP = {type(None): ogr.OFTString,  # What else should this be?
             type(numpy.array([0.0])[0]): ogr.OFTReal,  # numpy.float64
             type(numpy.array([[0.0]])[0]): ogr.OFTReal}  # numpy.ndarray
 
+# Extensions of spatial (.qix) and attribute (.ind, .idm) index files of
+# shapefiles
+SHAPEFILE_INDEX_TYPES = ['.qix', '.ind', '.idm']
+
 # Templates for downloading layers through rest
 WCS_TEMPLATE = '%s?version=1.0.0' + \
     '&service=wcs&request=getcoverage&format=GeoTIFF&' + \
@@ -42,18 +64,73 @@ WCS_TEMPLATE = '%s?version=1.0.0' + \
 
 WFS_TEMPLATE = '%s?service=WFS&version=1.0.0' + \
     '&request=GetFeature&typeName=%s' + \
-    '&outputFormat=SHAPE-ZIP&bbox=%s'
+    '&outputFormat=%s&bbox=%s'
+
+CAPABILITIES_TEMPLATE = '%s?service=%s&version=1.0.0&request=GetCapabilities'
+
+DESCRIBE_COVERAGE_TEMPLATE = '%s?service=wcs&version=1.0.0' + \
+    '&request=DescribeCoverage&coverage=%s'
+
+# Number of connections kept alive per host by the shared HTTP session
+HTTP_POOL_SIZE = getattr(settings, 'SAFE_HTTP_POOL_SIZE', 10)
+
+# Number of times failed HTTP requests are retried and the backoff factor
+# in seconds between retries (doubles with every retry)
+HTTP_RETRIES = getattr(settings, 'SAFE_HTTP_RETRIES', 3)
+HTTP_BACKOFF_FACTOR = getattr(settings, 'SAFE_HTTP_BACKOFF_FACTOR', 0.5)
+
+# Maximal number of concurrent requests to the same host
+HTTP_HOST_CONCURRENCY = getattr(settings, 'SAFE_HTTP_HOST_CONCURRENCY', 8)
+
+# Seconds to wait for a server in health checks and to remember the answer
+HEALTH_CHECK_TIMEOUT = getattr(settings, 'SAFE_HEALTH_CHECK_TIMEOUT', 10)
+HEALTH_CHECK_INTERVAL = getattr(settings, 'SAFE_HEALTH_CHECK_INTERVAL', 60)
+
+# Per process HTTP session and per host semaphores, created on first use
+HTTP_CLIENT = {'session': None,
+               'hosts': {},
+               'held': threading.local(),
+               'lock': threading.Lock()}
+
+# Directory for temporary files of downloads and conversions
+SCRATCH_DIR = getattr(settings, 'SAFE_SCRATCH_DIR',
+                      os.path.join(gettempdir(), 'safe-scratch'))
+
+# Maximal number of bytes in SAFE_SCRATCH_DIR on this node
+SCRATCH_QUOTA = getattr(settings, 'SAFE_SCRATCH_QUOTA', 5 * 1024 ** 3)
+
+# Seconds after which abandoned scratch directories are removed
+SCRATCH_MAX_AGE = getattr(settings, 'SAFE_SCRATCH_MAX_AGE', 6 * 3600)
+
+# Minimal number of seconds between sweeps of SAFE_SCRATCH_DIR by a process
+SCRATCH_SWEEP_INTERVAL = getattr(settings, 'SAFE_SCRATCH_SWEEP_INTERVAL', 60)
+
+# Per thread stack of scratch scopes, see scratch_space
+SCRATCH = threading.local()
+
+# Per process scratch scope of work outside any request or job and the
+# time and result of the last sweep, see get_scratch_dir and
+# get_scratch_usage
+SCRATCH_DEFAULT = {'scope': {'path': None, 'lock': threading.Lock()},
+                   'swept': None,
+                   'usage': 0,
+                   'lock': threading.Lock()}
 
 
 # Miscellaneous auxiliary functions
 def unique_filename(**kwargs):
     """Create new filename guaranteed not to exist previoously
 
-    Use mkstemp to create the file, then remove it and return the name
+    Use mkstemp to create the file, then remove it and return the name.
+    Unless keyword argument dir is given, the name is in the scratch
+    directory of the current request or job, see scratch_space.
 
     See http://docs.python.org/library/tempfile.html for details.
     """
 
+    if 'dir' not in kwargs:
+        kwargs['dir'] = get_scratch_dir()
+
     _, filename = mkstemp(**kwargs)
 
     try:
@@ -64,18 +141,497 @@ def unique_filename(**kwargs):
     return filename
 
 
+def get_scratch_scopes():
+    """Get stack of scratch scopes of the current thread
+    """
+
+    if not hasattr(SCRATCH, 'scopes'):
+        SCRATCH.scopes = []
+    return SCRATCH.scopes
+
+
+def new_scratch_scope():
+    """Create scratch scope whose directory is made on first use
+    """
+
+    return {'path': None, 'lock': threading.Lock()}
+
+
+def remove_scratch_scope(scope):
+    """Remove directory of scratch scope with everything in it
+    """
+
+    with scope['lock']:
+        if scope['path'] is not None:
+            shutil.rmtree(scope['path'], ignore_errors=True)
+            scope['path'] = None
+
+
+@contextlib.contextmanager
+def scratch_space(scope=None):
+    """Keep temporary files of a request or job in a directory of its own
+
+    Input
+        scope: Optional scope yielded by an enclosing scratch_space. Used
+               to share the directory of a job with its worker threads,
+               it is not removed when the block exits.
+
+    Output
+        scope: Scope of the block
+
+    Files made by make_scratch_dir and unique_filename within the block
+    are created in the directory of the scope, which is removed with
+    everything in it when the block that created the scope exits.
+    """
+
+    owner = scope is None
+    if owner:
+        scope = new_scratch_scope()
+
+    scopes = get_scratch_scopes()
+    scopes.append(scope)
+    try:
+        yield scope
+    finally:
+        if scope in scopes:
+            scopes.remove(scope)
+        if owner:
+            remove_scratch_scope(scope)
+
+
+def current_scratch_scope():
+    """Get innermost scratch scope of the current thread or None
+    """
+
+    scopes = get_scratch_scopes()
+    if len(scopes) == 0:
+        return None
+    return scopes[-1]
+
+
+def open_request_scratch_space(sender, **kwargs):
+    """Start scratch scope of a request (connected to request_started)
+    """
+
+    scope = new_scratch_scope()
+    scope['request'] = True
+    get_scratch_scopes().append(scope)
+
+
+def close_request_scratch_space(sender, **kwargs):
+    """Remove scratch scope of a request (connected to request_finished)
+
+    Scopes left open inside the request are removed as well.
+    """
+
+    scopes = get_scratch_scopes()
+    if not [scope for scope in scopes if scope.get('request')]:
+        return
+
+    while scopes:
+        scope = scopes.pop()
+        remove_scratch_scope(scope)
+        if scope.get('request'):
+            break
+
+
+def get_scratch_usage(force=False):
+    """Get number of bytes used in SAFE_SCRATCH_DIR
+
+    Input
+        force: If True, sweep scratch space in any case
+
+    Output
+        usage: Number of bytes found by the last sweep
+
+    Scratch space is swept at most every SAFE_SCRATCH_SWEEP_INTERVAL
+    seconds by a process unless force is True.
+    """
+
+    with SCRATCH_DEFAULT['lock']:
+        swept = SCRATCH_DEFAULT['swept']
+        if (force or swept is None or
+            time.time() - swept >= SCRATCH_SWEEP_INTERVAL):
+            SCRATCH_DEFAULT['usage'] = sweep_scratch_space()
+            SCRATCH_DEFAULT['swept'] = time.time()
+        return SCRATCH_DEFAULT['usage']
+
+
+def make_scratch_root(prefix='scope-'):
+    """Create directory directly in SAFE_SCRATCH_DIR
+
+    The name records host and process id so directories of processes
+    that died can be swept. An exception is raised if SAFE_SCRATCH_QUOTA
+    is exceeded, see get_scratch_usage.
+    """
+
+    if not os.path.isdir(SCRATCH_DIR):
+        try:
+            os.makedirs(SCRATCH_DIR)
+        except OSError:
+            # Created by another process in the meantime
+            pass
+
+    usage = get_scratch_usage()
+    if usage > SCRATCH_QUOTA:
+        # Space may have been freed since the last sweep
+        usage = get_scratch_usage(force=True)
+    if usage > SCRATCH_QUOTA:
+        msg = ('Scratch space %s uses %i bytes which exceeds the quota '
+               'of %i bytes given by SAFE_SCRATCH_QUOTA'
+               % (SCRATCH_DIR, usage, SCRATCH_QUOTA))
+        raise Exception(msg)
+
+    prefix = '%s%s-%i-' % (prefix, socket.gethostname(), os.getpid())
+    return mkdtemp(prefix=prefix, dir=SCRATCH_DIR)
+
+
+def get_scratch_dir():
+    """Get scratch directory of the current request or job
+
+    Output
+        path: Directory of the innermost scratch scope, created on first
+              use. Outside of any scope the directory of a default scope
+              of the process is used. Entries in it are removed by
+              sweep_scratch_space once they are older than
+              SAFE_SCRATCH_MAX_AGE.
+    """
+
+    scope = current_scratch_scope()
+    prefix = 'scope-'
+    if scope is None:
+        scope = SCRATCH_DEFAULT['scope']
+        prefix = 'default-'
+
+    with scope['lock']:
+        if scope['path'] is None or not os.path.isdir(scope['path']):
+            scope['path'] = make_scratch_root(prefix=prefix)
+        return scope['path']
+
+
+def make_scratch_dir():
+    """Create new uniquely named directory for temporary files
+
+    Output
+        path: New directory in the scratch directory of the current
+              request or job, see get_scratch_dir
+    """
+
+    return mkdtemp(dir=get_scratch_dir())
+
+
+def is_process_alive(pid):
+    """Check if process with given id exists on this host
+    """
+
+    try:
+        os.kill(pid, 0)
+    except OSError, e:
+        return e.errno == errno.EPERM
+    return True
+
+
+def get_path_size(path):
+    """Get number of bytes in file or directory tree
+    """
+
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+
+    size = 0
+    for dirpath, _, filenames in os.walk(path):
+        for name in filenames:
+            try:
+                size += os.path.getsize(os.path.join(dirpath, name))
+            except OSError:
+                # Removed in the meantime
+                pass
+    return size
+
+
+def sweep_scratch_space():
+    """Remove abandoned entries from SAFE_SCRATCH_DIR
+
+    Entries are removed if they are older than SAFE_SCRATCH_MAX_AGE or
+    were made by a process on this host that no longer runs. Entries in
+    the directory of the default scope of this process are removed once
+    they are older than SAFE_SCRATCH_MAX_AGE.
+
+    Output
+        usage: Number of bytes used by the remaining entries
+    """
+
+    if not os.path.isdir(SCRATCH_DIR):
+        return 0
+
+    default_path = SCRATCH_DEFAULT['scope']['path']
+    if default_path is not None and os.path.isdir(default_path):
+        for name in os.listdir(default_path):
+            path = os.path.join(default_path, name)
+            try:
+                if time.time() - os.path.getmtime(path) > SCRATCH_MAX_AGE:
+                    if os.path.isdir(path):
+                        shutil.rmtree(path, ignore_errors=True)
+                    else:
+                        os.remove(path)
+            except OSError:
+                # Removed by another thread in the meantime
+                continue
+
+    hostname = socket.gethostname()
+    usage = 0
+    for name in os.listdir(SCRATCH_DIR):
+        path = os.path.join(SCRATCH_DIR, name)
+        try:
+            abandoned = time.time() - os.path.getmtime(path) > SCRATCH_MAX_AGE
+
+            fields = name.split('-')
+            if len(fields) >= 4 and '-'.join(fields[1:-2]) == hostname:
+                try:
+                    pid = int(fields[-2])
+                except ValueError:
+                    pass
+                else:
+                    abandoned = abandoned or not is_process_alive(pid)
+
+            if abandoned:
+                if os.path.isdir(path):
+                    shutil.rmtree(path, ignore_errors=True)
+                else:
+                    os.remove(path)
+            else:
+                usage += get_path_size(path)
+        except OSError:
+            # Removed by another process in the meantime
+            continue
+
+    return usage
+
+
+class CancelledError(Exception):
+    """Raised by work that was stopped because other work failed
+    """
+    pass
+
+
+def run_in_parallel(function, arguments, workers=None, timeout=None,
+                    cancel=None):
+    """Call function once for every argument using a pool of threads
+
+    Input
+        function: Callable taking exactly one argument
+        arguments: List of arguments to call function with
+        workers: Maximal number of concurrent calls.
+                 If None, all calls are made concurrently.
+        timeout: Number of seconds to wait for all calls to finish,
+                 counted from the start of run_in_parallel for all calls
+                 together. Calls still queued for a worker use up the
+                 same time, so give every call a worker if each call is
+                 to get the full timeout. If None, wait until every call
+                 has finished.
+        cancel: Optional threading.Event. It is set as soon as a call
+                fails and calls that have not started by then are skipped
+                with a CancelledError. Running calls may watch the event
+                to stop early.
+
+    Output
+        results: List of 2-tuples (result, error), one per argument and in
+                 the same order. error is None if the call succeeded and
+                 otherwise the exception raised by the call. Calls still
+                 running after timeout get a multiprocessing.TimeoutError.
+                 Their threads can not be stopped and run on until the
+                 calls return, e.g. when HTTP requests time out.
+                 Errors have an attribute exc_info with the sys.exc_info()
+                 of the failed call, so they can be raised again with the
+                 traceback of the worker thread:
+
+                 raise error.exc_info[0], error.exc_info[1], error.exc_info[2]
+    """
+
+    if len(arguments) == 0:
+        return []
+
+    if workers is None:
+        workers = len(arguments)
+
+    # Temporary files of the calls belong to the caller's request or job
+    scope = current_scratch_scope()
+    if scope is not None:
+        def scoped(argument):
+            with scratch_space(scope):
+                return function(argument)
+    else:
+        scoped = function
+
+    # Django opens a database connection per thread. Close those of the
+    # pool threads, which would otherwise be left open when they exit.
+    def closing(argument):
+        try:
+            return scoped(argument)
+        finally:
+            connection.close()
+
+    if cancel is not None:
+        def call(argument):
+            if cancel.is_set():
+                raise CancelledError('Call was cancelled')
+            try:
+                return closing(argument)
+            except:
+                cancel.set()
+                raise
+    else:
+        call = closing
+
+    def capture(argument):
+        try:
+            return call(argument)
+        except:
+            # The traceback is lost once the pool hands the error over
+            exc_info = sys.exc_info()
+            exc_info[1].exc_info = exc_info
+            raise
+
+    pool = ThreadPool(min(workers, len(arguments)))
+    try:
+        pending = [pool.apply_async(capture, (argument,))
+                   for argument in arguments]
+    finally:
+        pool.close()
+
+    if timeout is not None:
+        deadline = time.time() + timeout
+
+    results = []
+    for async_result in pending:
+        if timeout is None:
+            async_result.wait()
+        else:
+            async_result.wait(max(0, deadline - time.time()))
+
+        if not async_result.ready():
+            msg = 'Call did not finish within %s seconds' % timeout
+            error = TimeoutError(msg)
+            error.exc_info = (TimeoutError, error, None)
+            results.append((None, error))
+            continue
+
+        try:
+            results.append((async_result.get(), None))
+        except Exception, e:
+            results.append((None, e))
+
+    # Calls that timed out are left to finish in the background
+    return results
+
+
+def get_http_session():
+    """Get the HTTP session shared by all threads of this process
+
+    The session keeps connections alive in a pool per host and retries
+    failed requests with exponential backoff.
+    """
+
+    with HTTP_CLIENT['lock']:
+        if HTTP_CLIENT['session'] is None:
+            retry = Retry(total=HTTP_RETRIES,
+                          backoff_factor=HTTP_BACKOFF_FACTOR,
+                          status_forcelist=[502, 503, 504])
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE,
+                                  pool_maxsize=HTTP_POOL_SIZE,
+                                  max_retries=retry)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            HTTP_CLIENT['session'] = session
+
+    return HTTP_CLIENT['session']
+
+
+@contextlib.contextmanager
+def host_slot(url):
+    """Limit number of concurrent requests to the host of url
+
+    At most SAFE_HTTP_HOST_CONCURRENCY requests are made to the same host
+    at the same time. A thread that already holds a slot for the host,
+    e.g. while it parses a response that leads to further requests,
+    does not need another one.
+    """
+
+    host = urlparse.urlsplit(url).netloc
+    with HTTP_CLIENT['lock']:
+        if host not in HTTP_CLIENT['hosts']:
+            HTTP_CLIENT['hosts'][host] = threading.BoundedSemaphore(
+                HTTP_HOST_CONCURRENCY)
+        semaphore = HTTP_CLIENT['hosts'][host]
+
+    held = HTTP_CLIENT['held']
+    if not hasattr(held, 'hosts'):
+        held.hosts = set()
+
+    if host in held.hosts:
+        yield
+        return
+
+    with semaphore:
+        held.hosts.add(host)
+        try:
+            yield
+        finally:
+            held.hosts.discard(host)
+
+
+@contextlib.contextmanager
+def http_get(url, headers=None, timeout=None):
+    """Get url through the shared HTTP session
+
+    Input
+        url: URL to get
+        headers: Optional dictionary of request headers
+        timeout: Optional socket timeout in seconds
+
+    Output
+        Streamed requests.Response. Its raw attribute is a file like
+        object with the decoded body. The response is closed on exit.
+
+    Use as
+        with http_get(url) as response:
+            ...
+    """
+
+    with host_slot(url):
+        response = get_http_session().get(url, headers=headers,
+                                          timeout=timeout, stream=True)
+        try:
+            response.raw.decode_content = True
+            yield response
+        finally:
+            response.close()
+
+
 # GeoServer utility functions
 def is_server_reachable(url):
     """Make an http connection to url to see if it is accesible.
 
        Returns boolean
+
+       The answer is cached for SAFE_HEALTH_CHECK_INTERVAL seconds.
     """
-    try:
-        urlopen(url)
-    except Exception:
-        return False
-    else:
-        return True
+
+    key = 'safe-reachable-%s' % hashlib.md5(url).hexdigest()
+    reachable = cache.get(key)
+    if reachable is None:
+        try:
+            with http_get(url, timeout=HEALTH_CHECK_TIMEOUT) as response:
+                response.raise_for_status()
+        except Exception, e:
+            logger.debug('Server %s is not reachable: %s' % (url, e))
+            reachable = False
+        else:
+            reachable = True
+        cache.set(key, reachable, HEALTH_CHECK_INTERVAL)
+
+    return reachable
 
 
 def write_keywords(keywords, filename):
@@ -271,6 +827,69 @@ def bbox_intersection(*args):
         return None
 
 
+def bbox_overlaps(bbox, other_bbox):
+    """Check if two bounding boxes overlap
+
+    Input
+        bbox, other_bbox: Bounding boxes of the form [W, S, E, N]
+
+    Output
+        True if bbox_intersection of the two boxes would not be None.
+        Boxes without area (e.g. single points) never overlap and neither
+        do missing boxes, e.g. of layers without a bounding box.
+    """
+
+    if bbox is None or other_bbox is None:
+        return False
+
+    return (max(bbox[0], other_bbox[0]) < min(bbox[2], other_bbox[2]) and
+            max(bbox[1], other_bbox[1]) < min(bbox[3], other_bbox[3]))
+
+
+class BoundingBoxIndex(object):
+    """Index of named bounding boxes to find the ones overlapping a given box
+
+    Boxes are kept sorted by their western boundary, so a query only looks
+    at boxes whose western boundary is within the widest box of the query.
+    """
+
+    def __init__(self, items):
+        """Build index
+
+        Input
+            items: Sequence of (name, bbox) with bbox of the form [W, S, E, N]
+                   Items whose bbox is None overlap nothing and are left out.
+        """
+
+        self.entries = sorted([(bbox[0], name, bbox) for name, bbox in items
+                               if bbox is not None])
+        self.wests = [entry[0] for entry in self.entries]
+        self.max_width = max([0] + [bbox[2] - bbox[0]
+                                    for _, _, bbox in self.entries])
+
+    def __len__(self):
+        return len(self.entries)
+
+    def query(self, bbox):
+        """Get names of indexed boxes overlapping bbox
+
+        Input
+            bbox: Bounding box of the form [W, S, E, N] or None
+
+        Output
+            List of names ordered by the western boundary of their box
+        """
+
+        if bbox is None:
+            return []
+
+        start = bisect.bisect_right(self.wests, bbox[0] - self.max_width)
+        end = bisect.bisect_left(self.wests, bbox[2])
+
+        return [name for _, name, other_bbox in self.entries[start:end]
+                if bbox_overlaps(bbox, other_bbox)]
+
+
 def buffered_bounding_box(bbox, resolution):
     """Grow bounding box with one unit of resolution in each direction
 
@@ -622,6 +1241,683 @@ def bboxstring2list(bbox_string):
     return [float(x) for x in fields]
 
 
+def crop_raster(filename, bbox, cropped_filename):
+    """Write the part of a raster covering a bounding box to a GeoTIFF file
+
+    Input
+        filename: Name of raster file in geographic coordinates
+        bbox: Bounding box [W, S, E, N] within the extent of the raster
+        cropped_filename: Name of GeoTIFF file to create
+
+    Only the window of pixels covering bbox is read. The window is
+    aligned with the pixels of the source, so its edges may differ from
+    bbox by up to half a pixel.
+    """
+
+    source = gdal.Open(filename)
+    msg = 'Could not open raster file %s' % filename
+    assert source is not None, msg
+
+    geotransform = source.GetGeoTransform()
+    origin_x, dx, _, origin_y, _, dy = geotransform
+
+    # Window of pixels in the source
+    xoff = max(0, int(round((bbox[0] - origin_x) / dx)))
+    yoff = max(0, int(round((bbox[3] - origin_y) / dy)))
+    xend = min(source.RasterXSize, int(round((bbox[2] - origin_x) / dx)))
+    yend = min(source.RasterYSize, int(round((bbox[1] - origin_y) / dy)))
+    xsize = max(1, xend - xoff)
+    ysize = max(1, yend - yoff)
+
+    driver = gdal.GetDriverByName('GTiff')
+    cropped = driver.Create(cropped_filename, xsize, ysize,
+                            source.RasterCount,
+                            source.GetRasterBand(1).DataType)
+    cropped.SetProjection(source.GetProjection())
+    cropped.SetGeoTransform((origin_x + xoff * dx, dx, geotransform[2],
+                             origin_y + yoff * dy, geotransform[4], dy))
+
+    for i in range(1, source.RasterCount + 1):
+        band = source.GetRasterBand(i)
+        cropped_band = cropped.GetRasterBand(i)
+
+        nodata = band.GetNoDataValue()
+        if nodata is not None:
+            cropped_band.SetNoDataValue(nodata)
+
+        cropped_band.WriteArray(band.ReadAsArray(xoff, yoff, xsize, ysize))
+
+    # Close datasets to flush the new file to disk
+    cropped = None
+    source = None
+
+
+def is_on_pixel_grid(filename, bbox, resolution, tolerance=1.0e-3):
+    """Check if a bounding box and resolution fit the pixel grid of a raster
+
+    Input
+        filename: Name of raster file in geographic coordinates
+        bbox: Bounding box [W, S, E, N]
+        resolution: Requested pixel size (resx, resy)
+        tolerance: Allowed deviation as a fraction of a pixel
+
+    Output
+        True if the edges of bbox are pixel edges of the raster and the
+        raster has as many pixels across bbox as a WCS request for bbox
+        and resolution returns, so cropping gives the requested grid.
+    """
+
+    source = gdal.Open(filename)
+    msg = 'Could not open raster file %s' % filename
+    assert source is not None, msg
+
+    origin_x, dx, rotation_x, origin_y, rotation_y, dy = \
+        source.GetGeoTransform()
+    source = None
+
+    if rotation_x != 0 or rotation_y != 0:
+        return False
+
+    # Positions of the edges of bbox in pixels
+    edges = [(bbox[0] - origin_x) / dx, (bbox[2] - origin_x) / dx,
+             (bbox[3] - origin_y) / dy, (bbox[1] - origin_y) / dy]
+    for edge in edges:
+        if abs(edge - round(edge)) > tolerance:
+            return False
+
+    ncols = int(round((bbox[2] - bbox[0]) / resolution[0]))
+    nrows = int(round((bbox[3] - bbox[1]) / resolution[1]))
+    return (int(round(edges[1] - edges[0])) == ncols and
+            int(round(edges[3] - edges[2])) == nrows)
+
+
+def is_on_geotransform_grid(filename, geotransform, tolerance=1.0e-3):
+    """Check if the pixels of a raster are pixels of another grid
+
+    Input
+        filename: Name of raster file in geographic coordinates
+        geotransform: Geotransform of the other grid, e.g. the native grid
+                      of a layer as found in its metadata
+        tolerance: Allowed deviation as a fraction of a pixel
+
+    Output
+        True if the raster has the pixel size of the grid and its origin
+        is a corner of a pixel of the grid. Resampling the raster then
+        picks the same values as resampling the data of the grid.
+    """
+
+    source = gdal.Open(filename)
+    msg = 'Could not open raster file %s' % filename
+    assert source is not None, msg
+
+    origin_x, dx, rotation_x, origin_y, rotation_y, dy = \
+        source.GetGeoTransform()
+    source = None
+
+    if rotation_x != 0 or rotation_y != 0:
+        return False
+    if geotransform[2] != 0 or geotransform[4] != 0:
+        return False
+
+    # Pixel sizes must agree closely enough for pixel edges to drift by
+    # less than tolerance over a thousand pixels
+    if (abs(dx - geotransform[1]) > tolerance * abs(dx) / 1000 or
+        abs(dy - geotransform[5]) > tolerance * abs(dy) / 1000):
+        return False
+
+    for position in [(origin_x - geotransform[0]) / geotransform[1],
+                     (origin_y - geotransform[3]) / geotransform[5]]:
+        if abs(position - round(position)) > tolerance:
+            return False
+
+    return True
+
+
+def split_bounding_box(bbox, resolution, tile_size):
+    """Split a raster request into tiles of at most tile_size pixels a side
+
+    Input
+        bbox: Bounding box [W, S, E, N]
+        resolution: Pixel size (resx, resy)
+        tile_size: Maximal number of pixels in each direction of a tile
+
+    Output
+        List of tile bounding boxes, row by row from the north west corner.
+        Tile boundaries fall on the pixel grid that starts at the north
+        west corner of bbox, so tiles fit together without resampling.
+    """
+
+    west, south, east, north = bbox
+    width = tile_size * resolution[0]
+    height = tile_size * resolution[1]
+
+    ncols = int(math.ceil((east - west) / width - 1.0e-9))
+    nrows = int(math.ceil((north - south) / height - 1.0e-9))
+
+    tiles = []
+    for j in range(max(1, nrows)):
+        for i in range(max(1, ncols)):
+            tiles.append([west + i * width,
+                          max(south, north - (j + 1) * height),
+                          min(east, west + (i + 1) * width),
+                          north - j * height])
+
+    return tiles
+
+
+def mosaic_rasters(filenames, bbox, resolution, mosaic_filename):
+    """Combine raster tiles into one GeoTIFF file
+
+    Input
+        filenames: Names of raster files on the pixel grid of the mosaic
+        bbox: Bounding box [W, S, E, N] of the mosaic
+        resolution: Pixel size (resx, resy) of the mosaic
+        mosaic_filename: Name of GeoTIFF file to create
+
+    Tiles are copied one at a time, so memory use is bounded by the size
+    of the largest tile. Pixels not covered by any tile are set to the
+    nodata value of the first tile.
+    """
+
+    ncols = int(round((bbox[2] - bbox[0]) / resolution[0]))
+    nrows = int(round((bbox[3] - bbox[1]) / resolution[1]))
+
+    first = gdal.Open(filenames[0])
+    msg = 'Could not open raster file %s' % filenames[0]
+    assert first is not None, msg
+
+    driver = gdal.GetDriverByName('GTiff')
+    mosaic = driver.Create(mosaic_filename, ncols, nrows, first.RasterCount,
+                           first.GetRasterBand(1).DataType)
+    mosaic.SetProjection(first.GetProjection())
+    mosaic.SetGeoTransform((bbox[0], resolution[0], 0,
+                            bbox[3], 0, -resolution[1]))
+
+    for i in range(1, first.RasterCount + 1):
+        nodata = first.GetRasterBand(i).GetNoDataValue()
+        if nodata is not None:
+            mosaic.GetRasterBand(i).SetNoDataValue(nodata)
+            mosaic.GetRasterBand(i).Fill(nodata)
+    first = None
+
+    for filename in filenames:
+        tile = gdal.Open(filename)
+        msg = 'Could not open raster file %s' % filename
+        assert tile is not None, msg
+
+        geotransform = tile.GetGeoTransform()
+        xoff = int(round((geotransform[0] - bbox[0]) / resolution[0]))
+        yoff = int(round((bbox[3] - geotransform[3]) / resolution[1]))
+
+        # Trim tiles reaching beyond the mosaic due to rounding
+        xsize = min(tile.RasterXSize, ncols - xoff)
+        ysize = min(tile.RasterYSize, nrows - yoff)
+        if xsize <= 0 or ysize <= 0:
+            continue
+
+        for i in range(1, tile.RasterCount + 1):
+            data = tile.GetRasterBand(i).ReadAsArray(0, 0, xsize, ysize)
+            mosaic.GetRasterBand(i).WriteArray(data, xoff, yoff)
+        tile = None
+
+    # Close dataset to flush the new file to disk
+    mosaic = None
+
+
+def warp_raster(filename, bbox, resolution, warped_filename):
+    """Resample a raster onto the pixel grid of a bounding box
+
+    Input
+        filename: Name of raster file in any projection known to GDAL
+        bbox: Bounding box [W, S, E, N] in geographic coordinates
+        resolution: Pixel size (resx, resy) in degrees
+        warped_filename: Name of GeoTIFF file to create
+
+    The grid is the one returned by a WCS request for bbox and resolution
+    in EPSG:4326. Pixels are resampled with nearest neighbour like
+    GeoServer does by default. Pixels outside of the source are set to
+    its nodata value.
+    """
+
+    ncols = max(1, int(round((bbox[2] - bbox[0]) / resolution[0])))
+    nrows = max(1, int(round((bbox[3] - bbox[1]) / resolution[1])))
+
+    source = gdal.Open(filename)
+    msg = 'Could not open raster file %s' % filename
+    assert source is not None, msg
+
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(4326)
+
+    driver = gdal.GetDriverByName('GTiff')
+    warped = driver.Create(warped_filename, ncols, nrows, source.RasterCount,
+                           source.GetRasterBand(1).DataType)
+    warped.SetProjection(srs.ExportToWkt())
+    warped.SetGeoTransform((bbox[0], resolution[0], 0,
+                            bbox[3], 0, -resolution[1]))
+
+    for i in range(1, source.RasterCount + 1):
+        nodata = source.GetRasterBand(i).GetNoDataValue()
+        if nodata is not None:
+            warped.GetRasterBand(i).SetNoDataValue(nodata)
+            warped.GetRasterBand(i).Fill(nodata)
+
+    gdal.ReprojectImage(source, warped, None, None, gdal.GRA_NearestNeighbour)
+
+    # Close datasets to flush the new file to disk
+    warped = None
+    source = None
+
+
+def get_overview_levels(filename, levels, min_size):
+    """Get overview levels worth building for a raster
+
+    Input
+        filename: Name of raster file
+        levels: Candidate decimation factors, e.g. [2, 4, 8]
+        min_size: Minimal number of pixels along the shorter side of an
+                  overview
+
+    Output
+        List of levels from levels giving overviews of at least min_size
+        pixels that the raster does not have already
+    """
+
+    source = gdal.Open(filename)
+    msg = 'Could not open raster file %s' % filename
+    assert source is not None, msg
+
+    size = min(source.RasterXSize, source.RasterYSize)
+    width = source.RasterXSize
+    band = source.GetRasterBand(1)
+    existing = [band.GetOverview(i).XSize
+                for i in range(band.GetOverviewCount())]
+    source = None
+
+    # Overviews are recognised by their width
+    return [level for level in levels
+            if size // level >= min_size and
+            int(math.ceil(float(width) / level)) not in existing]
+
+
+def build_overviews(filename, levels, resampling='NEAREST'):
+    """Build internal overviews of a GeoTIFF file
+
+    Input
+        filename: Name of GeoTIFF file. It is modified in place.
+        levels: Decimation factors, e.g. [2, 4, 8]
+        resampling: GDAL resampling method such as 'NEAREST' or 'AVERAGE'
+
+    Readers such as GeoServer use the overview closest to a requested
+    resolution instead of reading the full resolution grid.
+    """
+
+    dataset = gdal.Open(filename, gdal.GA_Update)
+    msg = 'Could not open raster file %s for update' % filename
+    assert dataset is not None, msg
+
+    result = dataset.BuildOverviews(resampling, levels)
+    msg = ('Could not build overviews %s of %s with resampling %s'
+           % (levels, filename, resampling))
+    assert result == 0, msg
+
+    # Close dataset to flush the overviews to disk
+    dataset = None
+
+
+def is_optimized_geotiff(filename):
+    """Check if a raster is an internally tiled and compressed GeoTIFF
+    """
+
+    dataset = gdal.Open(filename)
+    msg = 'Could not open raster file %s' % filename
+    assert dataset is not None, msg
+
+    # Blocks of stripped files are rows spanning the full width of the
+    # raster. Square blocks of a raster as wide as one block read like
+    # tiles even if the file calls them strips.
+    block_width, block_height = dataset.GetRasterBand(1).GetBlockSize()
+    tiled = (block_width != dataset.RasterXSize or
+             (block_height > 1 and block_height == block_width))
+    compression = dataset.GetMetadata('IMAGE_STRUCTURE').get('COMPRESSION')
+    driver = dataset.GetDriver().ShortName
+    dataset = None
+
+    return driver == 'GTiff' and tiled and compression is not None
+
+
+def write_optimized_geotiff(filename, optimized_filename, options):
+    """Copy a raster into a cloud optimized GeoTIFF
+
+    Input
+        filename: Name of raster file, possibly with overviews
+        optimized_filename: Name of GeoTIFF file to create
+        options: GTiff creation options such as ['TILED=YES',
+                 'COMPRESS=DEFLATE']
+
+    Overviews of the source are copied and stored in front of the full
+    resolution data. Projection, geotransform, nodata values and
+    metadata are copied as they are.
+    """
+
+    source = gdal.Open(filename)
+    msg = 'Could not open raster file %s' % filename
+    assert source is not None, msg
+
+    driver = gdal.GetDriverByName('GTiff')
+    optimized = driver.CreateCopy(optimized_filename, source, 0,
+                                  list(options) + ['COPY_SRC_OVERVIEWS=YES'])
+    msg = 'Could not write GeoTIFF file %s' % optimized_filename
+    assert optimized is not None, msg
+
+    # Close datasets to flush the new file to disk
+    optimized = None
+    source = None
+
+
+def write_band_array(filename, npy_filename, block_size=64 * 1024 ** 2):
+    """Write the first band of a raster file to a .npy file
+
+    Input
+        filename: Name of raster file
+        npy_filename: Name of .npy file to create
+        block_size: Maximal number of bytes read from the raster at a time
+
+    The array keeps the data type of the band, so the file is as large as
+    the uncompressed raster data. It is written to a temporary file and
+    renamed into place, so other processes either see a complete file or
+    none at all.
+    """
+
+    dataset = gdal.Open(filename)
+    msg = 'Could not open raster file %s' % filename
+    assert dataset is not None, msg
+
+    band = dataset.GetRasterBand(1)
+    rows, columns = dataset.RasterYSize, dataset.RasterXSize
+    dtype = gdal_array.GDALTypeCodeToNumericTypeCode(band.DataType)
+
+    fd, tmp_filename = mkstemp(suffix='.npy',
+                               dir=os.path.dirname(npy_filename))
+    os.close(fd)
+    try:
+        A = numpy.lib.format.open_memmap(tmp_filename, mode='w+',
+                                         dtype=dtype,
+                                         shape=(rows, columns))
+        step = max(1, block_size // (A.itemsize * columns))
+        for row in range(0, rows, step):
+            n = min(step, rows - row)
+            A[row:row + n] = band.ReadAsArray(0, row, columns, n)
+        A.flush()
+        del A
+        os.rename(tmp_filename, npy_filename)
+    except:
+        # Do not let cleaning up mask the original error
+        exc_info = sys.exc_info()
+        try:
+            os.remove(tmp_filename)
+        except OSError:
+            pass
+        raise exc_info[0], exc_info[1], exc_info[2]
+    finally:
+        band = None
+        dataset = None
+
+
+class MappedBand(object):
+    """GDAL band whose data is read from a memory mapped array
+
+    Reads of the whole band return the array, all other calls go to the
+    band itself.
+    """
+
+    def __init__(self, band, data):
+        self.band = band
+        self.data = data
+
+    def ReadAsArray(self, *args, **kwargs):
+        if args or kwargs:
+            return self.band.ReadAsArray(*args, **kwargs)
+        return self.data
+
+    def __getattr__(self, name):
+        return getattr(self.band, name)
+
+
+def memory_map_raster(layer, npy_filename):
+    """Read the data of a raster layer from a memory mapped .npy file
+
+    Input
+        layer: Raster layer read from a file with read_layer
+        npy_filename: Name of .npy file written by write_band_array for
+                      the same data
+
+    Raster.get_data reads the band when called. With the band mapped it
+    gets pages shared through the OS page cache with every other layer
+    mapping the same file, also in other processes, and GDAL does not
+    decode the raster again. Each call still returns a private double
+    precision array. With nodata values replaced by NaN, as by default,
+    it makes about three full size double precision arrays on the way.
+    Mapping only saves the private copy of the band that would otherwise
+    be read, e.g. 14% of the peak memory of get_data for a single
+    precision raster.
+    """
+
+    data = numpy.load(npy_filename, mmap_mode='r')
+    msg = ('Array in %s has shape %s but layer %s has %i rows and '
+           '%i columns' % (npy_filename, data.shape, layer.filename,
+                           layer.rows, layer.columns))
+    assert data.shape == (layer.rows, layer.columns), msg
+
+    layer.band = MappedBand(layer.band, data)
+
+
+def write_features(layers, filename, transformation=None, srs=None):
+    """Write features of OGR layers to a new shapefile
+
+    Input
+        layers: Iterable of OGR layers with the same fields, e.g. the
+                pages of a WFS response
+        filename: Name of shapefile to create
+        transformation: Optional osr.CoordinateTransformation applied to
+                        geometries on their way to the shapefile
+        srs: Spatial reference of the shapefile. If None, that of the
+             first layer is used, or EPSG:4326 if it has none.
+
+    Output
+        Number of features written. The shapefile is only created if
+        there is at least one feature.
+
+    Features are copied one at a time so memory use does not depend on
+    the number of features.
+    """
+
+    datasource = None
+    layer = None
+    count = 0
+    for source in layers:
+        feature = source.GetNextFeature()
+        if feature is None:
+            continue
+
+        if layer is None:
+            # WFS returns features in the native projection of the layer
+            if srs is None and source.GetSpatialRef() is not None:
+                srs = source.GetSpatialRef().Clone()
+            if srs is None:
+                srs = osr.SpatialReference()
+                srs.ImportFromEPSG(4326)
+
+            driver = ogr.GetDriverByName('ESRI Shapefile')
+            datasource = driver.CreateDataSource(filename)
+            msg = 'Could not create shapefile %s' % filename
+            assert datasource is not None, msg
+
+            # Create shapefile layer like the first source
+            defn = source.GetLayerDefn()
+            geometry_type = defn.GetGeomType()
+            if geometry_type == ogr.wkbUnknown:
+                geometry_type = feature.GetGeometryRef().GetGeometryType()
+
+            name = os.path.splitext(os.path.basename(filename))[0]
+            layer = datasource.CreateLayer(name, srs, geometry_type)
+            for i in range(defn.GetFieldCount()):
+                layer.CreateField(defn.GetFieldDefn(i))
+
+        while feature is not None:
+            copy = ogr.Feature(layer.GetLayerDefn())
+            copy.SetFrom(feature)
+            geometry = copy.GetGeometryRef()
+            if transformation is not None and geometry is not None:
+                geometry.Transform(transformation)
+            layer.CreateFeature(copy)
+            count += 1
+            feature = source.GetNextFeature()
+
+    # Close datasource to flush the shapefile to disk
+    layer = None
+    datasource = None
+
+    return count
+
+
+def index_shapefile(filename, fields=None):
+    """Build spatial and attribute indexes of a shapefile
+
+    Input
+        filename: Name of shapefile. Existing indexes are replaced.
+        fields: Optional names of attributes to index. Names are compared
+                without regard to case and those the shapefile does not
+                have are ignored.
+
+    Output
+        List of names of the indexed attributes
+
+    OGR and GeoServer use the spatial index (.qix) for bounding box
+    filters and OGR uses the attribute indexes for attribute filters, so
+    filtered reads scale with the number of matching features rather
+    than with the size of the layer.
+    """
+
+    basename = os.path.splitext(filename)[0]
+    dirname = os.path.dirname(os.path.abspath(filename))
+
+    # Build the indexes on a copy in a directory next to the shapefile and
+    # rename them into place, so readers of the shapefile never see partly
+    # written indexes
+    tmpdir = mkdtemp(prefix='.index-', dir=dirname)
+    try:
+        tmp_filename = os.path.join(tmpdir, os.path.basename(filename))
+        tmp_basename = os.path.splitext(tmp_filename)[0]
+        for ext in ['.shp', '.shx', '.dbf', '.prj', '.cpg']:
+            if os.path.isfile(basename + ext):
+                shutil.copy(basename + ext, tmp_basename + ext)
+
+        datasource = ogr.Open(tmp_filename, 1)
+        msg = 'Could not open shapefile %s for update' % filename
+        assert datasource is not None, msg
+
+        layer = datasource.GetLayer(0)
+        name = layer.GetName()
+        defn = layer.GetLayerDefn()
+        available = {}
+        for i in range(defn.GetFieldCount()):
+            field = defn.GetFieldDefn(i).GetName()
+            available[field.lower()] = field
+
+        datasource.ExecuteSQL('CREATE SPATIAL INDEX ON %s' % name)
+
+        indexed = []
+        for field in fields or []:
+            field = available.get(field.lower())
+            if field is not None and field not in indexed:
+                datasource.ExecuteSQL('CREATE INDEX ON %s USING %s'
+                                      % (name, field))
+                indexed.append(field)
+
+        # Close datasource to flush the indexes to disk
+        layer = None
+        datasource = None
+
+        for ext in SHAPEFILE_INDEX_TYPES:
+            if os.path.isfile(tmp_basename + ext):
+                os.rename(tmp_basename + ext, basename + ext)
+            elif os.path.isfile(basename + ext):
+                # Outdated index of attributes no longer indexed
+                os.remove(basename + ext)
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+    return indexed
+
+
+def clip_vector(filename, bbox, clipped_filename):
+    """Write the features of a vector file within a bounding box to a
+    shapefile
+
+    Input
+        filename: Name of vector file in any projection known to OGR
+        bbox: Bounding box [W, S, E, N] in geographic coordinates
+        clipped_filename: Name of shapefile to create
+
+    Output
+        Number of features written
+
+    Like a WFS request with a bbox, features intersecting bbox are
+    written whole. They are transformed to EPSG:4326.
+    """
+
+    source = ogr.Open(filename)
+    msg = 'Could not open vector file %s' % filename
+    assert source is not None, msg
+    layer = source.GetLayer(0)
+
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(4326)
+
+    west, south, east, north = bbox
+    ring = ogr.CreateGeometryFromWkt('POLYGON ((%s %s, %s %s, %s %s, '
+                                     '%s %s, %s %s))'
+                                     % (west, south, east, south,
+                                        east, north, west, north,
+                                        west, south))
+
+    # Filter in the projection of the file and transform what passes
+    transformation = None
+    source_srs = layer.GetSpatialRef()
+    if source_srs is not None and not source_srs.IsSame(srs):
+        ring.Transform(osr.CoordinateTransformation(srs, source_srs))
+        transformation = osr.CoordinateTransformation(source_srs, srs)
+
+    layer.SetSpatialFilter(ring)
+    count = write_features([layer], clipped_filename, transformation, srs)
+
+    layer = None
+    source = None
+
+    return count
+
+
+def layer_file_exists(filename):
+    """Check if a layer file exists
+
+    Input
+        filename: Name of file or GDAL virtual file name of a file in a
+                  zip archive (/vsizip/<archive>.zip/<member>)
+    """
+
+    if filename.startswith('/vsizip/'):
+        archive = filename[len('/vsizip/'):]
+        i = archive.find('.zip/')
+        if i < 0 or not os.path.isfile(archive[:i + 4]):
+            return False
+
+        with ZipFile(archive[:i + 4]) as zf:
+            return archive[i + 5:] in zf.namelist()
+
+    return os.path.exists(filename)
+
+
 def get_bounding_box_string(filename):
     """Get bounding box for specified raster or vector file
 
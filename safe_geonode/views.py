@@ -23,31 +23,60 @@ All API calls start with:
 """
 from __future__ import division
 
+import re
 import sys
+import base64
+import time
 import inspect
+import threading
+import hashlib
 import datetime
+import keyword as python_keywords
+from functools import partial
 
 from safe_geonode.storage import download
 from safe_geonode.storage import get_metadata
 from safe_geonode.storage import save_file_to_geonode
+from safe_geonode.storage import get_catalog_revision
+from safe_geonode.storage import get_layer_cache_stats
 from safe_geonode.models import Calculation, Workspace
 from safe_geonode.utilities import bboxlist2string
+from safe_geonode.utilities import bboxstring2list, check_bbox_string
+from safe_geonode.utilities import bbox_overlaps, BoundingBoxIndex
 from safe_geonode.utilities import titelize
 from safe_geonode.utilities import get_common_resolution, get_bounding_boxes
+from safe_geonode.utilities import run_in_parallel, CancelledError
 
+from safe.api import get_plugins
 from safe.api import get_admissible_plugins
+from safe.impact_functions.core import requirements_collect
+from safe.impact_functions.core import requirements_met
 from safe.api import calculate_impact
 
 from geonode.layers.utils import get_valid_user
 
 from django.utils import simplejson as json
-from django.http import HttpResponse
+from django.http import HttpResponse, HttpResponseNotModified
+from django.http import HttpResponseBadRequest
 from django.conf import settings
 from django.views.decorators.csrf import csrf_exempt
-from django.views.decorators.cache import cache_page
+from django.core.cache import cache
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from django.utils.http import parse_etags, quote_etag
 
 from urlparse import urljoin
 
+# Seconds to wait for the layers of the servers listed by questions. All
+# servers are queried at the same time, so each of them gets this long.
+SERVER_TIMEOUT = getattr(settings, 'SAFE_SERVER_TIMEOUT', 30)
+
+# Maximal number of layers downloaded at the same time by calculate
+DOWNLOAD_WORKERS = getattr(settings, 'SAFE_DOWNLOAD_WORKERS', 4)
+
+# Number of seconds answers from /questions/ are kept on the server
+QUESTIONS_CACHE_TIMEOUT = getattr(settings, 'SAFE_QUESTIONS_CACHE_TIMEOUT',
+                                  60 * 15)
+
 
 def exception_format(e):
     """Convert an exception object into a string,
@@ -58,6 +87,98 @@ def exception_format(e):
     return str(e) + '\n\n' + info
 
 
+def get_plugin_registry_hash():
+    """Get a hash identifying the registered plugins and their requirements
+
+    The hash changes whenever a plugin is added, removed or has its
+    requirements changed.
+    """
+
+    plugins = get_plugins()
+
+    registry_hash = hashlib.md5()
+    for name in sorted(plugins.keys()):
+        plugin = plugins[name]
+        registry_hash.update(name)
+        registry_hash.update(plugin.__module__)
+        registry_hash.update('\n'.join(requirements_collect(plugin)))
+
+    return registry_hash.hexdigest()
+
+
+def get_requirement_names():
+    """Get names of all keywords referred to by plugin requirements
+    """
+
+    names = set()
+    for plugin in get_plugins().values():
+        for requirement in requirements_collect(plugin):
+            # Only names outside of string literals refer to keywords
+            expression = re.sub(r"'[^']*'|\"[^\"]*\"", '', requirement)
+            names.update(re.findall(r'[A-Za-z_][A-Za-z0-9_]*', expression))
+
+    return names - set(python_keywords.kwlist)
+
+
+def keyword_signature(keywords, requirement_names):
+    """Get the part of a keywords dictionary that plugin requirements see
+
+    Input
+        keywords: Dictionary of layer keywords
+        requirement_names: Names referred to by plugin requirements
+                           as returned by get_requirement_names
+
+    Output
+        signature: Hashable object. Layers with the same signature are
+                   admissible for the same plugins.
+
+    Besides the keywords named in requirements, the signature records
+    whether safe can check requirements against the keywords at all.
+    Keywords that safe can not turn into Python assignments fail every
+    requirement, which is found by checking a requirement that always
+    holds.
+    """
+
+    items = tuple(sorted([(key, keywords[key]) for key in keywords
+                          if key.strip() in requirement_names]))
+    checkable = requirements_met(['True'], keywords)
+
+    return items, checkable
+
+
+# Plugin names admissible for each keyword signature, valid for the
+# plugin registry with the hash stored under 'registry'
+ADMISSIBLE_PLUGINS = {'registry': None, 'plugins': {}}
+
+
+def get_admissible_plugin_names(signature, keywords, registry):
+    """Get names of plugins admissible for a layer, memoized by signature
+
+    Input
+        signature: Keyword signature as returned by keyword_signature
+        keywords: Dictionary of layer keywords with that signature
+        registry: Current hash of the plugin registry as returned by
+                  get_plugin_registry_hash
+
+    Output
+        Set of plugin names
+
+    A pair of layers admits the plugins admitted by both of them,
+    which is what get_admissible_plugins checks for a list of keywords.
+    """
+
+    if ADMISSIBLE_PLUGINS['registry'] != registry:
+        # Plugins have changed since the names were memoized
+        ADMISSIBLE_PLUGINS['plugins'] = {}
+        ADMISSIBLE_PLUGINS['registry'] = registry
+
+    memo = ADMISSIBLE_PLUGINS['plugins']
+    if signature not in memo:
+        memo[signature] = frozenset(get_admissible_plugins(keywords=keywords))
+
+    return memo[signature]
+
+
 def get_servers(user):
     """ Gets the list of servers for a given user
     """
@@ -163,14 +284,29 @@ def calculate(request, save_output=save_file_to_geonode):
         msg = 'Performing requested calculation'
         #logger.info(msg)
 
-        # Download selected layer objects
-        layers = []
-        for server, layer_name, bbox in download_layers:
+        # Download selected layer objects at the same time.
+        # If one download fails the others are cancelled.
+        cancel = threading.Event()
+
+        def download_layer(item):
+            server, layer_name, bbox = item
             msg = ('- Downloading layer %s from %s'
                    % (layer_name, server))
             #logger.info(msg)
-            L = download(server, layer_name, bbox, raster_resolution)
-            layers.append(L)
+            return download(server, layer_name, bbox, raster_resolution,
+                            cancel=cancel)
+
+        results = run_in_parallel(download_layer, download_layers,
+                                  workers=DOWNLOAD_WORKERS, cancel=cancel)
+
+        # Report the failure that caused any cancellations
+        errors = [error for _, error in results if error is not None]
+        errors.sort(key=lambda error: isinstance(error, CancelledError))
+        if errors:
+            exc_info = errors[0].exc_info
+            raise exc_info[0], exc_info[1], exc_info[2]
+
+        layers = [L for L, _ in results]
 
         # Calculate result using specified impact function
         msg = ('- Calculating impact using %s' % impact_function_name)
@@ -284,12 +420,30 @@ def debug(request):
              'doc': f.__doc__,
             })
 
-    output = {'plugins': plugins_info}
+    output = {'plugins': plugins_info,
+              'layer_cache': get_layer_cache_stats()}
     jsondata = json.dumps(output)
     return HttpResponse(jsondata, mimetype='application/json')
 
 
-#@cache_page(60 * 15)
+def questions_cache_key(request, geoservers, revision):
+    """Get cache key for the questions offered by a list of servers
+
+    The key changes when the servers, the layer catalog revision, the
+    impact functions or the query parameters change. It also changes every
+    SAFE_QUESTIONS_CACHE_TIMEOUT seconds so that remote servers,
+    which do not tell us about their changes, are looked at again.
+    """
+
+    version = [[geoserver['url'] for geoserver in geoservers],
+               revision,
+               get_plugin_registry_hash(),
+               sorted(request.GET.lists()),
+               int(time.time() // QUESTIONS_CACHE_TIMEOUT)]
+
+    return 'safe-questions-%s' % hashlib.md5(json.dumps(version)).hexdigest()
+
+
 def questions(request):
     """Get a list of all the questions, layers and functions
 
@@ -299,8 +453,20 @@ def questions(request):
 
        e.g. http://127.0.0.1:8000/riab/api/v1/functions/?geoservers=http:...
        assumes version 1.0.0
+
+       The answer can be narrowed down with the query parameters
+       described in parse_questions_query.
+
+       Responses carry an ETag derived from the inputs of the answer,
+       so clients asking again with If-None-Match get a 304 when
+       nothing changed.
     """
 
+    try:
+        query = parse_questions_query(request.GET)
+    except (AssertionError, ValueError, TypeError), e:
+        return HttpResponseBadRequest(str(e))
+
     if 'geoservers' in request.GET:
         # FIXME for the moment assume version 1.0.0
         gs = request.GET['geoservers'].split(',')
@@ -308,13 +474,200 @@ def questions(request):
     else:
         geoservers = get_servers(request.user)
 
+    if query['server'] is not None:
+        geoservers = [geoserver for geoserver in geoservers
+                      if geoserver['url'] in query['server'] or
+                      str(geoserver.get('id')) in query['server']]
+
+    revision = get_catalog_revision()
+    key = questions_cache_key(request, geoservers, revision)
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match and key in parse_etags(if_none_match):
+        response = HttpResponseNotModified()
+    else:
+        jsondata = cache.get(key)
+        if jsondata is None:
+            revisions = []
+            output = get_questions(geoservers, bbox=query['bbox'],
+                                   function_names=query['function'],
+                                   revisions=revisions)
+            output = paginate_questions(output, query)
+            jsondata = json.dumps(output)
+
+            # Syncing the catalog while answering bumps the revision read
+            # above. If all bumps since then are our own, the answer was
+            # made from the current catalog and is filed under the
+            # revision of the last one. Otherwise layers changed while
+            # answering and the answer may be outdated already.
+            current_revision = get_catalog_revision()
+            if current_revision != revision:
+                if (revisions and current_revision == max(revisions) and
+                    current_revision - revision == len(revisions)):
+                    key = questions_cache_key(request, geoservers,
+                                              current_revision)
+                else:
+                    key = None
+
+            if key is None or output['degraded_servers']:
+                # Do not hold on to outdated or incomplete answers
+                key = None
+            else:
+                cache.set(key, jsondata, QUESTIONS_CACHE_TIMEOUT)
+
+        response = HttpResponse(jsondata, mimetype='application/json')
+
+    # The answer depends on the workspace of the user
+    patch_vary_headers(response, ['Cookie'])
+    if key is None:
+        patch_cache_control(response, no_cache=True)
+    else:
+        response['ETag'] = quote_etag(key)
+        patch_cache_control(response, private=True, max_age=0,
+                            must_revalidate=True)
+
+    return response
+
+
+def parse_questions_query(query):
+    """Get filters and pagination from the query parameters of /questions/
+
+    Input
+        query: Dictionary like object with these optional parameters
+            category: hazard or exposure. Only list layers of this category
+            bbox: W,S,E,N. Only use layers intersecting this bounding box
+            server: Comma separated server urls or ids. Only use these servers
+            function: Comma separated names. Only use these functions
+            cursor: Value of 'next' from a previous answer
+            limit: Maximal number of questions in the answer
+            slim: If present, leave out docstrings of functions
+
+    Output
+        Dictionary with the parsed parameters. Missing ones are None
+        except cursor which defaults to 0 and slim which is a boolean.
+    """
+
+    result = {}
+
+    result['category'] = query.get('category')
+    msg = ('Category must be either hazard or exposure. I got %s'
+           % result['category'])
+    assert result['category'] in [None, 'hazard', 'exposure'], msg
+
+    bbox = query.get('bbox')
+    if bbox is not None:
+        check_bbox_string(bbox)
+        bbox = bboxstring2list(bbox)
+    result['bbox'] = bbox
+
+    for name in ['server', 'function']:
+        value = query.get(name)
+        if value is not None:
+            value = value.split(',')
+        result[name] = value
+
+    cursor = query.get('cursor')
+    if cursor is None:
+        result['cursor'] = 0
+    else:
+        result['cursor'] = int(base64.urlsafe_b64decode(str(cursor)))
+        msg = 'Cursor %s was not valid' % cursor
+        assert result['cursor'] >= 0, msg
+
+    limit = query.get('limit')
+    if limit is not None:
+        limit = int(limit)
+        msg = 'Limit must be a positive number. I got %i' % limit
+        assert limit > 0, msg
+    result['limit'] = limit
+
+    result['slim'] = 'slim' in query
+
+    return result
+
+
+def paginate_questions(output, query):
+    """Apply category, pagination and slim mode to answer from get_questions
+
+    Input
+        output: Dictionary returned by get_questions
+        query: Dictionary returned by parse_questions_query
+
+    Output
+        output: Same dictionary. If only part of the questions is listed,
+                it has a key 'next' with the cursor for the following page.
+    """
+
+    if query['category'] is not None:
+        output['layers'] = dict([(name, params) for name, params
+                                 in output['layers'].items()
+                                 if params['keywords'].get('category') ==
+                                 query['category']])
+
+    start = query['cursor']
+    if query['limit'] is None:
+        end = len(output['questions'])
+    else:
+        end = start + query['limit']
+
+    if end < len(output['questions']):
+        output['next'] = base64.urlsafe_b64encode(str(end))
+    output['questions'] = output['questions'][start:end]
+
+    if query['slim']:
+        for function in output['functions'].values():
+            function.pop('doc', None)
+
+    return output
+
+
+def get_questions(geoservers, bbox=None, function_names=None,
+                  revisions=None):
+    """Get questions, layers and functions available from a list of servers
+
+    Input
+        geoservers: List of dictionaries with key 'url' and optionally 'name'
+        bbox: Optional bounding box [W, S, E, N]. If given, only layers
+              intersecting it are used
+        function_names: Optional list of names of the functions to use
+        revisions: Optional list. Catalog revisions produced by syncing
+                   the catalog while getting the layers are appended to it.
+
+    Output
+        Dictionary with keys 'layers', 'functions', 'questions'
+        and 'degraded_servers'
+    """
+
     layers = {}
     functions = {}
 
-    for geoserver in geoservers:
-        layers.update(get_metadata(geoserver['url']))
+    # Fetch metadata from all servers at once. Servers that fail or do
+    # not answer in time are reported as degraded instead of failing
+    # the whole request. The timeout is one deadline for all servers, so
+    # each server gets a thread of its own rather than waiting for a
+    # free one while the deadline runs.
+    results = run_in_parallel(partial(get_metadata, revisions=revisions),
+                              [geoserver['url'] for geoserver in geoservers],
+                              timeout=SERVER_TIMEOUT)
+
+    degraded_servers = []
+    for geoserver, (metadata, error) in zip(geoservers, results):
+        if error is None:
+            layers.update(metadata)
+        else:
+            degraded_servers.append({'url': geoserver['url'],
+                                     'name': geoserver.get('name'),
+                                     'error': str(error)})
+
+    if bbox is not None:
+        layers = dict([(name, params) for name, params in layers.items()
+                       if bbox_overlaps(bbox, params['bounding_box'])])
 
     admissible_plugins = get_admissible_plugins()
+    if function_names is not None:
+        admissible_plugins = dict([(name, f) for name, f
+                                   in admissible_plugins.items()
+                                   if name in function_names])
+
     for name, f in admissible_plugins.items():
         functions[name] = {'doc': f.__doc__,
                             }
@@ -322,13 +675,15 @@ def questions(request):
             if hasattr(f, key):
                 functions[name][key] = getattr(f, key)
 
-    output = {'layers': layers, 'functions': functions}
+    output = {'layers': layers, 'functions': functions,
+              'degraded_servers': degraded_servers}
 
     hazards = []
     exposures = []
 
-    # First get the list of all hazards and exposures
-    for name, params in layers.items():
+    # First get the list of all hazards and exposures. They are sorted
+    # so that pages of questions line up between requests.
+    for name, params in sorted(layers.items()):
         keywords = params['keywords']
         if 'category' in keywords:
             if keywords['category'] == 'hazard':
@@ -338,22 +693,43 @@ def questions(request):
 
     questions = []
 
-    # Then iterate over hazards and exposures to find 3-tuples of hazard, exposure and functions
+    # Layers whose keywords look the same to the plugin requirements
+    # admit the same plugins, so plugins are only evaluated once per
+    # distinct keyword signature.
+    registry = get_plugin_registry_hash()
+    requirement_names = get_requirement_names()
+    admissible = {}
+    for name in hazards + exposures:
+        keywords = layers[name]['keywords']
+        keywords['layertype'] = layers[name]['layertype']
+        signature = keyword_signature(keywords, requirement_names)
+        admissible[name] = get_admissible_plugin_names(signature, keywords,
+                                                       registry)
+
+    # Then iterate over hazards and overlapping exposures to find 3-tuples
+    # of hazard, exposure and functions. Layers that do not overlap within
+    # the bounding box would be rejected by calculate anyway.
+    exposure_index = BoundingBoxIndex([(name, layers[name]['bounding_box'])
+                                       for name in exposures])
     for hazard in hazards:
-        for exposure in exposures:
-            hazard_keywords = layers[hazard]['keywords']
-            exposure_keywords = layers[exposure]['keywords']
-
-            hazard_keywords['layertype'] = layers[hazard]['layertype']
-            exposure_keywords['layertype'] = layers[exposure]['layertype']
-
-            keywords = [hazard_keywords, exposure_keywords]
-            plugins = get_admissible_plugins(keywords=keywords)
-
-            for function in plugins:
+        hazard_bbox = layers[hazard]['bounding_box']
+        if hazard_bbox is None:
+            # Layers without a bounding box overlap nothing
+            continue
+        if bbox is not None:
+            hazard_bbox = [max(hazard_bbox[0], bbox[0]),
+                           max(hazard_bbox[1], bbox[1]),
+                           min(hazard_bbox[2], bbox[2]),
+                           min(hazard_bbox[3], bbox[3])]
+
+        for exposure in sorted(exposure_index.query(hazard_bbox)):
+            plugins = admissible[hazard] & admissible[exposure]
+            if function_names is not None:
+                plugins = plugins.intersection(function_names)
+
+            for function in sorted(plugins):
                 questions.append({'hazard': hazard, 'exposure': exposure, 'function': function})
 
     output['questions'] = questions
 
-    jsondata = json.dumps(output)
-    return HttpResponse(jsondata, mimetype='application/json')
+    return output
@@ -66,6 +66,7 @@ setup(
         'GeoNode',                  # sudo apt-get install geonode
         'django-leaflet>=0.2.0',    # pip install django-leaflet
         'pygments',                 # pip install pygments
+        'requests>=2.4',            # pip install requests
     ],
     packages = packages,
     data_files=data_files,